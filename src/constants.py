@@ -64,11 +64,26 @@ def get_eeprom_extension_database_file():
     return os.path.join(OPENMOTICS_PREFIX, 'etc/eeprom_ext.db')
 
 
+def get_eeprom_snapshot_file():
+    """ Get the filename of the EEPROM snapshot file. This file contains a memory mapped copy of the master EEPROM. """
+    return os.path.join(OPENMOTICS_PREFIX, 'etc/eeprom.snapshot')
+
+
 def get_metrics_database_file():
     """ Get the filename of the metrics database file. This file is in sqlite format. """
     return os.path.join(OPENMOTICS_PREFIX, 'etc/metrics.db')
 
 
+def get_metrics_store_dir():
+    """ Get the directory of the local metrics store. This directory contains the metric segment files. """
+    return os.path.join(OPENMOTICS_PREFIX, 'etc/metrics')
+
+
+def get_api_socket_file():
+    """ Get the unix domain socket on which the api is served to local processes (e.g. plugins). """
+    return os.path.join(OPENMOTICS_PREFIX, 'etc/api.sock')
+
+
 def get_pulse_counter_database_file():
     """ Get the filename of the pulse counter database file. This file is in sqlite format. """
     return os.path.join(OPENMOTICS_PREFIX, 'etc/pulse.db')
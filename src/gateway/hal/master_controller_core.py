@@ -48,6 +48,7 @@ from master.core.memory_models import CanControlModuleConfiguration, \
     GlobalConfiguration, InputConfiguration, InputModuleConfiguration, \
     OutputConfiguration, OutputModuleConfiguration, SensorConfiguration, \
     SensorModuleConfiguration, ShutterConfiguration
+from master.core.memory_types import memory_transaction
 from master.core.slave_communicator import SlaveCommunicator
 from master.core.system_value import Humidity, Temperature
 from master.core.ucan_communicator import UCANCommunicator
@@ -87,6 +88,7 @@ class MasterCoreController(MasterController):
         self._output_shutter_map = {}  # type: Dict[int, int]
 
         self._pubsub.subscribe_master_events(PubSub.MasterTopics.EEPROM, self._handle_eeprom_event)
+        self._pubsub.subscribe_master_events(PubSub.MasterTopics.MAINTENANCE, self._handle_maintenance_event)
 
         self._master_communicator.register_consumer(
             BackgroundConsumer(CoreAPI.event_information(), 0, self._handle_event)
@@ -114,6 +116,11 @@ class MasterCoreController(MasterController):
             self._input_last_updated = 0.0
             self._output_last_updated = 0.0
 
+    def _handle_maintenance_event(self, master_event):
+        # type: (MasterEvent) -> None
+        if master_event.type == MasterEvent.Types.MAINTENANCE_EXIT:
+            self._memory_files[MemoryTypes.EEPROM].invalidate_cache()
+
     def _handle_event(self, data):
         # type: (Dict[str, Any]) -> None
         core_event = MasterCoreEvent(data)
@@ -388,9 +395,10 @@ class MasterCoreController(MasterController):
         return inputs
 
     def save_inputs(self, inputs):  # type: (List[Tuple[InputDTO, List[str]]]) -> None
-        for input_dto, fields in inputs:
-            input_ = InputMapper.dto_to_orm(input_dto, fields)
-            input_.save()  # TODO: Batch saving - postpone eeprom activate if relevant for the Core
+        with memory_transaction():
+            for input_dto, fields in inputs:
+                input_ = InputMapper.dto_to_orm(input_dto, fields)
+                input_.save()
 
     def _refresh_input_states(self):
         # type: () -> bool
@@ -447,12 +455,13 @@ class MasterCoreController(MasterController):
         return outputs
 
     def save_outputs(self, outputs):  # type: (List[Tuple[OutputDTO, List[str]]]) -> None
-        for output_dto, fields in outputs:
-            output = OutputMapper.dto_to_orm(output_dto, fields)
-            if output.is_shutter:
-                # Shutter outputs cannot be changed
-                continue
-            output.save()  # TODO: Batch saving - postpone eeprom activate if relevant for the Core
+        with memory_transaction():
+            for output_dto, fields in outputs:
+                output = OutputMapper.dto_to_orm(output_dto, fields)
+                if output.is_shutter:
+                    # Shutter outputs cannot be changed
+                    continue
+                output.save()
 
     def load_output_status(self):
         # type: () -> List[Dict[str,Any]]
@@ -505,31 +514,31 @@ class MasterCoreController(MasterController):
         return shutters
 
     def save_shutters(self, shutters):  # type: (List[Tuple[ShutterDTO, List[str]]]) -> None
-        # TODO: Batch saving - postpone eeprom activate if relevant for the Core
         # TODO: Atomic saving
-        for shutter_dto, fields in shutters:
-            # Validate whether output module exists
-            output_module = OutputConfiguration(shutter_dto.id * 2).module
-            # Configure shutter
-            shutter = ShutterMapper.dto_to_orm(shutter_dto, fields)
-            if shutter.timer_down not in [0, 65535] and shutter.timer_up not in [0, 65535]:
-                # Shutter is "configured"
-                shutter.outputs.output_0 = shutter.id * 2
-                output_set = shutter.output_set
-                self._output_shutter_map[shutter.outputs.output_0] = shutter.id
-                self._output_shutter_map[shutter.outputs.output_1] = shutter.id
-                is_configured = True
-            else:
-                output_set = shutter.output_set  # Previous outputs need to be restored
-                self._output_shutter_map.pop(shutter.outputs.output_0, None)
-                self._output_shutter_map.pop(shutter.outputs.output_1, None)
-                shutter.outputs.output_0 = 255 * 2
-                is_configured = False
-            shutter.save()
-            # Mark related Outputs as "occupied by shutter"
-            setattr(output_module.shutter_config, 'are_{0}_outputs'.format(output_set), not is_configured)
-            setattr(output_module.shutter_config, 'set_{0}_direction'.format(shutter.output_set), shutter_dto.up_down_config == 1)
-            output_module.save()
+        with memory_transaction():
+            for shutter_dto, fields in shutters:
+                # Validate whether output module exists
+                output_module = OutputConfiguration(shutter_dto.id * 2).module
+                # Configure shutter
+                shutter = ShutterMapper.dto_to_orm(shutter_dto, fields)
+                if shutter.timer_down not in [0, 65535] and shutter.timer_up not in [0, 65535]:
+                    # Shutter is "configured"
+                    shutter.outputs.output_0 = shutter.id * 2
+                    output_set = shutter.output_set
+                    self._output_shutter_map[shutter.outputs.output_0] = shutter.id
+                    self._output_shutter_map[shutter.outputs.output_1] = shutter.id
+                    is_configured = True
+                else:
+                    output_set = shutter.output_set  # Previous outputs need to be restored
+                    self._output_shutter_map.pop(shutter.outputs.output_0, None)
+                    self._output_shutter_map.pop(shutter.outputs.output_1, None)
+                    shutter.outputs.output_0 = 255 * 2
+                    is_configured = False
+                shutter.save()
+                # Mark related Outputs as "occupied by shutter"
+                setattr(output_module.shutter_config, 'are_{0}_outputs'.format(output_set), not is_configured)
+                setattr(output_module.shutter_config, 'set_{0}_direction'.format(shutter.output_set), shutter_dto.up_down_config == 1)
+                output_module.save()
 
     def _refresh_shutter_states(self):
         status_data = {x['device_nr']: x for x in self.load_output_status()}
@@ -647,9 +656,10 @@ class MasterCoreController(MasterController):
         return sensors
 
     def save_sensors(self, sensors):  # type: (List[Tuple[SensorDTO, List[str]]]) -> None
-        for sensor_dto, fields in sensors:
-            sensor = SensorMapper.dto_to_orm(sensor_dto, fields)
-            sensor.save()  # TODO: Batch saving - postpone eeprom activate if relevant for the Core
+        with memory_transaction():
+            for sensor_dto, fields in sensors:
+                sensor = SensorMapper.dto_to_orm(sensor_dto, fields)
+                sensor.save()
 
     def _refresh_sensor_states(self):
         amount_sensor_modules = self._master_communicator.do_command(CoreAPI.general_configuration_number_of_modules(), {})['sensor']
@@ -719,9 +729,10 @@ class MasterCoreController(MasterController):
                 for o in GroupActionController.load_group_actions()]
 
     def save_group_actions(self, group_actions):  # type: (List[Tuple[GroupActionDTO, List[str]]]) -> None
-        for group_action_dto, fields in group_actions:
-            group_action = GroupActionMapper.dto_to_orm(group_action_dto, fields)
-            GroupActionController.save_group_action(group_action, fields)
+        with memory_transaction():
+            for group_action_dto, fields in group_actions:
+                group_action = GroupActionMapper.dto_to_orm(group_action_dto, fields)
+                GroupActionController.save_group_action(group_action, fields)
 
     # Module management
 
@@ -1015,6 +1026,7 @@ class MasterCoreController(MasterController):
     def update_master(self, hex_filename):
         # type: (str) -> None
         CoreUpdater.update(hex_filename=hex_filename)
+        self._memory_files[MemoryTypes.EEPROM].invalidate_cache()  # The new firmware might have migrated the EEPROM
 
     def get_backup(self):
         data = bytearray()
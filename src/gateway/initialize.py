@@ -182,12 +182,12 @@ def setup_target_platform(target_platform, message_client_name):
     # abstract implementations depending on e.g. the platform (classic vs core) or certain settings (classic
     # thermostats vs gateway thermostats)
     from plugins import base
-    from gateway import (metrics_controller, webservice, scheduling, observer, gateway_api, metrics_collector,
+    from gateway import (metrics_controller, metrics_store, webservice, scheduling, observer, gateway_api, metrics_collector,
                          maintenance_controller, user_controller, pulse_counter_controller,
                          metrics_caching, watchdog, output_controller, room_controller, sensor_controller,
                          shutter_controller, group_action_controller, module_controller, ventilation_controller)
     from cloud import events
-    _ = (metrics_controller, webservice, scheduling, observer, gateway_api, metrics_collector,
+    _ = (metrics_controller, metrics_store, webservice, scheduling, observer, gateway_api, metrics_collector,
          maintenance_controller, base, events, user_controller,
          pulse_counter_controller, metrics_caching, watchdog, output_controller, room_controller,
          sensor_controller, shutter_controller, group_action_controller, module_controller, ventilation_controller)
@@ -223,6 +223,7 @@ def setup_target_platform(target_platform, message_client_name):
     # Metrics Controller
     Injectable.value(metrics_db=constants.get_metrics_database_file())
     Injectable.value(metrics_db_lock=metrics_lock)
+    Injectable.value(metrics_store_dir=constants.get_metrics_store_dir())
 
     # Energy Controller
     try:
@@ -271,7 +272,7 @@ def setup_target_platform(target_platform, message_client_name):
 
         Injectable.value(master_communicator=CoreCommunicator())
         Injectable.value(maintenance_communicator=MaintenanceCoreCommunicator())
-        Injectable.value(memory_files={MemoryTypes.EEPROM: MemoryFile(MemoryTypes.EEPROM),
+        Injectable.value(memory_files={MemoryTypes.EEPROM: MemoryFile(MemoryTypes.EEPROM, snapshot_path=constants.get_eeprom_snapshot_file()),
                                        MemoryTypes.FRAM: MemoryFile(MemoryTypes.FRAM)})
         Injectable.value(master_controller=MasterCoreController())
     elif target_platform in Platform.ClassicTypes:
@@ -281,6 +282,7 @@ def setup_target_platform(target_platform, message_client_name):
         leds_i2c_address = config.get('OpenMotics', 'leds_i2c_address')
         passthrough_serial_port = config.get('OpenMotics', 'passthrough_serial')
         Injectable.value(eeprom_db=constants.get_eeprom_extension_database_file())
+        Injectable.value(eeprom_snapshot_file=constants.get_eeprom_snapshot_file())
         Injectable.value(leds_i2c_address=int(leds_i2c_address, 16))
         if passthrough_serial_port:
             Injectable.value(passthrough_serial=Serial(passthrough_serial_port, 115200))
@@ -339,11 +341,12 @@ def setup_minimal_master_platform(port):
         Injectable.value(cli_serial=Serial(core_cli_serial_port, 115200))
         Injectable.value(master_communicator=CoreCommunicator())
         Injectable.value(maintenance_communicator=None)
-        Injectable.value(memory_files={MemoryTypes.EEPROM: MemoryFile(MemoryTypes.EEPROM),
+        Injectable.value(memory_files={MemoryTypes.EEPROM: MemoryFile(MemoryTypes.EEPROM, snapshot_path=constants.get_eeprom_snapshot_file()),
                                        MemoryTypes.FRAM: MemoryFile(MemoryTypes.FRAM)})
         Injectable.value(master_controller=MasterCoreController())
     elif platform in Platform.ClassicTypes:
         Injectable.value(eeprom_db=constants.get_eeprom_extension_database_file())
+        Injectable.value(eeprom_snapshot_file=constants.get_eeprom_snapshot_file())
         from master.classic import eeprom_extension
         _ = eeprom_extension
         Injectable.value(master_communicator=MasterCommunicator())
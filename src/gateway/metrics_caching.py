@@ -23,6 +23,11 @@ import logging
 import ujson as json
 from random import randint
 from ioc import Injectable, Inject, INJECTED, Singleton
+from gateway.daemon_thread import DaemonThread
+from gateway.models import Config
+
+if False:  # MYPY
+    from typing import Dict, List, Optional, Set, Tuple
 
 logger = logging.getLogger("openmotics")
 
@@ -31,6 +36,9 @@ logger = logging.getLogger("openmotics")
 @Singleton
 class MetricsCacheController(object):
 
+    FLUSH_INTERVAL = 60
+    BUFFER_PAGE_SIZE = 500
+
     @Inject
     def __init__(self, metrics_db=INJECTED, metrics_db_lock=INJECTED):
         """
@@ -46,6 +54,27 @@ class MetricsCacheController(object):
                                            isolation_level=None)
         self._cursor = self._connection.cursor()
         self._check_tables()
+        # Counter state is kept in memory and written behind to the database. Keyed by (source, type, identifier, name),
+        # the value holds [last_value, counter, timestamp, persisted].
+        self._source_ids = {}  # type: Dict[Tuple[str, str, str], int]
+        self._counters = {}  # type: Dict[Tuple[str, str, str, str], List]
+        self._dirty_counters = set()  # type: Set[Tuple[str, str, str, str]]
+        self._load_counters()
+        self._flusher = None  # type: Optional[DaemonThread]
+
+    def start(self):
+        # type: () -> None
+        flush_interval = Config.get_entry('metrics_counter_flush_interval', MetricsCacheController.FLUSH_INTERVAL)  # type: int
+        self._flusher = DaemonThread(name='metricscacheflush',
+                                     target=self.flush,
+                                     interval=flush_interval)
+        self._flusher.start()
+
+    def stop(self):
+        # type: () -> None
+        if self._flusher is not None:
+            self._flusher.stop()
+        self.flush()
 
     def _execute(self, *args, **kwargs):
         with self._lock:
@@ -65,24 +94,68 @@ class MetricsCacheController(object):
         self._execute("CREATE TABLE IF NOT EXISTS counter_sources (id INTEGER PRIMARY KEY, source TEXT, type TEXT, identifier TEXT);")
         self._execute("CREATE TABLE IF NOT EXISTS counters (id INTEGER PRIMARY KEY, source_id INTEGER , name TEXT, last_value REAL, counter REAL, timestamp INTEGER);")
         self._execute("CREATE TABLE IF NOT EXISTS counters_buffer (id INTEGER PRIMARY KEY, source_id INTEGER, counters TEXT, timestamp INTEGER);")
+        self._execute("CREATE INDEX IF NOT EXISTS counter_sources_lookup ON counter_sources (source, type, identifier);")
+        self._execute("CREATE INDEX IF NOT EXISTS counters_lookup ON counters (source_id, name);")
+        self._execute("CREATE INDEX IF NOT EXISTS counters_buffer_timestamp ON counters_buffer (timestamp);")
+        self._execute("CREATE INDEX IF NOT EXISTS counters_buffer_source ON counters_buffer (source_id, timestamp);")
+
+    def _load_counters(self):
+        with self._lock:
+            for source_id, source, mtype, identifier in self._execute_unlocked("SELECT id, source, type, identifier FROM counter_sources;").fetchall():
+                self._source_ids[(source, mtype, identifier)] = source_id
+            data = self._execute_unlocked("SELECT source, type, identifier, name, last_value, counter, counters.timestamp FROM counters "
+                                          "INNER JOIN counter_sources ON counter_sources.id = counters.source_id;").fetchall()
+            for source, mtype, identifier, name, last_value, counter, timestamp in data:
+                self._counters[(source, mtype, identifier, name)] = [last_value, counter, timestamp, True]
 
     def process_counter(self, source, mtype, tags, name, value, timestamp):
+        identifier = json.dumps(tags, sort_keys=True)
+        key = (source, mtype, identifier, name)
         with self._lock:
-            identifier = json.dumps(tags, sort_keys=True)
-            id = self._get_counter_id(source, mtype, identifier)
-            data = self._execute_unlocked("SELECT last_value, counter FROM counters WHERE source_id=? AND name=?;", (id, name))
-            for entry in data:
-                last_value, counter = entry
-                if last_value == value:
-                    return counter
-                if last_value < value:
-                    counter += (value - last_value)
-                else:
-                    counter += value
-                self._execute_unlocked("UPDATE counters SET last_value=?, counter=?, timestamp=? WHERE source_id=? AND name=?;", (value, counter, timestamp, id, name))
+            entry = self._counters.get(key)
+            if entry is None:
+                self._counters[key] = [value, value, timestamp, False]
+                self._dirty_counters.add(key)
+                return value
+            last_value, counter = entry[0], entry[1]
+            if last_value == value:
                 return counter
-            self._execute_unlocked("INSERT INTO counters (source_id, name, last_value, counter, timestamp) VALUES (?, ?, ?, ?, ?);", (id, name, value, value, timestamp))
-            return value
+            if last_value < value:
+                counter += (value - last_value)
+            else:
+                counter += value
+            entry[0], entry[1], entry[2] = value, counter, timestamp
+            self._dirty_counters.add(key)
+            return counter
+
+    def flush(self):
+        # type: () -> None
+        """ Writes all changed counters to the database, in a single transaction """
+        with self._lock:
+            if not self._dirty_counters:
+                return
+            updates, inserts = [], []
+            source_ids = dict(self._source_ids)
+            self._execute_unlocked("BEGIN;")
+            try:
+                for key in self._dirty_counters:
+                    source, mtype, identifier, name = key
+                    last_value, counter, timestamp, persisted = self._counters[key]
+                    source_id = self._get_counter_id(source, mtype, identifier)
+                    if persisted:
+                        updates.append((last_value, counter, timestamp, source_id, name))
+                    else:
+                        inserts.append((source_id, name, last_value, counter, timestamp))
+                self._cursor.executemany("UPDATE counters SET last_value=?, counter=?, timestamp=? WHERE source_id=? AND name=?;", updates)
+                self._cursor.executemany("INSERT INTO counters (source_id, name, last_value, counter, timestamp) VALUES (?, ?, ?, ?, ?);", inserts)
+                self._execute_unlocked("COMMIT;")
+            except Exception:
+                self._execute_unlocked("ROLLBACK;")
+                self._source_ids = source_ids  # Newly created sources are rolled back as well
+                raise
+            for key in self._dirty_counters:
+                self._counters[key][3] = True
+            self._dirty_counters = set()
 
     def buffer_counter(self, source, mtype, tags, counters, timestamp):
         with self._lock:
@@ -98,28 +171,65 @@ class MetricsCacheController(object):
     def _floored_timestamp(timestamp, window=60 * 60 * 24):
         return int(timestamp) - (int(timestamp) % window)
 
-    def load_buffer(self, before):
+    def load_buffer(self, before, with_ids=False):
+        for page in self.iter_buffer(before, with_ids=with_ids):
+            for item in page:
+                yield item
+
+    def iter_buffer(self, before, page_size=BUFFER_PAGE_SIZE, with_ids=False):
+        """
+        Yields the buffered metrics older than `before` (or all of them if `before` is -1) in pages of at most
+        `page_size` metrics. Every page is a separate query, so the lock is not held while the pages are processed.
+        With `with_ids`, every metric is yielded as a (buffer id, metric) tuple (see `clear_buffer_until`).
+        """
+        query = ("SELECT counters_buffer.id, source, type, identifier, counters, timestamp FROM counters_buffer "
+                 "INNER JOIN counter_sources ON counter_sources.id = counters_buffer.source_id "
+                 "WHERE counters_buffer.id > ?{0} ORDER BY counters_buffer.id LIMIT ?;").format('' if before == -1 else ' AND timestamp < ?')
+        last_id = 0
+        while True:
+            parameters = (last_id,) + (() if before == -1 else (before,)) + (page_size,)
+            with self._lock:
+                buffer_items = self._execute_unlocked(query, parameters).fetchall()
+            if not buffer_items:
+                return
+            last_id = buffer_items[-1][0]
+            metrics = [{'source': item[1],
+                        'type': item[2],
+                        'tags': json.loads(item[3]),
+                        'values': json.loads(item[4]),
+                        'timestamp': item[5]} for item in buffer_items]
+            yield [(item[0], metric) for item, metric in zip(buffer_items, metrics)] if with_ids else metrics
+            if len(buffer_items) < page_size:
+                return
+
+    def count_buffer(self, before):
         with self._lock:
-            buffer_items = self._execute_unlocked("SELECT source, type, identifier, counters, timestamp FROM counters_buffer INNER JOIN counter_sources ON counter_sources.id = counters_buffer.source_id;")
-        for item in buffer_items:
-            if before == -1 or before > item[4]:
-                yield {'source': item[0],
-                       'type': item[1],
-                       'tags': json.loads(item[2]),
-                       'values': json.loads(item[3]),
-                       'timestamp': item[4]}
+            if before == -1:
+                return self._execute_unlocked("SELECT COUNT(*) FROM counters_buffer;").fetchone()[0]
+            return self._execute_unlocked("SELECT COUNT(*) FROM counters_buffer WHERE timestamp < ?;", (before,)).fetchone()[0]
 
     def clear_buffer(self, timestamp):
         with self._lock:
             self._execute_unlocked("DELETE FROM counters_buffer WHERE timestamp < ?;", (timestamp,))
             return self._execute_unlocked("SELECT changes();").fetchone()[0]
 
+    def clear_buffer_until(self, buffer_id):
+        """ Removes the buffered metrics up to (and including) the given buffer id """
+        with self._lock:
+            self._execute_unlocked("DELETE FROM counters_buffer WHERE id <= ?;", (buffer_id,))
+            return self._execute_unlocked("SELECT changes();").fetchone()[0]
+
     def _get_counter_id(self, source, mtype, identifier):
+        key = (source, mtype, identifier)
+        if key in self._source_ids:
+            return self._source_ids[key]
         data = self._execute_unlocked("SELECT id FROM counter_sources WHERE source=? AND type=? AND identifier=?;", (source, mtype, identifier)).fetchone()
         if data is not None:
-            return data[0]
-        result = self._execute_unlocked("INSERT INTO counter_sources (source, type, identifier) VALUES (?, ?, ?);", (source, mtype, identifier))
-        return result.lastrowid
+            source_id = data[0]
+        else:
+            source_id = self._execute_unlocked("INSERT INTO counter_sources (source, type, identifier) VALUES (?, ?, ?);", (source, mtype, identifier)).lastrowid
+        self._source_ids[key] = source_id
+        return source_id
 
     def close(self):
         """ Close the database connection. """
@@ -20,19 +20,22 @@ from __future__ import absolute_import
 import logging
 import re
 import time
+import zlib
 from collections import deque
 
 import requests
 import ujson as json
+from six.moves.urllib.parse import urlencode
 
 from bus.om_bus_events import OMBusEvents
 from gateway.daemon_thread import DaemonThread, DaemonThreadWait
+from gateway.metrics_record import MetricRecord
 from gateway.models import Config
 from ioc import INJECTED, Inject, Injectable, Singleton
 import six
 
 if False:  # MYPY
-    from typing import Any, Dict, Optional, List
+    from typing import Any, Dict, Iterator, Optional, List, Tuple
     from plugins.base import PluginController
     from gateway.metrics_collector import MetricsCollector
     from gateway.metrics_caching import MetricsCacheController
@@ -52,6 +55,11 @@ class MetricsController(object):
     The Metrics Controller collects all metrics and pushses them to all subscribers
     """
 
+    CLOUD_UPLOAD_BATCH_SIZE = 500
+    CLOUD_UPLOAD_QUEUE_SIZE = 5000
+    CLOUD_BACKOFF_BASE = 5
+    CLOUD_BACKOFF_MAX = 60 * 60
+
     @Inject
     def __init__(self, plugin_controller=INJECTED, metrics_collector=INJECTED, metrics_cache_controller=INJECTED, gateway_uuid=INJECTED):
         # type: (PluginController, MetricsCollector, MetricsCacheController, str) -> None
@@ -62,12 +70,14 @@ class MetricsController(object):
         self._buffer_counters = {}  # type: Dict
         self.definitions = {}  # type: Dict
         self._definition_filters = {'source': {}, 'metric_type': {}}  # type: Dict
+        self._routing_table = None  # type: Optional[Dict[str, Any]]
         self._metrics_cache = {}  # type: Dict
         self._collector_plugins = None  # type: Optional[DaemonThread]
         self._collector_openmotics = None  # type: Optional[DaemonThread]
         self._internal_stats = None
         self._distributor_plugins = None  # type: Optional[DaemonThread]
         self._distributor_openmotics = None  # type: Optional[DaemonThread]
+        self._cloud_uploader = None  # type: Optional[DaemonThread]
         self.metrics_queue_plugins = deque()  # type: deque
         self.metrics_queue_openmotics = deque()  # type: deque
         self.inbound_rates = {'total': 0}
@@ -75,18 +85,25 @@ class MetricsController(object):
         self._openmotics_receivers = []  # type: List
         self._cloud_cache = {}  # type: Dict
         self._cloud_queue = []  # type: List
-        self._cloud_buffer = []  # type: List
+        self._cloud_buffer_outstanding = 0
         self._cloud_buffer_length = 0
         self._load_cloud_buffer()
         self._cloud_last_send = time.time()
         self._cloud_last_try = time.time()
         self._cloud_retry_interval = None  # type: Optional[int]
+        self._cloud_failures = 0
+        self._cloud_upload_queue = deque(maxlen=MetricsController.CLOUD_UPLOAD_QUEUE_SIZE)  # type: deque
+        self._cloud_session = requests.Session()
         self._gateway_uuid = gateway_uuid
         self._throttled_down = False
         self.cloud_stats = {'queue': 0,
                             'buffer': self._cloud_buffer_length,
                             'time_ago_send': 0,
-                            'time_ago_try': 0}
+                            'time_ago_try': 0,
+                            'upload_queue': 0,
+                            'upload_dropped': 0,
+                            'upload_latency': 0.0,
+                            'bytes_sent': 0}
 
         # Metrics generated by the Metrics_Controller_ are also defined in the collector. Trying to get them in one place.
         for definition in self._metrics_collector.get_definitions():
@@ -97,6 +114,7 @@ class MetricsController(object):
 
     def start(self):
         self._refresh_cloud_interval()
+        self._metrics_cache_controller.start()
         self._collector_plugins = DaemonThread(name='metricplugincoll',
                                                target=self._collect_plugins,
                                                interval=1)
@@ -113,6 +131,10 @@ class MetricsController(object):
                                                     target=self._distribute_openmotics,
                                                     interval=0, delay=0.1)
         self._distributor_openmotics.start()
+        self._cloud_uploader = DaemonThread(name='metriccloudupload',
+                                            target=self._upload_cloud_metrics,
+                                            interval=1)
+        self._cloud_uploader.start()
 
     def stop(self):
         # type: () -> None
@@ -124,6 +146,9 @@ class MetricsController(object):
             self._distributor_plugins.stop()
         if self._distributor_openmotics is not None:
             self._distributor_openmotics.stop()
+        if self._cloud_uploader is not None:
+            self._cloud_uploader.stop()
+        self._metrics_cache_controller.stop()
 
     def set_cloud_interval(self, metric_type, interval, save=True):
         logger.info('Setting cloud interval {0}_{1}'.format(metric_type, interval))
@@ -138,6 +163,7 @@ class MetricsController(object):
         self._throttled_down = False
 
     def add_receiver(self, receiver):
+        """ Adds an internal receiver, which will be called with batches (lists) of metrics """
         self._openmotics_receivers.append(receiver)
 
     def get_filter(self, filter_type, metric_filter):
@@ -226,11 +252,45 @@ class MetricsController(object):
                 self._buffer_counters.pop(source, None)
         self._definition_filters['source'] = {}
         self._definition_filters['metric_type'] = {}
+        self._routing_table = None
+
+    def _get_oldest_queue_timestamp(self):
+        return min([time.time()] + [metric[0]['timestamp'] for metric in self._cloud_queue])
 
     def _load_cloud_buffer(self):
-        oldest_queue_timestamp = min([time.time()] + [metric[0]['timestamp'] for metric in self._cloud_queue])
-        self._cloud_buffer = [[metric] for metric in self._metrics_cache_controller.load_buffer(before=oldest_queue_timestamp)]
-        self._cloud_buffer_length = len(self._cloud_buffer)
+        # The buffered metrics themselves stay on disk, they are only streamed when uploading
+        self._cloud_buffer_outstanding = self._metrics_cache_controller.count_buffer(before=self._get_oldest_queue_timestamp())
+        self._cloud_buffer_length = self._cloud_buffer_outstanding
+
+    def _iter_cloud_batches(self):
+        # type: () -> Iterator[Tuple[List[List[Dict[str, Any]]], Optional[int], int]]
+        """
+        Yields the outstanding buffered metrics followed by the queued metrics, in batches. Every batch comes with
+        the buffer id of its last buffered metric (if any) and the amount of queued metrics it contains, so these
+        can be cleared as soon as the batch is sent.
+        """
+        buffered_metrics = iter([])  # type: Iterator[Tuple[int, Dict[str, Any]]]
+        if self._cloud_buffer_outstanding > 0:
+            buffered_metrics = self._metrics_cache_controller.load_buffer(before=self._get_oldest_queue_timestamp(), with_ids=True)
+        batch = []  # type: List[List[Dict[str, Any]]]
+        buffer_id = None  # type: Optional[int]
+        queued = 0
+        for buffer_id, metric in buffered_metrics:
+            batch.append([metric])
+            if len(batch) >= MetricsController.CLOUD_UPLOAD_BATCH_SIZE:
+                yield batch, buffer_id, 0
+                batch = []
+                buffer_id = None
+        for queued_metric in list(self._cloud_queue):
+            batch.append(queued_metric)
+            queued += 1
+            if len(batch) >= MetricsController.CLOUD_UPLOAD_BATCH_SIZE:
+                yield batch, buffer_id, queued
+                batch = []
+                buffer_id = None
+                queued = 0
+        if batch:
+            yield batch, buffer_id, queued
 
     @staticmethod
     def _parse_definition(definition):
@@ -254,35 +314,88 @@ class MetricsController(object):
                     settings[policy][metric['name']] = setting
         return settings
 
-    def _needs_upload_to_cloud(self, metric):
-        metric_type = metric['type']
-        metric_source = metric['source']
+    def _get_routing_table(self):
+        # type: () -> Dict[str, Any]
+        """
+        Returns the routing table, holding the cloud settings and the compiled routes per source/type. It is
+        rebuilt when the definitions or the configuration change, or when the Config cache would have expired
+        (to pick up changes made by other processes).
+        """
+        routing_table = self._routing_table
+        now = time.time()
+        if routing_table is None or routing_table['version'] != Config.VERSION or routing_table['expire_at'] < now:
+            routing_table = {'version': Config.VERSION,
+                             'expire_at': now + Config.CACHE_EXPIRY_DURATION,
+                             'settings': self._compile_cloud_settings(),
+                             'routes': {}}
+            self._routing_table = routing_table
+        return routing_table
+
+    def _get_route(self, metric_source, metric_type):
+        # type: (str, str) -> Dict[str, Any]
+        routing_table = self._get_routing_table()
+        route = routing_table['routes'].get((metric_source, metric_type))
+        if route is None:
+            route = self._compile_route(metric_source, metric_type, routing_table['settings'])
+            routing_table['routes'][(metric_source, metric_type)] = route
+        return route
+
+    def _compile_cloud_settings(self):
+        # type: () -> Dict[str, Any]
+        endpoint = Config.get_entry('cloud_endpoint', None)  # type: Optional[str]
+        metrics_endpoint = None  # type: Optional[str]
+        if endpoint is not None:
+            metrics_endpoint = '{0}/{1}?uuid={2}'.format(
+                endpoint if endpoint.startswith('http') else 'https://{0}'.format(endpoint),
+                Config.get_entry('cloud_endpoint_metrics', ''),
+                self._gateway_uuid
+            )
+        return {'enabled': Config.get_entry('cloud_enabled', False) is not False,
+                'metric_types': Config.get_entry('cloud_metrics_types', []),
+                'metric_sources': Config.get_entry('cloud_metrics_sources', []),
+                'batch_size': Config.get_entry('cloud_metrics_batch_size', 0),
+                'min_interval': Config.get_entry('cloud_metrics_min_interval', None),
+                'compression': Config.get_entry('cloud_metrics_compression', False),
+                'endpoint': metrics_endpoint}
+
+    def _compile_route(self, metric_source, metric_type, settings):
+        # type: (str, str, Dict[str, Any]) -> Dict[str, Any]
+        route = {'rate_key': '{0}.{1}'.format(metric_source.lower(), metric_type.lower()),
+                 'persist': self._persist_counters.get(metric_source, {}).get(metric_type, {}),
+                 'buffer': self._buffer_counters.get(metric_source, {}).get(metric_type, {}),
+                 'upload': False,
+                 'tags': [],
+                 'modulo_interval': None}  # type: Dict[str, Any]
 
         # get definition for metric source and type, getting the definitions for a metric_source is case sensitive!
         definition = self.definitions.get(metric_source, {}).get(metric_type)
         if definition is None:
-            return False
+            return route
+        route['tags'] = sorted(definition['tags'])
+        if metric_source == 'OpenMotics':
+            # round off timestamps for openmotics metrics
+            route['modulo_interval'] = Config.get_entry('cloud_metrics_interval|{0}'.format(metric_type), 900)
 
-        if Config.get_entry('cloud_enabled', False) is False:
-            return False
+        if not settings['enabled']:
+            return route
 
         if metric_source == 'OpenMotics':
             if Config.get_entry('cloud_metrics_enabled|{0}'.format(metric_type), True) is False:
-                return False
-
+                return route
             # filter openmotics metrics that are not listed in cloud_metrics_types
-            metric_types = Config.get_entry('cloud_metrics_types', [])
-            if metric_type not in metric_types:
-                return False
-
+            if metric_type not in settings['metric_types']:
+                return route
         else:
             # filter 3rd party (plugin) metrics that are not listed in cloud_metrics_sources
-            metric_sources = Config.get_entry('cloud_metrics_sources', [])
             # make sure to get the lowercase metric_source
-            if metric_source.lower() not in metric_sources:
-                return False
+            if metric_source.lower() not in settings['metric_sources']:
+                return route
 
-        return True
+        route['upload'] = True
+        return route
+
+    def _needs_upload_to_cloud(self, metric):
+        return self._get_route(metric['source'], metric['type'])['upload']
 
     def receiver(self, metric):
         # type: (Dict[str,Any]) -> None
@@ -301,36 +414,102 @@ class MetricsController(object):
         >                   "tags": {"device": "OpenMotics energy ID1",
         >                            "id": "E7.3"},
         >                   "values": {"power": 1234}}
+        The actual processing and uploading is done by the cloud uploader, so a slow cloud doesn't block the
+        distribution of the metrics.
         """
+        self.receive_batch([metric])
+
+    def receive_batch(self, metrics):
+        # type: (List[Dict[str,Any]]) -> None
+        """ Batch version of `receiver`, waking up the cloud uploader only once per batch """
+        queued = False
+        for metric in metrics:
+            if not self._needs_upload_to_cloud(metric):
+                continue
+            if len(self._cloud_upload_queue) == self._cloud_upload_queue.maxlen:
+                self.cloud_stats['upload_dropped'] += 1
+            self._cloud_upload_queue.append(metric)
+            queued = True
+        self.cloud_stats['upload_queue'] = len(self._cloud_upload_queue)
+        if queued and self._cloud_uploader is not None:
+            self._cloud_uploader.request_single_run()
+
+    def _upload_cloud_metrics(self):
+        # type: () -> None
+        while True:
+            try:
+                metric = self._cloud_upload_queue.popleft()
+            except IndexError:
+                break
+            self.cloud_stats['upload_queue'] = len(self._cloud_upload_queue)
+            self._process_cloud_metric(metric)
+
+    def _get_cloud_backoff(self):
+        # type: () -> int
+        """ Exponential backoff between retries, based on the amount of consecutive failed uploads """
+        if self._cloud_failures == 0:
+            return 0
+        return min(MetricsController.CLOUD_BACKOFF_MAX,
+                   MetricsController.CLOUD_BACKOFF_BASE * 2 ** min(self._cloud_failures - 1, 16))
+
+    def _post_cloud_metrics(self, endpoint, metrics):
+        # type: (str, List[List[Dict[str, Any]]]) -> None
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        data = urlencode({'metrics': json.dumps([[MetricRecord.as_dict(metric) for metric in entry] for entry in metrics])}).encode()
+        if self._get_routing_table()['settings']['compression']:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip container
+            data = compressor.compress(data) + compressor.flush()
+            headers['Content-Encoding'] = 'gzip'
+        start = time.time()
+        request = self._cloud_session.post(endpoint, data=data, headers=headers, timeout=30.0)
+        self.cloud_stats['upload_latency'] = time.time() - start
+        self.cloud_stats['bytes_sent'] += len(data)
+        return_data = json.loads(request.text)
+        if return_data.get('success', False) is False:
+            raise RuntimeError('{0}'.format(return_data.get('error')))
+
+    def _send_cloud_batches(self, endpoint):
+        # type: (str) -> None
+        """
+        Sends the outstanding metrics in batches. Every batch is cleared as soon as it's sent, so a failing
+        batch doesn't cause the previous ones to be sent again.
+        """
+        buffer_cleared = False
+        try:
+            for batch, buffer_id, queued in self._iter_cloud_batches():
+                self._post_cloud_metrics(endpoint, batch)
+                if buffer_id is not None:
+                    self._metrics_cache_controller.clear_buffer_until(buffer_id)
+                    buffer_cleared = True
+                self._cloud_queue = self._cloud_queue[queued:]
+        finally:
+            if buffer_cleared:
+                self._load_cloud_buffer()
+
+    def _process_cloud_metric(self, metric):
+        # type: (Dict[str,Any]) -> None
         metric_type = metric['type']
         metric_source = metric['source']
+        settings = self._get_routing_table()['settings']
+        route = self._get_route(metric_source, metric_type)
 
-        if not self._needs_upload_to_cloud(metric):
-            return
-
-        if metric_source == 'OpenMotics':
-            # round off timestamps for openmotics metrics
-            modulo_interval = Config.get_entry('cloud_metrics_interval|{0}'.format(metric_type), 900)
+        modulo_interval = route['modulo_interval']
+        if modulo_interval is not None:
             timestamp = int(metric['timestamp'] - metric['timestamp'] % modulo_interval)
         else:
             timestamp = int(metric['timestamp'])
 
-        cloud_batch_size = Config.get_entry('cloud_metrics_batch_size', 0)
-        cloud_min_interval = Config.get_entry('cloud_metrics_min_interval', None)  # type: Optional[int]
+        cloud_batch_size = settings['batch_size']
+        cloud_min_interval = settings['min_interval']  # type: Optional[int]
         if cloud_min_interval is not None:
             self._cloud_retry_interval = cloud_min_interval
-        endpoint = Config.get_entry('cloud_endpoint', None)  # type: Optional[str]
-        if endpoint is None:
+        metrics_endpoint = settings['endpoint']  # type: Optional[str]
+        if metrics_endpoint is None:
             return
-        metrics_endpoint = '{0}/{1}?uuid={2}'.format(
-            endpoint if endpoint.startswith('http') else 'https://{0}'.format(endpoint),
-            Config.get_entry('cloud_endpoint_metrics', ''),
-            self._gateway_uuid
-        )
 
-        counters_to_buffer = self._buffer_counters.get(metric_source, {}).get(metric_type, {})
-        definition = self.definitions.get(metric_source, {}).get(metric_type)
-        identifier = '|'.join(['{0}={1}'.format(tag, metric['tags'][tag]) for tag in sorted(definition['tags'])])
+        counters_to_buffer = route['buffer']
+        tags = metric['tags']
+        identifier = '|'.join(['{0}={1}'.format(tag, tags[tag]) for tag in route['tags']])
 
         # Check if the metric needs to be send
         entry = self._cloud_cache.setdefault(metric_source, {}).setdefault(metric_type, {}).setdefault(identifier, {})
@@ -352,7 +531,7 @@ class MetricsController(object):
         now = time.time()
         time_ago_send = int(now - self._cloud_last_send)
         time_ago_try = int(now - self._cloud_last_try)
-        outstanding_data_length = len(self._cloud_buffer) + len(self._cloud_queue)
+        outstanding_data_length = self._cloud_buffer_outstanding + len(self._cloud_queue)
 
         send = False
         if outstanding_data_length > 0:  # There must be outstanding data
@@ -363,7 +542,7 @@ class MetricsController(object):
                 send |= time_ago_send > cloud_min_interval and time_ago_send == time_ago_try
             if self._cloud_retry_interval is not None:
                 # Last send was unsuccessful, and it has been a while
-                send |= time_ago_send > time_ago_try > self._cloud_retry_interval
+                send |= time_ago_send > time_ago_try > max(self._cloud_retry_interval, self._get_cloud_backoff())
 
         self.cloud_stats['queue'] = len(self._cloud_queue)
         self.cloud_stats['buffer'] = self._cloud_buffer_length
@@ -373,23 +552,19 @@ class MetricsController(object):
         if send is True:
             self._cloud_last_try = now
             try:
-                # Try to send the metrics
-                request = requests.post(metrics_endpoint,
-                                        data={'metrics': json.dumps(self._cloud_buffer + self._cloud_queue)},
-                                        timeout=30.0)
-                return_data = json.loads(request.text)
-                if return_data.get('success', False) is False:
-                    raise RuntimeError('{0}'.format(return_data.get('error')))
+                # Try to send the metrics, streaming them in batches
+                self._send_cloud_batches(metrics_endpoint)
                 # If successful; clear buffers
                 if self._metrics_cache_controller.clear_buffer(metric['timestamp']) > 0:
                     self._load_cloud_buffer()
-                self._cloud_queue = []
                 self._cloud_last_send = now
+                self._cloud_failures = 0
                 self._cloud_retry_interval = cloud_min_interval
                 if self._throttled_down:
                     self._refresh_cloud_interval()
             except Exception as ex:
                 logger.error('Error sending metrics to Cloud: {0}'.format(ex))
+                self._cloud_failures += 1
                 if time_ago_send > 60 * 60:
                     # Decrease metrics rate, but at least every 2 hours
                     # Decrease cloud try interval, but at least every hour
@@ -403,7 +578,7 @@ class MetricsController(object):
                         self._cloud_retry_interval = 60 * 60
                         new_interval = 2 * 60 * 60
                     self._throttled_down = True
-                    metric_types = Config.get_entry('cloud_metrics_types', [])  # type: List[str]
+                    metric_types = settings['metric_types']  # type: List[str]
                     for mtype in metric_types:
                         self.set_cloud_interval(mtype, new_interval, save=False)
 
@@ -411,47 +586,53 @@ class MetricsController(object):
         time_ago_send = int(now - self._cloud_last_send)
         time_ago_try = int(now - self._cloud_last_try)
         if time_ago_send > time_ago_try and include_this_metric is True and len(counters_to_buffer) > 0:
+            values = metric['values']
             cache_data = {}
             for counter, match_setting in six.iteritems(counters_to_buffer):
                 if match_setting is not True:
-                    if metric['tags'][match_setting['key']] not in match_setting['matches']:
+                    if tags[match_setting['key']] not in match_setting['matches']:
                         continue
-                cache_data[counter] = metric['values'][counter]
-            if self._metrics_cache_controller.buffer_counter(metric_source, metric_type, metric['tags'], cache_data, metric['timestamp']):
+                cache_data[counter] = values[counter]
+            if self._metrics_cache_controller.buffer_counter(metric_source, metric_type, tags, cache_data, metric['timestamp']):
                 self._cloud_buffer_length += 1
             if self._metrics_cache_controller.clear_buffer(time.time() - 365 * 24 * 60 * 60) > 0:
                 self._load_cloud_buffer()
 
     def _put(self, metric):
-        rate_key = '{0}.{1}'.format(metric['source'].lower(), metric['type'].lower())
+        metric = MetricRecord.from_dict(metric)  # Queued metrics are kept in their compact form
+        route = self._get_route(metric.source, metric.type)
+        rate_key = route['rate_key']
         if rate_key not in self.inbound_rates:
             self.inbound_rates[rate_key] = 0
         self.inbound_rates[rate_key] += 1
         self.inbound_rates['total'] += 1
-        self._transform_counters(metric)  # Convert counters to "ever increasing counters"
+        if route['persist']:
+            self._transform_counters(metric, route['persist'])  # Convert counters to "ever increasing counters"
         # No need to make a deep copy; openmotics doesn't alter the object, and for the plugins the metric gets (de)serialized
         self.metrics_queue_plugins.appendleft(metric)
         self.metrics_queue_openmotics.appendleft(metric)
 
-    def _transform_counters(self, metric):
+    def _transform_counters(self, metric, counters_to_persist):
         # TODO: The 'persist' policy should be a part of the PulseCounterController
 
-        source = metric['source']
-        mtype = metric['type']
-        for counter, match_setting in six.iteritems(self._persist_counters.get(source, {}).get(mtype, {})):
-            if counter not in metric['values']:
+        source = metric.source
+        mtype = metric.type
+        tags = metric.tags
+        values = metric.values
+        for counter, match_setting in six.iteritems(counters_to_persist):
+            if counter not in values:
                 continue
             if match_setting is not True:
-                if metric['tags'][match_setting['key']] not in match_setting['matches']:
+                if tags[match_setting['key']] not in match_setting['matches']:
                     continue
-            counter_type = type(metric['values'][counter])
+            counter_type = type(values[counter])
             counter_value = self._metrics_cache_controller.process_counter(source=source,
                                                                            mtype=mtype,
-                                                                           tags=metric['tags'],
+                                                                           tags=tags,
                                                                            name=counter,
-                                                                           value=metric['values'][counter],
-                                                                           timestamp=metric['timestamp'])
-            metric['values'][counter] = counter_type(counter_value)
+                                                                           value=values[counter],
+                                                                           timestamp=metric.timestamp)
+            metric.set_value(counter, counter_type(counter_value))
 
     def _collect_plugins(self):
         """
@@ -546,21 +727,27 @@ class MetricsController(object):
 
     def _distribute_openmotics(self):
         # type: () -> None
+        metrics = []  # type: List[Dict[str, Any]]
         try:
-            metric = self.metrics_queue_openmotics.pop()
-            for receiver in self._openmotics_receivers:
-                try:
-                    receiver(metric)
-                except Exception as ex:
-                    logger.exception('error distributing metrics')
-                    raise MetricsDistributeFailed('Error distributing metrics to internal receivers: {0}'.format(ex))
-                rate_key = '{0}.{1}'.format(metric['source'].lower(), metric['type'].lower())
+            while len(metrics) < 250:
+                metrics.append(self.metrics_queue_openmotics.pop())
+        except IndexError:
+            pass
+        if not metrics:
+            raise DaemonThreadWait()
+        rate_keys = [self._get_route(metric['source'], metric['type'])['rate_key'] for metric in metrics]
+        for receiver in self._openmotics_receivers:
+            try:
+                receiver(metrics)
+            except Exception:
+                # A failing receiver shouldn't hold back the metrics for the other receivers
+                logger.exception('Error distributing metrics to internal receiver {0}'.format(receiver))
+                continue
+            for rate_key in rate_keys:
                 if rate_key not in self.outbound_rates:
                     self.outbound_rates[rate_key] = 0
                 self.outbound_rates[rate_key] += 1
-                self.outbound_rates['total'] += 1
-        except IndexError:
-            raise DaemonThreadWait()
+            self.outbound_rates['total'] += len(rate_keys)
 
     def event_receiver(self, event, payload):
         if event == OMBusEvents.METRICS_INTERVAL_CHANGE:
@@ -0,0 +1,109 @@
+# Copyright (C) 2020 OpenMotics BV
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Compact in-memory representation of a metric
+"""
+
+from __future__ import absolute_import
+
+import six
+
+if False:  # MYPY
+    from typing import Any, Dict, Tuple, Union
+
+_INTERNED = {}  # type: Dict[Any, Any]
+
+
+def _intern(value):
+    # The amount of sources, types and tag/value key sets is limited, so every record can share the same objects
+    return _INTERNED.setdefault(value, value)
+
+
+class MetricRecord(object):
+    """
+    A metric as it travels through the metrics queues. Source, type and the tag/value key tuples are
+    shared between records; only the timestamp and the tag/value tuples are stored per record. The
+    dict form is only built when crossing an API/plugin boundary (see `as_dict`).
+
+    For reading, a record can be used as the dict form of the metric (e.g. `metric['tags']['id']`).
+    """
+
+    __slots__ = ('source', 'type', 'timestamp', '_tag_keys', '_tag_values', '_value_keys', '_values')
+
+    def __init__(self, source, metric_type, timestamp, tags, values):
+        # type: (str, str, float, Dict[str, Any], Dict[str, Any]) -> None
+        self.source = _intern(source)
+        self.type = _intern(metric_type)
+        self.timestamp = timestamp
+        self._tag_keys = _intern(tuple(sorted(tags)))
+        self._tag_values = tuple(tags[key] for key in self._tag_keys)
+        self._value_keys = _intern(tuple(sorted(values)))
+        self._values = tuple(values[key] for key in self._value_keys)
+
+    @staticmethod
+    def from_dict(metric):
+        # type: (Union[MetricRecord, Dict[str, Any]]) -> MetricRecord
+        if isinstance(metric, MetricRecord):
+            return metric
+        return MetricRecord(metric['source'], metric['type'], metric['timestamp'], metric['tags'], metric['values'])
+
+    @staticmethod
+    def as_dict(metric):
+        # type: (Union[MetricRecord, Dict[str, Any]]) -> Dict[str, Any]
+        if isinstance(metric, MetricRecord):
+            return metric.to_dict()
+        return metric
+
+    @property
+    def tags(self):
+        # type: () -> Dict[str, Any]
+        return dict(six.moves.zip(self._tag_keys, self._tag_values))
+
+    @property
+    def values(self):
+        # type: () -> Dict[str, Any]
+        return dict(six.moves.zip(self._value_keys, self._values))
+
+    def set_value(self, key, value):
+        # type: (str, Any) -> None
+        index = self._value_keys.index(key)
+        self._values = self._values[:index] + (value,) + self._values[index + 1:]
+
+    def to_dict(self):
+        # type: () -> Dict[str, Any]
+        return {'source': self.source,
+                'type': self.type,
+                'timestamp': self.timestamp,
+                'tags': self.tags,
+                'values': self.values}
+
+    def __getitem__(self, key):
+        # type: (str) -> Any
+        if key in ('source', 'type', 'timestamp', 'tags', 'values'):
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __eq__(self, other):
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        if not isinstance(other, MetricRecord):
+            return False
+        return self.to_dict() == other.to_dict()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'MetricRecord({0})'.format(self.to_dict())
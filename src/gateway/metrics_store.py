@@ -0,0 +1,391 @@
+# Copyright (C) 2020 OpenMotics BV
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Local time-series store, keeping a (downsampled) history of all numeric metrics
+"""
+
+from __future__ import absolute_import
+
+import logging
+import mmap
+import os
+import re
+import time
+from threading import Lock
+
+import six
+import ujson as json
+
+from gateway.models import Config
+from ioc import INJECTED, Inject, Injectable, Singleton
+
+if False:  # MYPY
+    from typing import Any, Dict, IO, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger('openmotics')
+
+
+def _encode_varint(value, buffer):
+    # type: (int, bytearray) -> None
+    while value > 0x7F:
+        buffer.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def _decode_varint(data, offset):
+    # type: (Any, int) -> Tuple[int, int]
+    value = 0
+    shift = 0
+    while True:
+        byte = six.indexbytes(data, offset)
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def _encode_zigzag(value, buffer):
+    # type: (int, bytearray) -> None
+    _encode_varint((value << 1) if value >= 0 else ((-value << 1) - 1), buffer)
+
+
+def _decode_zigzag(data, offset):
+    # type: (Any, int) -> Tuple[int, int]
+    value, offset = _decode_varint(data, offset)
+    return (value >> 1) if not value & 1 else -((value + 1) >> 1), offset
+
+
+@Injectable.named('metrics_store')
+@Singleton
+class MetricsStore(object):
+    """
+    Stores all numeric metric values in append-only segment files, per metric source/type and resolution.
+
+    * Raw values are downsampled into 1 minute, 15 minutes and 1 hour buckets, holding the average,
+      minimum, maximum and amount of values of that bucket.
+    * Each record contains the series id, and the timestamp (in ms) and values (in 1/1000) as delta
+      against the previous record of the same series in that segment.
+    * Segments are rotated when they reach SEGMENT_SIZE, and the oldest segments are removed when a
+      resolution exceeds its size budget.
+
+    Buckets that are not complete yet are kept in memory, so they are lost on a restart.
+    """
+
+    RAW = 0
+    RESOLUTIONS = [RAW, 60, 15 * 60, 60 * 60]
+    MAX_SIZES = {RAW: 32 * 1024 * 1024,
+                 60: 16 * 1024 * 1024,
+                 15 * 60: 8 * 1024 * 1024,
+                 60 * 60: 8 * 1024 * 1024}
+    SEGMENT_SIZE = 256 * 1024
+    AGGREGATIONS = ['avg', 'min', 'max', 'sum', 'count']
+
+    @Inject
+    def __init__(self, metrics_store_dir=INJECTED):
+        # type: (str) -> None
+        self._directory = metrics_store_dir
+        self._lock = Lock()
+        self._series = {}  # type: Dict[str, Dict[Tuple[Any, ...], int]]
+        self._series_info = {}  # type: Dict[str, List[Dict[str, Any]]]
+        self._segments = {}  # type: Dict[Tuple[str, int], Dict[str, Any]]
+        self._buckets = {}  # type: Dict[Tuple[str, int, int], List[Any]]
+        for resolution in MetricsStore.RESOLUTIONS:
+            path = os.path.join(self._directory, str(resolution))
+            if not os.path.exists(path):
+                os.makedirs(path)
+
+    @staticmethod
+    def _get_key(source, metric_type):
+        # type: (str, str) -> str
+        """ Builds the (filename safe) key of a metric source/type. The `+` separator can't occur in the sanitized names """
+        return '+'.join(re.sub(r'[^a-zA-Z0-9_-]', '_', name) for name in (source, metric_type))
+
+    def receive_batch(self, metrics):
+        # type: (List[Any]) -> None
+        """ Internal metrics receiver, storing all numeric values """
+        if not Config.get_entry('metrics_store_enabled', True):
+            return
+        with self._lock:
+            try:
+                for metric in metrics:
+                    self._store(metric)
+            finally:
+                for segment_key, segment in list(self._segments.items()):
+                    try:
+                        segment['file'].flush()
+                    except (IOError, OSError) as ex:
+                        logger.error('Could not write metrics segment %s: %s', segment['file'].name, ex)
+                        self._drop_segment(segment_key)
+
+    def close(self):
+        # type: () -> None
+        with self._lock:
+            for segment in self._segments.values():
+                segment['file'].close()
+            self._segments = {}
+
+    def _store(self, metric):
+        # type: (Any) -> None
+        key = MetricsStore._get_key(metric['source'], metric['type'])
+        timestamp = int(metric['timestamp'] * 1000)
+        tags = metric['tags']
+        tag_items = tuple(sorted(tags.items()))
+        for field, value in six.iteritems(metric['values']):
+            if isinstance(value, bool):
+                value = int(value)
+            elif not isinstance(value, (float, six.integer_types)):
+                continue
+            series_id = self._get_series_id(key, metric['source'], tags, tag_items, field)
+            value = int(round(value * 1000))
+            self._write(key, MetricsStore.RAW, series_id, timestamp, [value])
+            for resolution in MetricsStore.RESOLUTIONS[1:]:
+                self._downsample(key, resolution, series_id, timestamp, value)
+
+    def _downsample(self, key, resolution, series_id, timestamp, value):
+        # type: (str, int, int, int, int) -> None
+        bucket_start = timestamp - timestamp % (resolution * 1000)
+        bucket = self._buckets.get((key, resolution, series_id))
+        if bucket is not None and bucket[0] != bucket_start:
+            start, count, total, minimum, maximum = bucket
+            self._write(key, resolution, series_id, start, [total // count, minimum, maximum], count=count)
+            bucket = None
+        if bucket is None:
+            self._buckets[(key, resolution, series_id)] = [bucket_start, 1, value, value, value]
+        else:
+            bucket[1] += 1
+            bucket[2] += value
+            bucket[3] = min(bucket[3], value)
+            bucket[4] = max(bucket[4], value)
+
+    def _get_series_id(self, key, source, tags, tag_items, field):
+        # type: (str, str, Dict[str, Any], Tuple[Any, ...], str) -> int
+        series = self._series.get(key)
+        if series is None:
+            series = self._load_series(key)
+        series_id = series.get((tag_items, field))
+        if series_id is None:
+            series_id = len(series)
+            series[(tag_items, field)] = series_id
+            info = {'source': source, 'tags': tags, 'field': field}
+            self._series_info[key].append(info)
+            with open(os.path.join(self._directory, '{0}.series'.format(key)), 'a') as series_file:
+                series_file.write('{0}\n'.format(json.dumps(info)))
+        return series_id
+
+    def _load_series(self, key):
+        # type: (str) -> Dict[Tuple[Any, ...], int]
+        series = {}  # type: Dict[Tuple[Any, ...], int]
+        series_info = []  # type: List[Dict[str, Any]]
+        filename = os.path.join(self._directory, '{0}.series'.format(key))
+        if os.path.exists(filename):
+            with open(filename, 'r') as series_file:
+                for line in series_file:
+                    if not line.strip():
+                        continue
+                    info = json.loads(line)
+                    series[(tuple(sorted(info['tags'].items())), info['field'])] = len(series_info)
+                    series_info.append(info)
+        self._series[key] = series
+        self._series_info[key] = series_info
+        return series
+
+    def _write(self, key, resolution, series_id, timestamp, values, count=None):
+        # type: (str, int, int, int, List[int], Optional[int]) -> None
+        segment = self._segments.get((key, resolution))
+        if segment is None or segment['size'] >= MetricsStore.SEGMENT_SIZE:
+            segment = self._open_segment(key, resolution, timestamp)
+        last_timestamp, last_values = segment['last'].get(series_id, (segment['start'], [0] * len(values)))
+        buffer = bytearray()
+        _encode_varint(series_id, buffer)
+        _encode_zigzag(timestamp - last_timestamp, buffer)
+        for value, last_value in zip(values, last_values):
+            _encode_zigzag(value - last_value, buffer)
+        if count is not None:
+            _encode_varint(count, buffer)
+        try:
+            segment['file'].write(bytes(buffer))
+        except (IOError, OSError):
+            self._drop_segment((key, resolution))
+            raise
+        segment['size'] += len(buffer)
+        segment['last'][series_id] = (timestamp, values)
+
+    def _open_segment(self, key, resolution, timestamp):
+        # type: (str, int, int) -> Dict[str, Any]
+        """ Starts a new segment. The delta state isn't persisted, so every process run starts a new segment as well. """
+        segment = self._segments.pop((key, resolution), None)
+        if segment is not None:
+            segment['file'].close()
+            self._enforce_retention(resolution)
+        path = os.path.join(self._directory, str(resolution))
+        start = timestamp
+        while os.path.exists(os.path.join(path, '{0}.{1}.seg'.format(key, start))):
+            start += 1
+        segment = {'file': open(os.path.join(path, '{0}.{1}.seg'.format(key, start)), 'ab'),
+                   'start': start,
+                   'size': 0,
+                   'last': {}}
+        self._segments[(key, resolution)] = segment
+        return segment
+
+    def _drop_segment(self, segment_key):
+        # type: (Tuple[str, int]) -> None
+        """ Stops writing to a segment after a failed write, as it might end with a partial record """
+        segment = self._segments.pop(segment_key)
+        try:
+            segment['file'].close()
+        except (IOError, OSError):
+            pass
+
+    def _list_segments(self, resolution, key=None):
+        # type: (int, Optional[str]) -> List[Tuple[int, str]]
+        """ Lists the segments of a resolution (optionally for a given key) as (start, filename), oldest first """
+        path = os.path.join(self._directory, str(resolution))
+        segments = []
+        for filename in os.listdir(path):
+            segment_key, _, remainder = filename.partition('.')
+            if key is not None and segment_key != key:
+                continue
+            start, _, extension = remainder.partition('.')
+            if extension != 'seg' or not start.isdigit():
+                continue
+            segments.append((int(start), os.path.join(path, filename)))
+        return sorted(segments)
+
+    def _enforce_retention(self, resolution):
+        # type: (int) -> None
+        active = set(segment['file'].name for (_, segment_resolution), segment in six.iteritems(self._segments)
+                     if segment_resolution == resolution)
+        segments = [(start, filename, os.path.getsize(filename))
+                    for start, filename in self._list_segments(resolution)]
+        total_size = sum(size for _, _, size in segments)
+        for _, filename, size in segments:
+            if total_size <= MetricsStore.MAX_SIZES[resolution]:
+                break
+            if filename in active:
+                continue
+            os.remove(filename)
+            total_size -= size
+
+    def _read_segment(self, filename, resolution):
+        # type: (str, int) -> Iterator[Tuple[int, int, int, int, int, int]]
+        """ Yields (series_id, timestamp, avg, min, max, count) for all records in a segment """
+        start = int(os.path.basename(filename).split('.')[1])
+        amount_of_values = 1 if resolution == MetricsStore.RAW else 3
+        with open(filename, 'rb') as segment_file:
+            try:
+                data = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                return  # Empty file
+            try:
+                last = {}  # type: Dict[int, Tuple[int, List[int]]]
+                offset = 0
+                length = len(data)
+                while offset < length:
+                    try:
+                        series_id, offset = _decode_varint(data, offset)
+                        last_timestamp, last_values = last.get(series_id, (start, [0] * amount_of_values))
+                        delta, offset = _decode_zigzag(data, offset)
+                        timestamp = last_timestamp + delta
+                        values = []
+                        for last_value in last_values:
+                            delta, offset = _decode_zigzag(data, offset)
+                            values.append(last_value + delta)
+                        count = 1
+                        if resolution != MetricsStore.RAW:
+                            count, offset = _decode_varint(data, offset)
+                    except IndexError:
+                        # The last record is incomplete. Either it was only partially written (e.g. on a power loss)
+                        # or it's still being written to the active segment. All complete records are returned.
+                        logger.debug('Skipping partial record at the end of segment %s', filename)
+                        return
+                    last[series_id] = (timestamp, values)
+                    if resolution == MetricsStore.RAW:
+                        yield series_id, timestamp, values[0], values[0], values[0], count
+                    else:
+                        yield series_id, timestamp, values[0], values[1], values[2], count
+            finally:
+                data.close()
+
+    def query(self, source, metric_type, field, start, end, interval=None, aggregation='avg', tags=None):
+        # type: (str, str, str, float, float, Optional[int], str, Optional[Dict[str, Any]]) -> Dict[str, Any]
+        """
+        Returns the values of a field for all matching series between start and end (in seconds). The values
+        are aggregated in buckets of `interval` seconds, using the coarsest resolution that still fits
+        """
+        if aggregation not in MetricsStore.AGGREGATIONS:
+            raise ValueError('Unknown aggregation {0}'.format(aggregation))
+        if interval is not None and interval <= 0:
+            raise ValueError('Interval should be positive, got {0}'.format(interval))
+        if start >= end:
+            raise ValueError('Start ({0}) should be before end ({1})'.format(start, end))
+        resolution = MetricsStore.RAW
+        if interval:
+            resolution = max(r for r in MetricsStore.RESOLUTIONS if r <= interval)
+        key = MetricsStore._get_key(source, metric_type)
+        start_ms, end_ms = int(start * 1000), int(end * 1000)
+        bucket_size = int(interval * 1000) if interval else None
+        with self._lock:
+            for segment in self._segments.values():
+                segment['file'].flush()
+            if key not in self._series:
+                self._load_series(key)
+            series_info = self._series_info[key]
+            series_ids = set(series_id for series_id, info in enumerate(series_info)
+                             if info['field'] == field and
+                             all(info['tags'].get(tag) == value for tag, value in six.iteritems(tags or {})))
+            segments = self._list_segments(resolution, key=key)
+        buckets = {}  # type: Dict[int, Dict[int, List[int]]]
+        for index, (segment_start, filename) in enumerate(segments):
+            if segment_start > end_ms:
+                break
+            if index + 1 < len(segments) and segments[index + 1][0] <= start_ms:
+                continue  # The next segment starts before the requested range
+            try:
+                records = list(self._read_segment(filename, resolution))
+            except (IOError, OSError):
+                continue  # Removed by the retention in the meantime
+            for series_id, timestamp, average, minimum, maximum, count in records:
+                if series_id not in series_ids or not start_ms <= timestamp < end_ms:
+                    continue
+                bucket_start = timestamp - timestamp % bucket_size if bucket_size else timestamp
+                bucket = buckets.setdefault(series_id, {}).get(bucket_start)
+                if bucket is None:
+                    buckets[series_id][bucket_start] = [average * count, minimum, maximum, count]
+                else:
+                    bucket[0] += average * count
+                    bucket[1] = min(bucket[1], minimum)
+                    bucket[2] = max(bucket[2], maximum)
+                    bucket[3] += count
+        series = []
+        for series_id in sorted(buckets):
+            values = []
+            for bucket_start, (total, minimum, maximum, count) in sorted(buckets[series_id].items()):
+                value = {'avg': float(total) / count,
+                         'min': minimum,
+                         'max': maximum,
+                         'sum': total,
+                         'count': count * 1000}[aggregation]
+                values.append([bucket_start / 1000.0, value / 1000.0])
+            info = series_info[series_id]
+            series.append({'source': info['source'],
+                           'tags': info['tags'],
+                           'values': values})
+        return {'type': metric_type,
+                'field': field,
+                'resolution': resolution,
+                'series': series}
@@ -196,6 +196,7 @@ class Config(BaseModel):
 
     CACHE_EXPIRY_DURATION = 60
     CACHE = {}
+    VERSION = 0  # Incremented on every change, so derived caches know when to rebuild
 
     @staticmethod
     def get_entry(key, fallback):
@@ -230,6 +231,7 @@ class Config(BaseModel):
             config_orm = Config(setting=key, data=data)
             config_orm.save()
         Config.CACHE[key] = (value, time.time() + Config.CACHE_EXPIRY_DURATION)
+        Config.VERSION += 1
 
     @staticmethod
     def remove_entry(key):
@@ -239,6 +241,7 @@ class Config(BaseModel):
             Config.setting == key.lower()
         ).execute()
         Config.CACHE.pop(key, None)
+        Config.VERSION += 1
 
 
 class Plugin(BaseModel):
@@ -54,9 +54,11 @@ from gateway.enums import ShutterEnums, UserEnums
 from gateway.exceptions import UnsupportedException
 from gateway.hal.master_controller import CommunicationFailure
 from gateway.maintenance_communicator import InMaintenanceModeException
+from gateway.metrics_record import MetricRecord
+from gateway.metrics_store import MetricsStore
 from gateway.models import Database, Feature, Config
 from gateway.websockets import EventsSocket, MaintenanceSocket, \
-    MetricsSocket, OMPlugin, OMSocketTool
+    MetricsSocket, OMPlugin, OMSocket, OMSocketTool
 from ioc import INJECTED, Inject, Injectable, Singleton
 from platform_utils import Hardware, Platform, System
 from power.power_communicator import InAddressModeException
@@ -210,7 +212,9 @@ def authentication_handler(pass_token=False):
                 except Exception:
                     pass
         _self = request.handler.callable.__self__
-        if request.remote.ip != '127.0.0.1':
+        # Calls over the api socket are only accepted from processes running as the same user
+        local_socket = getattr(request, 'wsgi_environ', {}).get('X_REMOTE_UID') == str(os.getuid())
+        if request.remote.ip != '127.0.0.1' and not local_socket:
             check_token = _self._user_controller.check_token if hasattr(_self, '_user_controller') else _self.webinterface.check_token
             if not check_token(token):
                 raise RuntimeError()
@@ -304,6 +308,8 @@ def types(**kwargs):
 class WebInterface(object):
     """ This class defines the web interface served by cherrypy. """
 
+    WEBSOCKET_TOKEN_CHECK_INTERVAL = 30
+
     @Inject
     def __init__(self, user_controller=INJECTED, gateway_api=INJECTED, maintenance_controller=INJECTED,
                  message_client=INJECTED, scheduling_controller=INJECTED,
@@ -334,6 +340,7 @@ class WebInterface(object):
         self._plugin_controller = None  # type: Optional[PluginController]
         self._metrics_collector = None  # type: Optional[MetricsCollector]
         self._metrics_controller = None  # type: Optional[MetricsController]
+        self._metrics_store = None  # type: Optional[MetricsStore]
 
         self._ws_metrics_registered = False
         self._power_dirty = False
@@ -349,28 +356,55 @@ class WebInterface(object):
     def set_service_state(self, state):
         self._service_state = state
 
-    def distribute_metric(self, metric):
+    def _check_receiver_token(self, receiver_info, local):
+        # type: (Dict[str, Any], bool) -> None
+        """ Validates the token of a websocket receiver, caching a positive result for a short while """
+        if local:
+            return
+        now = time.time()
+        if receiver_info.get('token_checked_until', 0) > now:
+            return
+        if not self._user_controller.check_token(receiver_info['token']):
+            raise cherrypy.HTTPError(401, 'invalid_token')
+        receiver_info['token_checked_until'] = now + WebInterface.WEBSOCKET_TOKEN_CHECK_INTERVAL
+
+    def distribute_metrics(self, metrics):
+        """ Sends a batch of metrics to all connected metrics websockets """
         try:
             answers = cherrypy.engine.publish('get-metrics-receivers')
             if not answers:
                 return
             receivers = answers.pop()
-            for client_id in receivers.keys():
+            local = cherrypy.request.remote.ip == '127.0.0.1'
+            # Group the receivers by their filter, so the filtering is done once per unique filter
+            receiver_groups = {}  # type: Dict[Any, List[Any]]
+            for client_id in list(receivers.keys()):
                 receiver_info = receivers.get(client_id)
                 if receiver_info is None:
                     continue
-                try:
-                    if cherrypy.request.remote.ip != '127.0.0.1' and not self._user_controller.check_token(receiver_info['token']):
-                        raise cherrypy.HTTPError(401, 'invalid_token')
-                    sources = self._metrics_controller.get_filter('source', receiver_info['source'])
-                    metric_types = self._metrics_controller.get_filter('metric_type', receiver_info['metric_type'])
+                receiver_groups.setdefault((receiver_info['source'], receiver_info['metric_type']), []).append((client_id, receiver_info))
+            serialized_metrics = {}  # type: Dict[int, bytes]
+            for (source_filter, metric_type_filter), group in six.iteritems(receiver_groups):
+                sources = self._metrics_controller.get_filter('source', source_filter)
+                metric_types = self._metrics_controller.get_filter('metric_type', metric_type_filter)
+                data = []
+                for index, metric in enumerate(metrics):
                     if metric['source'] in sources and metric['type'] in metric_types:
-                        receiver_info['socket'].send(msgpack.dumps(metric), binary=True)
-                except cherrypy.HTTPError as ex:  # As might be caught from the `check_token` function
-                    receiver_info['socket'].close(ex.code, ex.message)
-                except Exception as ex:
-                    logger.error('Failed to distribute metrics to WebSocket: %s', ex)
-                    cherrypy.engine.publish('remove-metrics-receiver', client_id)
+                        if index not in serialized_metrics:
+                            serialized_metrics[index] = msgpack.dumps(MetricRecord.as_dict(metric))
+                        data.append(serialized_metrics[index])
+                if not data:
+                    continue
+                for client_id, receiver_info in group:
+                    try:
+                        self._check_receiver_token(receiver_info, local)
+                        for entry in data:
+                            receiver_info['socket'].enqueue(entry)
+                    except cherrypy.HTTPError as ex:  # As might be caught from the `check_token` function
+                        receiver_info['socket'].close(ex.code, ex.args[1])
+                    except Exception as ex:
+                        logger.error('Failed to distribute metrics to WebSocket: %s', ex)
+                        cherrypy.engine.publish('remove-metrics-receiver', client_id)
         except Exception as ex:
             logger.error('Failed to distribute metrics to WebSockets: %s', ex)
 
@@ -380,18 +414,22 @@ class WebInterface(object):
             if not answers:
                 return
             receivers = answers.pop()
-            for client_id in receivers.keys():
+            local = cherrypy.request.remote.ip == '127.0.0.1'
+            data = None
+            coalesce_key = EventsSocket.get_coalesce_key(event)
+            for client_id in list(receivers.keys()):
                 receiver_info = receivers.get(client_id)
                 if receiver_info is None:
                     continue
                 try:
                     if event.type not in receiver_info['subscribed_types']:
                         continue
-                    if cherrypy.request.remote.ip != '127.0.0.1' and not self._user_controller.check_token(receiver_info['token']):
-                        raise cherrypy.HTTPError(401, 'invalid_token')
-                    receiver_info['socket'].send(msgpack.dumps(event.serialize()), binary=True)
+                    self._check_receiver_token(receiver_info, local)
+                    if data is None:
+                        data = msgpack.dumps(event.serialize())
+                    receiver_info['socket'].enqueue(data, key=coalesce_key)
                 except cherrypy.HTTPError as ex:  # As might be caught from the `check_token` function
-                    receiver_info['socket'].close(ex.code, ex.message)
+                    receiver_info['socket'].close(ex.code, ex.args[1])
                 except Exception as ex:
                     logger.error('Failed to distribute events to WebSocket: %s', ex)
                     cherrypy.engine.publish('remove-events-receiver', client_id)
@@ -414,6 +452,10 @@ class WebInterface(object):
         """ Sets the metrics controller """
         self._metrics_controller = metrics_controller
 
+    def set_metrics_store(self, metrics_store):
+        """ Sets the metrics store """
+        self._metrics_store = metrics_store
+
     @cherrypy.expose
     def index(self):
         """
@@ -2286,6 +2328,47 @@ class WebInterface(object):
         """
         return {'logs': self._plugin_controller.get_logs()}
 
+    @openmotics_api(auth=True, plugin_exposed=False)
+    def get_plugin_metric_statistics(self):
+        """
+        Get the amount of metrics that were delivered to (or dropped for) each plugin metric receiver.
+
+        :returns: 'statistics': dict with the plugin names as keys and a dict per metric receiver as value, \
+            containing the 'delivered' and 'dropped' amounts.
+        :rtype: dict
+        """
+        return {'statistics': self._plugin_controller.get_metric_receiver_statistics()}
+
+    @openmotics_api(auth=True, check=types(calls='json'), plugin_exposed=False)
+    def batch_calls(self, calls):
+        """
+        Executes a list of plugin exposed API calls in a single request. The parameters of a call can be
+        passed as they would be in the query string, or as their (json) values.
+
+        :param calls: list of dicts with the 'name' of the call and its 'params' (a dict).
+        :type calls: list
+        :returns: 'responses': list with the response of each call, in the same order.
+        :rtype: dict
+        """
+        responses = []
+        for call in calls:
+            method = getattr(self, call.get('name', ''), None)
+            if method is None or not getattr(method, 'plugin_exposed', False):
+                responses.append({'success': False, 'msg': 'invalid_call'})
+                continue
+            param_types = method.check or {}
+            params = dict(call.get('params') or {})
+            for key, value in params.items():
+                if param_types.get(key) == 'json' and not isinstance(value, six.string_types):
+                    params[key] = json.dumps(value)
+            try:
+                params_parser(params, param_types)
+            except ValueError:
+                responses.append({'success': False, 'msg': 'invalid_parameters'})
+                continue
+            responses.append(json.loads(method(**params)))
+        return {'responses': responses}
+
     @openmotics_api(auth=True, plugin_exposed=False)
     def install_plugin(self, md5, package_data):
         """
@@ -2366,6 +2449,24 @@ class WebInterface(object):
                         definitions[_source][_metric_type] = definition
         return {'definitions': definitions}
 
+    @openmotics_api(auth=True, check=types(start=float, end=float, interval=int, aggregation=MetricsStore.AGGREGATIONS, tags='json'))
+    def get_metrics_history(self, metric_type, field, start, end=None, interval=None, aggregation='avg', source='OpenMotics', tags=None):
+        """
+        Returns the stored history of a metric field, aggregated per `interval` seconds.
+        :param metric_type: The metric type (e.g. energy)
+        :param field: The metric field (e.g. power)
+        :param start: Start timestamp
+        :param end: End timestamp, defaults to now
+        :param interval: Positive aggregation interval in seconds. If not given, the raw values are returned.
+        :param aggregation: One of avg, min, max, sum or count
+        :param source: The metric source
+        :param tags: Optional tags to filter the series on, e.g. {"id": 1}
+        """
+        if end is None:
+            end = time.time()
+        return {'history': self._metrics_store.query(source, metric_type, field, start, end,
+                                                     interval=interval, aggregation=aggregation, tags=tags)}
+
     @openmotics_api(check=types(confirm=bool), auth=True, plugin_exposed=False)
     def factory_reset(self, username, password, confirm=False):
         user_dto = UserDTO(username=username)
@@ -2393,6 +2494,19 @@ class WebInterface(object):
         return {'health': health,
                 'health_version': 1.0}
 
+    @openmotics_api(auth=True)
+    def get_websocket_statistics(self):
+        """ Returns the outgoing queue statistics of the connected metrics and events websockets """
+        clients = {}
+        for receiver_type in ['metrics', 'events']:
+            answers = cherrypy.engine.publish('get-{0}-receivers'.format(receiver_type))
+            if not answers:
+                continue
+            for client_id, receiver_info in list(answers.pop().items()):
+                clients[client_id] = dict(receiver_info['socket'].send_statistics, type=receiver_type)
+        return {'totals': OMSocket.get_statistics(),
+                'clients': clients}
+
     @openmotics_api(auth=True)
     def indicate(self):
         """ Blinks the Status led on the Gateway to indicate the module """
@@ -2445,6 +2559,7 @@ class WebService(object):
         self._https_port = https_port
         self._http_server = None  # type: Optional[cherrypy._cpserver.Server]
         self._https_server = None  # type: Optional[cherrypy._cpserver.Server]
+        self._socket_server = None  # type: Optional[cherrypy._cpserver.Server]
         if not verbose:
             logging.getLogger("cherrypy").propagate = False
 
@@ -2508,16 +2623,40 @@ class WebService(object):
             self._http_server.socket_timeout = 60
             self._http_server.subscribe()
 
+            self._socket_server = WebService._build_socket_server(constants.get_api_socket_file())
+
             cherrypy.engine.autoreload_on = False
 
             cherrypy.engine.start()
             self._https_server.httpserver.error_log = WebService._http_server_logger
             self._http_server.httpserver.error_log = WebService._http_server_logger
+            if self._socket_server is not None:
+                self._socket_server.httpserver.error_log = WebService._http_server_logger
             logger.info('Starting webserver... Done')
         except Exception:
             logger.exception("Could not start webservice. Dying...")
             sys.exit(1)
 
+    @staticmethod
+    def _build_socket_server(socket_file):
+        # type: (str) -> Optional[cherrypy._cpserver.Server]
+        """
+        Builds the server for local (e.g. plugin) api calls, without the TCP overhead. Those calls are
+        authorized by the uid of the calling process, so the socket is only served if CherryPy supports
+        peer credentials. Otherwise the local processes keep using the http server.
+        """
+        if os.path.exists(socket_file):
+            os.remove(socket_file)  # Left behind by a previous run
+        if not hasattr(cherrypy._cpserver.Server, 'peercreds'):
+            logger.info('Peer credentials not supported, not serving the api socket')
+            return None
+        server = cherrypy._cpserver.Server()
+        server.socket_file = socket_file
+        server.socket_timeout = 60
+        server.peercreds = True
+        server.subscribe()
+        return server
+
     def stop(self):
         # type: () -> None
         """ Stop the web service. """
@@ -2534,6 +2673,11 @@ class WebService(object):
             self._https_server.stop()
         except Exception as ex:
             logger.error('Could not stop secure webserver: {0}'.format(ex))
+        if self._socket_server is not None:
+            try:
+                self._socket_server.stop()
+            except Exception as ex:
+                logger.error('Could not stop socket webserver: {0}'.format(ex))
         try:
             for mount in mounts:
                 cherrypy.tree.mount(**mount)
@@ -2549,3 +2693,9 @@ class WebService(object):
             self._https_server.httpserver.error_log = WebService._http_server_logger
         except Exception as ex:
             logger.error('Could not restart secure webserver: {0}'.format(ex))
+        if self._socket_server is not None:
+            try:
+                self._socket_server.start()
+                self._socket_server.httpserver.error_log = WebService._http_server_logger
+            except Exception as ex:
+                logger.error('Could not restart socket webserver: {0}'.format(ex))
@@ -19,14 +19,24 @@ from __future__ import absolute_import
 import msgpack
 import cherrypy
 import logging
+import threading
+from collections import OrderedDict
 from ws4py import WS_VERSION
 from ws4py.server.cherrypyserver import WebSocketPlugin, WebSocketTool
 from ws4py.websocket import WebSocket
+from gateway.daemon_thread import BaseThread
 from gateway.events import GatewayEvent
 
+if False:  # MYPY
+    from typing import Any, Dict, Hashable, Optional
+
 logger = logging.getLogger('openmotics')
 
 
+class SendQueueStopped(Exception):
+    pass
+
+
 class OMPlugin(WebSocketPlugin):
     def __init__(self, bus):
         WebSocketPlugin.__init__(self, bus)
@@ -111,6 +121,109 @@ class OMSocketTool(WebSocketTool):
 
 
 class OMSocket(WebSocket):
+    """
+    Outgoing data is queued in a bounded queue and sent by a writer thread per socket, so a slow client
+    can't block the threads distributing metrics and events. Queued data with the same key is coalesced,
+    and the client is disconnected when it can't keep up and the queue overflows.
+    """
+
+    SEND_QUEUE_SIZE = 1000
+    STATISTICS = {'queued': 0, 'sent': 0, 'coalesced': 0, 'dropped': 0, 'disconnected': 0}  # type: Dict[str, int]
+    STATISTICS_LOCK = threading.Lock()  # The totals are counted by the threads of all sockets
+
+    def __init__(self, *args, **kwargs):
+        super(OMSocket, self).__init__(*args, **kwargs)
+        self._send_queue = OrderedDict()  # type: OrderedDict
+        self._send_condition = threading.Condition()
+        self._send_sequence = 0
+        self._send_overflow = False
+        self._send_stopped = False
+        self._send_thread = None  # type: Optional[BaseThread]
+        self.send_statistics = {'queue': 0, 'queued': 0, 'sent': 0, 'coalesced': 0, 'dropped': 0}
+
+    def enqueue(self, data, key=None):
+        # type: (bytes, Optional[Hashable]) -> None
+        """ Queues binary data to be sent, replacing any unsent data with the same key """
+        with self._send_condition:
+            if self._send_stopped or self._send_overflow:
+                raise SendQueueStopped('Send queue is stopped')
+            if key is not None and key in self._send_queue:
+                self._send_queue[key] = data
+                OMSocket._count(self.send_statistics, 'coalesced')
+                return
+            if len(self._send_queue) >= self.SEND_QUEUE_SIZE:
+                OMSocket._count(self.send_statistics, 'dropped', len(self._send_queue) + 1)
+                self._send_queue.clear()
+                self._send_overflow = True
+                self._send_condition.notify()
+                raise SendQueueStopped('Send queue overflow')
+            if key is None:
+                self._send_sequence += 1
+                key = self._send_sequence
+            self._send_queue[key] = data
+            self.send_statistics['queue'] = len(self._send_queue)
+            OMSocket._count(self.send_statistics, 'queued')
+            if self._send_thread is None:
+                self._send_thread = BaseThread(name='wswriter', target=self._send_queued)
+                self._send_thread.daemon = True
+                self._send_thread.start()
+            self._send_condition.notify()
+
+    @staticmethod
+    def _count(statistics, key, amount=1):
+        # type: (Optional[Dict[str, int]], str, int) -> None
+        """ Counts in the statistics of a socket (if given, with its send condition held) and in the totals """
+        if statistics is not None:
+            statistics[key] += amount
+        with OMSocket.STATISTICS_LOCK:
+            OMSocket.STATISTICS[key] += amount
+
+    @staticmethod
+    def get_statistics():
+        # type: () -> Dict[str, int]
+        """ Returns a copy of the totals of all sockets """
+        with OMSocket.STATISTICS_LOCK:
+            return dict(OMSocket.STATISTICS)
+
+    def _send_queued(self):
+        # type: () -> None
+        while True:
+            with self._send_condition:
+                while not self._send_queue and not self._send_overflow and not self._send_stopped:
+                    self._send_condition.wait()
+                if self._send_stopped:
+                    return
+                if self._send_overflow:
+                    break
+                _, data = self._send_queue.popitem(last=False)
+                self.send_statistics['queue'] = len(self._send_queue)
+            try:
+                self.send(data, binary=True)
+                with self._send_condition:
+                    OMSocket._count(self.send_statistics, 'sent')
+            except Exception as ex:
+                logger.error('Failed to send data to WebSocket: %s', ex)
+                self._stop_sending()
+                return
+        logger.warning('WebSocket send queue overflow, disconnecting client')
+        OMSocket._count(None, 'disconnected')
+        self._stop_sending()
+        try:
+            self.close(1013, 'send queue overflow')
+        except Exception as ex:
+            logger.error('Failed to close WebSocket: %s', ex)
+
+    def _stop_sending(self):
+        # type: () -> None
+        with self._send_condition:
+            self._send_stopped = True
+            self._send_queue.clear()
+            self.send_statistics['queue'] = 0
+            self._send_condition.notify()
+
+    def closed(self, code, reason=None):
+        self._stop_sending()
+
     def once(self):
         """
         Almost exact the same code as in `WebSocket`, but somehow resolves an issue where not all
@@ -154,8 +267,8 @@ class MetricsSocket(OMSocket):
                                                                              self.metadata['metric_type'],
                                                                              self.metadata['interval'])
 
-    def closed(self, *args, **kwargs):
-        _ = args, kwargs
+    def closed(self, code, reason=None):
+        super(MetricsSocket, self).closed(code, reason)
         if not hasattr(self, 'metadata'):
             return
         client_id = self.metadata['client_id']
@@ -168,6 +281,21 @@ class EventsSocket(OMSocket):
     """
     Handles web socket communications for events
     """
+
+    # Only the most recent unsent state change of an object is relevant
+    COALESCED_TYPES = [GatewayEvent.Types.OUTPUT_CHANGE,
+                       GatewayEvent.Types.SHUTTER_CHANGE,
+                       GatewayEvent.Types.THERMOSTAT_CHANGE,
+                       GatewayEvent.Types.THERMOSTAT_GROUP_CHANGE,
+                       GatewayEvent.Types.VENTILATION_CHANGE]
+
+    @staticmethod
+    def get_coalesce_key(event):
+        # type: (GatewayEvent) -> Optional[Any]
+        if event.type in EventsSocket.COALESCED_TYPES and isinstance(event.data, dict) and 'id' in event.data:
+            return event.type, event.data['id']
+        return None
+
     def opened(self):
         if not hasattr(self, 'metadata'):
             return
@@ -177,8 +305,8 @@ class EventsSocket(OMSocket):
                                  'subscribed_types': [],
                                  'socket': self})
 
-    def closed(self, *args, **kwargs):
-        _ = args, kwargs
+    def closed(self, code, reason=None):
+        super(EventsSocket, self).closed(code, reason)
         if not hasattr(self, 'metadata'):
             return
         client_id = self.metadata['client_id']
@@ -202,8 +330,8 @@ class EventsSocket(OMSocket):
                                             self.metadata['client_id'],
                                             {'subscribed_types': subscribed_types})
             elif event.type == GatewayEvent.Types.PING:
-                self.send(msgpack.dumps(GatewayEvent(event_type=GatewayEvent.Types.PONG,
-                                                     data=None).serialize()), binary=True)
+                self.enqueue(msgpack.dumps(GatewayEvent(event_type=GatewayEvent.Types.PONG,
+                                                        data=None).serialize()))
         except Exception as ex:
             logger.exception('Error receiving message: %s', ex)
             # Ignore malformed data processing; in that case there's nothing that will happen
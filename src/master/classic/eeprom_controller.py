@@ -20,6 +20,7 @@ from __future__ import absolute_import
 import copy
 import inspect
 import logging
+import random
 import types
 from threading import Lock
 
@@ -28,6 +29,7 @@ from gateway.hal.master_event import MasterEvent
 from gateway.pubsub import PubSub
 from master.classic.master_api import activate_eeprom, eeprom_list, \
     write_eeprom
+from master.memory_snapshot import MemorySnapshot
 
 if False:  # MYPY
     from typing import Any, Dict, List, Optional, Iterable, Type, TypeVar, Set, Union, Tuple, Callable
@@ -76,10 +78,14 @@ class EepromController(object):
         """
         Create a list of instances of an EepromModel by reading it from the EepromFile.
         """
+        ids = list(ids)
+        eext_fields = [field_name for field_name in eeprom_model.get_field_dict(include_eext=True)
+                       if fields is None or field_name in fields]
+        eext_data = self._eeprom_extension.read_many(eeprom_model.get_name(), ids, eext_fields) if eext_fields else {}
         return_data = []
         for id in ids:
             entry = eeprom_model(id)
-            entry.load_from_system(self._eeprom_file, self._eeprom_extension, fields)
+            entry.load_from_system(self._eeprom_file, self._eeprom_extension, fields, eext_data=eext_data)
             return_data.append(entry)
         return return_data
 
@@ -138,18 +144,90 @@ class EepromFile(object):
     """ Reads from and writes to the Master EEPROM. """
 
     BATCH_SIZE = 10
+    BANKS = 256
+    BANK_LENGTH = 256
+    SNAPSHOT_SAMPLES = 8
 
     @Inject
-    def __init__(self, master_communicator=INJECTED, pubsub=INJECTED):
-        # type: (MasterCommunicator, PubSub) -> None
+    def __init__(self, master_communicator=INJECTED, pubsub=INJECTED, eeprom_snapshot_file=INJECTED):
+        # type: (MasterCommunicator, PubSub, Optional[str]) -> None
         """ Create an EepromFile. """
         self._master_communicator = master_communicator
         self._pubsub = pubsub
         self._bank_cache = {}  # type: Dict[int, bytearray]
+        self._snapshot = None  # type: Optional[MemorySnapshot]
+        self._snapshot_verified = False
+        self._unverified_banks = set()  # type: Set[int]
+        if eeprom_snapshot_file is not None:
+            try:
+                self._snapshot = MemorySnapshot(eeprom_snapshot_file, EepromFile.BANKS, EepromFile.BANK_LENGTH)
+            except Exception:
+                logger.exception('EEPROM - Could not open snapshot {0}'.format(eeprom_snapshot_file))
 
     def invalidate_cache(self):
-        """ Invalidate the cache, this should happen when maintenance mode was used. """
+        """
+        Invalidate the cache, this should happen when maintenance mode was used.
+        The snapshot is kept, but it's verified again before it's used.
+        """
         self._bank_cache = {}
+        self._unverified_banks = set()
+        self._snapshot_verified = False
+
+    def _verify_snapshot(self):
+        # type: () -> None
+        """
+        Compares a few sampled banks of the snapshot with the master when the snapshot is first used (on startup
+        or after maintenance mode). If they all match, the snapshot is used to fill the cache. Otherwise the snapshot
+        is discarded, except for the banks that were just read. Since changes to the other banks can't be ruled out,
+        banks from the snapshot are read again before they are written.
+        """
+        if self._snapshot is None:
+            return
+        snapshot_banks = {}  # type: Dict[int, bytearray]
+        for bank in range(EepromFile.BANKS):
+            data = self._snapshot.load(bank)
+            if data is not None:
+                snapshot_banks[bank] = data
+        if not snapshot_banks:
+            self._snapshot_verified = True
+            return
+
+        # Bank 0 contains the module configuration, so it's always checked
+        samples = [bank for bank in snapshot_banks if bank != 0]
+        samples = random.sample(samples, min(EepromFile.SNAPSHOT_SAMPLES, len(samples)))
+        if 0 in snapshot_banks:
+            samples.append(0)
+        master_banks = {}  # type: Dict[int, bytearray]
+        for bank in samples:
+            master_banks[bank] = self._master_communicator.do_command(eeprom_list(), {'bank': bank})['data']
+
+        changed_banks = [bank for bank in samples if master_banks[bank] != snapshot_banks[bank]]
+        if changed_banks:
+            logger.info('EEPROM - Snapshot outdated (changed banks: {0}), discarding'.format(sorted(changed_banks)))
+            self._snapshot.invalidate()
+            self._bank_cache = {}
+            self._unverified_banks = set()
+        else:
+            logger.info('EEPROM - Snapshot verified, reusing {0} banks'.format(len(snapshot_banks)))
+            self._bank_cache = snapshot_banks
+            self._unverified_banks = set(snapshot_banks)
+        for bank, data in master_banks.items():
+            self._cache_bank(bank, data)
+        self._snapshot_verified = True
+
+    def _cache_bank(self, bank, data):
+        # type: (int, bytearray) -> None
+        self._bank_cache[bank] = data
+        self._unverified_banks.discard(bank)
+        if self._snapshot is not None:
+            self._snapshot.store(bank, data)
+
+    def _invalidate_bank(self, bank):
+        # type: (int) -> None
+        self._bank_cache.pop(bank, None)
+        self._unverified_banks.discard(bank)
+        if self._snapshot is not None:
+            self._snapshot.invalidate(bank)
 
     def activate(self):
         """
@@ -174,21 +252,18 @@ class EepromFile(object):
     def _read_banks(self, banks):
         # type: (Set[int]) -> Dict[int, bytearray]
         """ Read a number of banks from the Eeprom. """
-        try:
-            return_data = {}
-            for bank in banks:
-                if bank in self._bank_cache:
-                    data = self._bank_cache[bank]
-                else:
-                    output = self._master_communicator.do_command(eeprom_list(), {'bank': bank})
-                    data = output['data']
-                    self._bank_cache[bank] = data
-                return_data[bank] = data
-            return return_data
-        except Exception:
-            # Failure reading, cache might be invalid
-            self.invalidate_cache()
-            raise
+        if not self._snapshot_verified:
+            self._verify_snapshot()
+        return_data = {}
+        for bank in banks:
+            if bank in self._bank_cache:
+                data = self._bank_cache[bank]
+            else:
+                output = self._master_communicator.do_command(eeprom_list(), {'bank': bank})
+                data = output['data']
+                self._cache_bank(bank, data)
+            return_data[bank] = data
+        return return_data
 
     def write(self, data):
         # type: (List[EepromData]) -> bool
@@ -196,7 +271,12 @@ class EepromFile(object):
         wrote_data = False
 
         # Read the data in the banks that we are trying to write
-        bank_data = self._read_banks({d.address.bank for d in data})
+        banks = {d.address.bank for d in data}
+        bank_data = self._read_banks(banks)
+        # Only changed bytes are written, so the banks need to be up to date
+        for bank in sorted(self._unverified_banks.intersection(banks)):
+            bank_data[bank] = self._master_communicator.do_command(eeprom_list(), {'bank': bank})['data']
+            self._cache_bank(bank, bank_data[bank])
         new_bank_data = copy.deepcopy(bank_data)
 
         for data_item in data:
@@ -204,11 +284,11 @@ class EepromFile(object):
             new_bank_data[address.bank][address.offset:address.offset + address.length] = data_item.bytes
 
         # Check what changed and write changes in batch
-        try:
-            for bank in bank_data.keys():
-                old = bank_data[bank]
-                new = new_bank_data[bank]
+        for bank in bank_data.keys():
+            old = bank_data[bank]
+            new = new_bank_data[bank]
 
+            try:
                 i = 0
                 while i < len(bank_data[bank]):
                     if old[i] != new[i]:
@@ -224,13 +304,13 @@ class EepromFile(object):
                         i += EepromFile.BATCH_SIZE
                     else:
                         i += 1
+            except Exception:
+                # Failure writing, this bank might be partially written
+                self._invalidate_bank(bank)
+                raise
 
-                self._bank_cache[bank] = new
-            return wrote_data
-        except Exception:
-            # Failure reading, cache might be invalid
-            self.invalidate_cache()
-            raise
+            self._cache_bank(bank, new)
+        return wrote_data
 
     def _write(self, bank, offset, to_write):
         # type: (int, int, bytearray) -> None
@@ -310,8 +390,12 @@ class EepromModel(object):
             self._add_property(field_name)
             self._fields['eext'].append(field_name)
 
-    def load_from_system(self, eeprom_file, eeprom_extension, fields=None):
-        # type: (EepromFile, EepromExtension, List[str]) -> None
+    def load_from_system(self, eeprom_file, eeprom_extension, fields=None, eext_data=None):
+        # type: (EepromFile, EepromExtension, List[str], Optional[Dict[Tuple[Optional[int], str], Any]]) -> None
+        """
+        Loads the (given) fields. The eext data can be prefetched for multiple models with `EepromExtension.read_many`,
+        otherwise it's read for this model only.
+        """
         expected_fields = [] if fields is None else fields[:]
         self._loaded_fields = []
         addresses = []
@@ -336,12 +420,14 @@ class EepromModel(object):
             else:
                 field.load_bytes(data[field.address])
             self._loaded_fields.append(field_name)
-        for field_name in self._fields['eext']:
+        eext_fields = [field_name for field_name in self._fields['eext']
+                       if fields is None or field_name in expected_fields]
+        if eext_data is None:
+            eext_data = eeprom_extension.read_many(self.__class__.__name__, [self.id], eext_fields) if eext_fields else {}
+        for field_name in eext_fields:
             if fields is not None:
-                if field_name not in expected_fields:
-                    continue
                 expected_fields.remove(field_name)
-            data = eeprom_extension.read_data(self.__class__.__name__, self.id, field_name)
+            data = eext_data[(self.id, field_name)]
             if data is not None:
                 field = getattr(self, '_{0}'.format(field_name))
                 field.load_bytes(data)
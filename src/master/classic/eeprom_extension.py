@@ -23,6 +23,9 @@ import os.path
 from threading import Lock
 from ioc import Injectable, Inject, INJECTED, Singleton
 
+if False:  # MYPY
+    from typing import Any, Dict, Iterable, Optional, Set, Tuple
+
 
 @Injectable.named('eeprom_extension')
 @Singleton
@@ -33,6 +36,9 @@ class EepromExtension(object):
     @Inject
     def __init__(self, eeprom_db=INJECTED):
         self._lock = Lock()
+        # Write-through cache, keyed by (model, model_id, field). Models are loaded as a whole.
+        self._cache = {}  # type: Dict[Tuple[str, int, str], Any]
+        self._cached_models = set()  # type: Set[str]
         create_tables = not os.path.exists(eeprom_db)
         self._connection = sqlite3.connect(eeprom_db,
                                            detect_types=sqlite3.PARSE_DECLTYPES,
@@ -50,12 +56,31 @@ class EepromExtension(object):
                                  "UNIQUE(model, model_id, field) ON CONFLICT REPLACE);")
 
     def read_data(self, eeprom_model_name, model_id, field_name):
-        model_id = 0 if model_id is None else model_id
+        return self.read_many(eeprom_model_name, [model_id], [field_name])[(model_id, field_name)]
+
+    def read_many(self, eeprom_model_name, model_ids, field_names):
+        # type: (str, Iterable[Optional[int]], Iterable[str]) -> Dict[Tuple[Optional[int], str], Any]
+        """
+        Reads the given fields of all given model ids. The result is keyed by (model_id, field_name) and
+        contains None for data that is not stored.
+        """
+        field_names = list(field_names)
+        data = {}
         with self._lock:
-            for row in self._cursor.execute("SELECT value FROM extensions WHERE model=? AND model_id=? AND field=?",
-                                            (eeprom_model_name, model_id, field_name)):
-                return row[0]
-        return None
+            self._load_model(eeprom_model_name)
+            for model_id in model_ids:
+                for field_name in field_names:
+                    data[(model_id, field_name)] = self._cache.get((eeprom_model_name, 0 if model_id is None else model_id, field_name))
+        return data
+
+    def _load_model(self, eeprom_model_name):
+        """ Loads all data of the given model in the cache, using a single query. Must be called with the lock held. """
+        if eeprom_model_name in self._cached_models:
+            return
+        for model_id, field_name, value in self._cursor.execute("SELECT model_id, field, value FROM extensions WHERE model=?",
+                                                                (eeprom_model_name,)):
+            self._cache[(eeprom_model_name, model_id, field_name)] = value
+        self._cached_models.add(eeprom_model_name)
 
     def write_data(self, data):
         """
@@ -67,12 +92,14 @@ class EepromExtension(object):
             with self._lock:
                 self._cursor.execute("INSERT INTO extensions (model, model_id, field, value) VALUES (?, ?, ?, ?)",
                                      (model_name, model_id, field_name, value))
+                self._cache[(model_name, model_id, field_name)] = value
 
     def delete_data(self, eeprom_model_name, model_id, field_name):
         model_id = 0 if model_id is None else model_id
         with self._lock:
             self._cursor.execute("DELETE FROM extensions WHERE model=? AND model_id=? AND field=?",
                                  (eeprom_model_name, model_id, field_name))
+            self._cache.pop((eeprom_model_name, model_id, field_name), None)
 
     def close(self):
         """ Commit the changes and close the database connection. """
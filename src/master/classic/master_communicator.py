@@ -19,11 +19,11 @@ Module to communicate with the master.
 from __future__ import absolute_import
 
 import logging
+import re
 import select
 import time
 from threading import Event, Lock, Thread
 
-import six
 from six.moves.queue import Empty, Queue
 from collections import Counter
 from gateway.daemon_thread import BaseThread
@@ -32,7 +32,7 @@ from gateway.maintenance_controller import InMaintenanceModeException
 from ioc import INJECTED, Inject
 from master.classic import master_api
 from master.classic.master_command import Field, MasterCommandSpec, printable
-from serial_utils import CommunicationTimedOutException
+from serial_utils import CommunicationTimedOutException, DebugBuffer
 
 logger = logging.getLogger('gateway.master.classic')
 
@@ -77,6 +77,8 @@ class MasterCommunicator(object):
         self.__update_mode = False
 
         self.__consumers = []  # type: List[Union[Consumer, BackgroundConsumer]]
+        self.__consumers_lock = Lock()
+        self.__dispatch_table = ({}, None)  # type: Tuple[Dict[bytes, List[Union[Consumer, BackgroundConsumer]]], Optional[Any]]
 
         self.__passthrough_enabled = False
         self.__passthrough_mode = False
@@ -98,9 +100,8 @@ class MasterCommunicator(object):
                                       'calls_timedout': [],
                                       'bytes_written': 0,
                                       'bytes_read': 0}  # type: Dict[str,Any]
-        self.__debug_buffer = {'read': {},
-                               'write': {}}  # type: Dict[str, Dict[float,bytearray]]
-        self.__debug_buffer_duration = 300
+        self.__debug_buffer = {'read': DebugBuffer(),
+                               'write': DebugBuffer()}  # type: Dict[str, DebugBuffer]
 
     def start(self):
         # type: () -> None
@@ -177,11 +178,8 @@ class MasterCommunicator(object):
 
     def get_debug_buffer(self):
         # type: () -> Dict[str,Dict[float,str]]
-        def process(buffer):
-            return {k: printable(v) for k, v in six.iteritems(buffer)}
-
-        return {'read': process(self.__debug_buffer['read']),
-                'write': process(self.__debug_buffer['write'])}
+        return {'read': self.__debug_buffer['read'].get(),
+                'write': self.__debug_buffer['write'].get()}
 
     def get_seconds_since_last_success(self):
         """ Get the number of seconds since the last successful communication. """
@@ -208,12 +206,7 @@ class MasterCommunicator(object):
         with self.__serial_write_lock:
             if self.__verbose:
                 logger.debug('Writing to Master serial:   {0}'.format(printable(data)))
-
-            threshold = time.time() - self.__debug_buffer_duration
-            self.__debug_buffer['write'][time.time()] = data
-            for t in self.__debug_buffer['write'].keys():
-                if t < threshold:
-                    del self.__debug_buffer['write'][t]
+            self.__debug_buffer['write'].append(data)
 
             self.__serial.write(data)  # TODO: make non blocking
             self.__communication_stats['bytes_written'] += len(data)
@@ -226,7 +219,20 @@ class MasterCommunicator(object):
         :param consumer: The consumer to register.
         :type consumer: Consumer or BackgroundConsumer.
         """
-        self.__consumers.append(consumer)
+        with self.__consumers_lock:
+            self.__consumers.append(consumer)
+            self.__update_dispatch_table()
+
+    def unregister_consumer(self, consumer):
+        """ Unregister a consumer from the communicator.
+
+        :param consumer: The consumer to unregister.
+        :type consumer: Consumer or BackgroundConsumer.
+        """
+        with self.__consumers_lock:
+            if consumer in self.__consumers:
+                self.__consumers.remove(consumer)
+                self.__update_dispatch_table()
 
     def do_raw_action(self, action, size, output_size=None, data=None, timeout=2):
         # type: (str, int, Optional[int], Optional[bytearray], Union[T_co, int]) -> Union[T_co, Dict[str, Any]]
@@ -276,7 +282,7 @@ class MasterCommunicator(object):
 
         with self.__command_lock:
             self.__command_total_histogram.update({str(cmd.action): 1})
-            self.__consumers.append(consumer)
+            self.register_consumer(consumer)
             self.__write_to_serial(inp)
             try:
                 result = consumer.get(timeout).fields
@@ -412,16 +418,19 @@ class MasterCommunicator(object):
         """ Returns whether the MasterCommunicator is in maintenance mode. """
         return self.__maintenance_mode
 
-    def __get_start_bytes(self):
-        """ Create a dict that maps the start byte to a list of consumers. """
-        start_bytes = {}  # type: Dict[int, List[Union[Consumer, BackgroundConsumer]]]
+    def __update_dispatch_table(self):
+        """
+        Precompiles the table that maps a 3 byte prefix to its consumers, together with a pattern matching
+        all possible start bytes. The table is swapped as a whole so the read thread never sees a partial update.
+        """
+        dispatch_table = {}  # type: Dict[bytes, List[Union[Consumer, BackgroundConsumer]]]
         for consumer in self.__consumers:
-            start_byte = consumer.get_prefix()[0]
-            if start_byte in start_bytes:
-                start_bytes[start_byte].append(consumer)
-            else:
-                start_bytes[start_byte] = [consumer]
-        return start_bytes
+            dispatch_table.setdefault(bytes(consumer.get_prefix()), []).append(consumer)
+        start_bytes = sorted(set(bytearray(prefix)[0] for prefix in dispatch_table))
+        start_byte_pattern = None
+        if start_bytes:
+            start_byte_pattern = re.compile('[{0}]'.format(''.join('\\x{0:02x}'.format(start_byte) for start_byte in start_bytes)).encode())
+        self.__dispatch_table = (dispatch_table, start_byte_pattern)
 
     def __read(self):
         """
@@ -431,7 +440,7 @@ class MasterCommunicator(object):
         def consumer_done(_consumer):
             """ Callback for when consumer is done. ReadState does not access parent directly. """
             if isinstance(_consumer, Consumer):
-                self.__consumers.remove(_consumer)
+                self.unregister_consumer(_consumer)
             elif isinstance(_consumer, BackgroundConsumer) and _consumer.send_to_passthrough:
                 self.__push_passthrough_data(_consumer.last_cmd_data)
 
@@ -499,15 +508,11 @@ class MasterCommunicator(object):
                 continue
 
             num_bytes = self.__serial.inWaiting()
-            data += self.__serial.read(num_bytes)
+            read_data = self.__serial.read(num_bytes)
+            data += read_data
             if len(data) > 0:
                 self.__communication_stats['bytes_read'] += num_bytes
-
-                threshold = time.time() - self.__debug_buffer_duration
-                self.__debug_buffer['read'][time.time()] = data
-                for t in self.__debug_buffer['read'].keys():
-                    if t < threshold:
-                        del self.__debug_buffer['read'][t]
+                self.__debug_buffer['read'].append(read_data)
 
                 if self.__verbose:
                     logger.debug('Reading from Master serial: {0}'.format(printable(data)))
@@ -517,39 +522,55 @@ class MasterCommunicator(object):
 
                 # No else here: data might not be empty when current_consumer is done
                 if read_state.should_find_consumer():
-                    start_bytes = self.__get_start_bytes()
-                    leftovers = bytearray()  # for unconsumed bytes; these will go to the passthrough.
-
-                    while len(data) > 0:
-                        if data[0] in start_bytes:
-                            # Prefixes are 3 bytes, make sure we have enough data to match
-                            if len(data) >= 3:
-                                match = False
-                                for consumer in start_bytes[data[0]]:
-                                    if data[:3] == consumer.get_prefix():
-                                        # Found matching consumer
-                                        read_state.set_consumer(consumer)
-                                        data = read_state.consume(data[3:])  # Strip off prefix
-                                        # Consumers might have changed, update start_bytes
-                                        start_bytes = self.__get_start_bytes()
-                                        match = True
-                                        break
-                                if match:
-                                    continue
-                            else:
-                                # All commands end with '\r\n', there are no prefixes that start
-                                # with \r\n so the last bytes of a command will not get stuck
-                                # waiting for the next serial.read()
-                                break
-
-                        leftovers.append(data[0])
-                        data = data[1:]
-
-                    if len(leftovers) > 0:
-                        if not self.__maintenance_mode:
-                            self.__push_passthrough_data(leftovers)
-                        else:
-                            self.__maintenance_queue.put(leftovers)
+                    data = self.__dispatch(data, read_state)
+
+    def __dispatch(self, data, read_state):
+        # type: (bytearray, Any) -> bytearray
+        """
+        Matches the data against the dispatch table and hands complete prefixes to their consumer. Bytes in between
+        are not consumed and are sent to the passthrough (or maintenance) queue in bulk.
+
+        :returns: The data that still needs more bytes before it can be matched
+        """
+        dispatch_table, start_byte_pattern = self.__dispatch_table
+        leftovers = []  # type: List[bytearray]  # for unconsumed bytes; these will go to the passthrough.
+        offset = 0
+
+        while offset < len(data):
+            match = start_byte_pattern.search(data, offset) if start_byte_pattern is not None else None
+            if match is None:
+                leftovers.append(data[offset:])
+                offset = len(data)
+                break
+            index = match.start()
+            if index + 3 > len(data):
+                # Prefixes are 3 bytes, make sure we have enough data to match. All commands end with '\r\n',
+                # there are no prefixes that start with \r\n so the last bytes of a command will not get stuck
+                # waiting for the next serial.read()
+                leftovers.append(data[offset:index])
+                offset = index
+                break
+            consumers = dispatch_table.get(bytes(data[index:index + 3]))
+            if not consumers:
+                leftovers.append(data[offset:index + 1])
+                offset = index + 1
+                continue
+
+            # Found matching consumer
+            leftovers.append(data[offset:index])
+            read_state.set_consumer(consumers[0])
+            data = read_state.consume(data[index + 3:])  # Strip off prefix
+            offset = 0
+            # Consumers might have changed, use the latest dispatch table
+            dispatch_table, start_byte_pattern = self.__dispatch_table
+
+        leftover_data = bytearray().join(leftovers)
+        if len(leftover_data) > 0:
+            if not self.__maintenance_mode:
+                self.__push_passthrough_data(leftover_data)
+            else:
+                self.__maintenance_queue.put(leftover_data)
+        return data[offset:]
 
 
 class CrcCheckFailedException(Exception):
@@ -23,9 +23,8 @@ import logging
 import select
 import struct
 import time
-import six
 from threading import Lock
-from collections import Counter
+from collections import Counter, deque
 from six.moves.queue import Empty, Queue
 from gateway.daemon_thread import BaseThread
 from ioc import INJECTED, Inject
@@ -33,10 +32,10 @@ from master.core.core_api import CoreAPI
 from master.core.core_command import CoreCommandSpec
 from master.core.fields import WordField
 from master.core.toolbox import Toolbox
-from serial_utils import CommunicationTimedOutException, printable
+from serial_utils import CommunicationTimedOutException, DebugBuffer, printable
 
 if False:  # MYPY
-    from typing import Dict, Any, Optional, TypeVar, Union, Callable, Set, List
+    from typing import Dict, Any, Optional, TypeVar, Union, Callable, Set, List, Tuple, Deque
     from serial import Serial
     T_co = TypeVar('T_co', bound=None, covariant=True)
 
@@ -55,6 +54,9 @@ class CoreCommunicator(object):
     START_OF_REPLY = bytearray(b'RTR')
     END_OF_REPLY = bytearray(b'\r\n')
 
+    # Maximum amount of pipelined commands in flight
+    PIPELINE_WINDOW_SIZE = 8
+
     @Inject
     def __init__(self, controller_serial=INJECTED):
         # type: (Serial) -> None
@@ -82,9 +84,8 @@ class CoreCommunicator(object):
                                      'calls_timedout': [],
                                      'bytes_written': 0,
                                      'bytes_read': 0}  # type: Dict[str,Any]
-        self._debug_buffer = {'read': {},
-                              'write': {}}  # type: Dict[str, Dict[float, bytearray]]
-        self._debug_buffer_duration = 300
+        self._debug_buffer = {'read': DebugBuffer(),
+                              'write': DebugBuffer()}  # type: Dict[str, DebugBuffer]
 
     def start(self):
         """ Start the CoreComunicator, this starts the background read thread. """
@@ -120,11 +121,8 @@ class CoreCommunicator(object):
 
     def get_debug_buffer(self):
         # type: () -> Dict[str,Dict[float,str]]
-        def process(buffer):
-            return {k: printable(v) for k, v in six.iteritems(buffer)}
-
-        return {'read': process(self._debug_buffer['read']),
-                'write': process(self._debug_buffer['write'])}
+        return {'read': self._debug_buffer['read'].get(),
+                'write': self._debug_buffer['write'].get()}
 
     def get_seconds_since_last_success(self):  # type: () -> float
         """ Get the number of seconds since the last successful communication. """
@@ -171,12 +169,7 @@ class CoreCommunicator(object):
         with self._serial_write_lock:
             if self._verbose:
                 logger.debug('Writing to Core serial:   {0}'.format(printable(data)))
-
-            threshold = time.time() - self._debug_buffer_duration
-            self._debug_buffer['write'][time.time()] = data
-            for t in self._debug_buffer['write'].keys():
-                if t < threshold:
-                    del self._debug_buffer['write'][t]
+            self._debug_buffer['write'].append(data)
 
             self._serial.write(data)
             self._serial_bytes_written += len(data)
@@ -229,6 +222,49 @@ class CoreCommunicator(object):
         :param fields: A dictionary with the command input field values
         :param timeout: maximum allowed time before a CommunicationTimedOutException is raised
         """
+        consumer = self._submit_command(command, fields)
+        return self._wait_for_result(consumer, timeout)
+
+    def do_commands(self, commands, timeout=2, window_size=None):
+        # type: (List[Tuple[CoreCommandSpec, Dict[str, Any]]], Union[T_co, int], Optional[int]) -> List[Union[T_co, Dict[str, Any]]]
+        """
+        Send multiple commands over the serial port, without waiting for each answer before sending the next command.
+        Every command gets its own CID, so the answers are matched to their command as they arrive. At most
+        `window_size` commands are in flight at any given time.
+        If the Core does not respond to one of the commands within the timeout period, a CommunicationTimedOutException
+        is raised and the remaining commands are abandoned.
+
+        :param commands: A list of (command spec, command input field values) tuples
+        :param timeout: maximum allowed time for each answer before a CommunicationTimedOutException is raised
+        :param window_size: the maximum amount of commands in flight, defaults to PIPELINE_WINDOW_SIZE
+        :returns: A list with the command output fields, in the order of the commands
+        """
+        if window_size is None:
+            window_size = CoreCommunicator.PIPELINE_WINDOW_SIZE
+        window_size = max(1, window_size)
+        in_flight = deque()  # type: Deque[Consumer]
+        results = []  # type: List[Union[T_co, Dict[str, Any]]]
+        try:
+            for command, fields in commands:
+                if len(in_flight) >= window_size:
+                    results.append(self._wait_for_result(in_flight.popleft(), timeout))
+                in_flight.append(self._submit_command(command, fields))
+            while in_flight:
+                results.append(self._wait_for_result(in_flight.popleft(), timeout))
+        except Exception:
+            while in_flight:
+                self.unregister_consumer(in_flight.popleft())
+            raise
+        return results
+
+    def _submit_command(self, command, fields):  # type: (CoreCommandSpec, Dict[str, Any]) -> Consumer
+        """
+        Registers a consumer for the command and sends the command over the serial port
+
+        :param command: specification of the command to execute
+        :param fields: A dictionary with the command input field values
+        :returns: The consumer that will receive the answer
+        """
         cid = self._get_cid()
         consumer = Consumer(command, cid)
         command = consumer.command
@@ -240,10 +276,20 @@ class CoreCommunicator(object):
         except Exception:
             self.discard_cid(cid)
             raise
+        return consumer
 
+    def _wait_for_result(self, consumer, timeout):
+        # type: (Consumer, Union[T_co, int]) -> Union[T_co, Dict[str, Any]]
+        """
+        Waits for the answer on a submitted command
+
+        :param consumer: The consumer that was registered for the command
+        :param timeout: maximum allowed time before a CommunicationTimedOutException is raised
+        """
+        command = consumer.command
         try:
             result = None  # type: Any
-            if isinstance(consumer, Consumer) and timeout is not None:
+            if timeout is not None:
                 result = consumer.get(timeout)
             self._last_success = time.time()
             self._communication_stats['calls_succeeded'].append(time.time())
@@ -303,11 +349,7 @@ class CoreCommunicator(object):
         Response format: 'RTR' + {CID, 1 byte} + {command, 2 bytes} + {length, 2 bytes} + {payload, `length` bytes} + 'C' + {checksum, 1 byte} + '\r\n'
 
         """
-        data = bytearray()
-        message_length = None
-        header_fields = None
-        header_length = len(CoreCommunicator.START_OF_REPLY) + 1 + 2 + 2  # RTR + CID (1 byte) + command (2 bytes) + length (2 bytes)
-        footer_length = 1 + 1 + len(CoreCommunicator.END_OF_REPLY)  # 'C' + checksum (1 byte) + \r\n
+        decoder = CoreFrameDecoder()
         need_more_data = False
 
         while not self._stop:
@@ -319,73 +361,31 @@ class CoreCommunicator(object):
                         continue
                     need_more_data = False
 
-                # Read what's now on the serial port
-                num_bytes = self._serial.inWaiting()
+                # Read what's now on the serial port, but never more than what fits in the decoder
+                num_bytes = min(self._serial.inWaiting(), decoder.free)
                 if num_bytes > 0:
-                    data += self._serial.read(num_bytes)
+                    decoder.feed(self._serial.read(num_bytes))
                     # Update counters
                     self._serial_bytes_read += num_bytes
                     self._communication_stats['bytes_read'] += num_bytes
 
-                # Wait for the full message, or the header length
-                min_length = message_length or header_length
-                if len(data) < min_length:
+                frame = decoder.decode()
+                if frame is None:
                     need_more_data = True
                     continue
-
-                if message_length is None:
-                    # Check if the data contains the START_OF_REPLY
-                    if CoreCommunicator.START_OF_REPLY not in data:
-                        need_more_data = True
-                        continue
-
-                    # Align with START_OF_REPLY
-                    if not data.startswith(CoreCommunicator.START_OF_REPLY):
-                        data = CoreCommunicator.START_OF_REPLY + data.split(CoreCommunicator.START_OF_REPLY, 1)[-1]
-                        if len(data) < header_length:
-                            continue
-
-                    header_fields = CoreCommunicator._parse_header(data)
-                    message_length = header_fields['length'] + header_length + footer_length
-
-                    # If not all data is present, wait for more data
-                    if len(data) < message_length:
-                        continue
-
-                message = data[:message_length]  # type: bytearray
-                data = data[message_length:]
+                message, header_fields = frame
 
                 # A possible message is received, log where appropriate
                 if self._verbose:
                     logger.debug('Reading from Core serial: {0}'.format(printable(message)))
-                threshold = time.time() - self._debug_buffer_duration
-                self._debug_buffer['read'][time.time()] = message
-                for t in self._debug_buffer['read'].keys():
-                    if t < threshold:
-                        del self._debug_buffer['read'][t]
-
-                # Validate message boundaries
-                correct_boundaries = message.startswith(CoreCommunicator.START_OF_REPLY) and message.endswith(CoreCommunicator.END_OF_REPLY)
-                if not correct_boundaries:
-                    logger.info('Unexpected boundaries: {0}'.format(printable(message)))
-                    # Reset, so we'll wait for the next RTR
-                    message_length = None
-                    data = message[3:] + data  # Strip the START_OF_REPLY, and restore full data
-                    continue
+                self._debug_buffer['read'].append(message)
 
-                # Validate message CRC
-                crc = bytearray([message[-3]])
-                payload = message[8:-4]  # type: bytearray
-                checked_payload = message[3:-4]  # type: bytearray
-                expected_crc = CoreCommunicator._calculate_crc(checked_payload)
-                if crc != expected_crc:
-                    logger.info('Unexpected CRC ({0} vs expected {1}): {2}'.format(crc, expected_crc, printable(checked_payload)))
-                    # Reset, so we'll wait for the next RTR
-                    message_length = None
-                    data = message[3:] + data  # Strip the START_OF_REPLY, and restore full data
+                if header_fields is None:
+                    # Invalid message, the decoder already resynchronized on the next RTR
                     continue
 
                 # A valid message is received, reliver it to the correct consumer
+                payload = message[CoreFrameDecoder.HEADER_LENGTH:-CoreFrameDecoder.FOOTER_LENGTH]  # type: bytearray
                 consumers = self._consumers.get(header_fields['hash'], [])
                 for consumer in consumers[:]:
                     if self._verbose:
@@ -395,13 +395,9 @@ class CoreCommunicator(object):
                         self.unregister_consumer(consumer)
 
                 self.discard_cid(header_fields['cid'])
-
-                # Message processed, cleaning up
-                message_length = None
             except Exception:
                 logger.exception('Unexpected exception at Core read thread')
-                data = bytearray()
-                message_length = None
+                decoder.reset()
 
     @staticmethod
     def _parse_header(data):  # type: (bytearray) -> Dict[str, Union[int, bytearray]]
@@ -412,6 +408,195 @@ class CoreCommunicator(object):
                 'length': struct.unpack('>H', data[base + 3:base + 5])[0]}
 
 
+class RingBuffer(object):
+    """
+    Fixed-size byte ring buffer. Incoming data is copied once into a preallocated bytearray and
+    is only copied out again when a caller explicitly asks for it. Offsets are relative to the
+    oldest byte in the buffer.
+    """
+
+    def __init__(self, capacity):  # type: (int) -> None
+        self._capacity = capacity
+        self._buffer = bytearray(capacity)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._length = 0
+
+    def __len__(self):  # type: () -> int
+        return self._length
+
+    def __getitem__(self, offset):  # type: (int) -> int
+        if not 0 <= offset < self._length:
+            raise IndexError('RingBuffer offset out of range')
+        return self._buffer[(self._start + offset) % self._capacity]
+
+    @property
+    def capacity(self):  # type: () -> int
+        return self._capacity
+
+    @property
+    def free(self):  # type: () -> int
+        return self._capacity - self._length
+
+    def clear(self):  # type: () -> None
+        self._start = 0
+        self._length = 0
+
+    def write(self, data):  # type: (Union[bytes, bytearray]) -> None
+        """ Appends data to the buffer. When the buffer overflows, the oldest data is dropped. """
+        data_view = memoryview(data)
+        size = len(data_view)
+        if size > self._capacity:
+            data_view = data_view[size - self._capacity:]
+            size = self._capacity
+        overflow = self._length + size - self._capacity
+        if overflow > 0:
+            self.skip(overflow)
+        end = (self._start + self._length) % self._capacity
+        first = min(size, self._capacity - end)
+        self._view[end:end + first] = data_view[:first]
+        if first < size:
+            self._view[:size - first] = data_view[first:]
+        self._length += size
+
+    def skip(self, size):  # type: (int) -> None
+        """ Drops the oldest `size` bytes. """
+        size = min(size, self._length)
+        self._start = (self._start + size) % self._capacity
+        self._length -= size
+
+    def copy(self, offset, size):  # type: (int, int) -> bytearray
+        """ Copies `size` bytes starting at `offset` into a new bytearray. """
+        if offset < 0 or size < 0 or offset + size > self._length:
+            raise IndexError('RingBuffer range out of range')
+        data = bytearray(size)
+        begin = (self._start + offset) % self._capacity
+        first = min(size, self._capacity - begin)
+        data[:first] = self._view[begin:begin + first]
+        if first < size:
+            data[first:] = self._view[:size - first]
+        return data
+
+    def find(self, pattern, offset=0):  # type: (bytearray, int) -> int
+        """ Returns the offset of the first occurrence of `pattern` at or after `offset`, or -1. """
+        pattern_length = len(pattern)
+        if offset + pattern_length > self._length:
+            return -1
+        begin = self._start + offset
+        end = self._start + self._length
+        if end <= self._capacity:
+            index = self._buffer.find(pattern, begin, end)
+            return -1 if index == -1 else index - self._start
+        if begin < self._capacity:
+            # Contiguous part up to the end of the underlying buffer
+            index = self._buffer.find(pattern, begin, self._capacity)
+            if index != -1:
+                return index - self._start
+            # A match straddling the wrap point
+            tail = max(begin, self._capacity - pattern_length + 1)
+            seam = self._buffer[tail:self._capacity] + self._buffer[:min(pattern_length - 1, end - self._capacity)]
+            index = seam.find(pattern)
+            if index != -1:
+                return tail + index - self._start
+            begin = self._capacity
+        index = self._buffer.find(pattern, begin - self._capacity, end - self._capacity)
+        return -1 if index == -1 else index + self._capacity - self._start
+
+
+class CoreFrameDecoder(object):
+    """
+    Incremental decoder for Core reply frames. Raw serial data is fed into a fixed-size ring buffer and
+    a small header/length/CRC state machine extracts the frames. Bytes are only copied out of the ring
+    buffer once a complete frame is available.
+    """
+
+    HEADER_LENGTH = len(CoreCommunicator.START_OF_REPLY) + 1 + 2 + 2  # RTR + CID (1 byte) + command (2 bytes) + length (2 bytes)
+    FOOTER_LENGTH = 1 + 1 + len(CoreCommunicator.END_OF_REPLY)  # 'C' + checksum (1 byte) + \r\n
+    BUFFER_SIZE = 8192
+
+    def __init__(self, capacity=BUFFER_SIZE):  # type: (int) -> None
+        self._buffer = RingBuffer(capacity)
+        self._header_fields = None  # type: Optional[Dict[str, Any]]
+        self._message_length = None  # type: Optional[int]
+
+    @property
+    def free(self):  # type: () -> int
+        return self._buffer.free
+
+    def feed(self, data):  # type: (Union[bytes, bytearray]) -> None
+        self._buffer.write(data)
+
+    def reset(self):  # type: () -> None
+        self._buffer.clear()
+        self._header_fields = None
+        self._message_length = None
+
+    def decode(self):  # type: () -> Optional[Tuple[bytearray, Optional[Dict[str, Any]]]]
+        """
+        Decodes the next frame.
+
+        :returns: None if more data is needed, otherwise a tuple with the raw message and its header fields.
+                  The header fields are None if the message failed validation.
+        """
+        buffer = self._buffer
+        while self._message_length is None:
+            # Align with START_OF_REPLY
+            index = buffer.find(CoreCommunicator.START_OF_REPLY)
+            if index == -1:
+                # Keep a possible partial START_OF_REPLY
+                buffer.skip(max(0, len(buffer) - (len(CoreCommunicator.START_OF_REPLY) - 1)))
+                return None
+            buffer.skip(index)
+            if len(buffer) < CoreFrameDecoder.HEADER_LENGTH:
+                return None
+            header_fields = self._parse_header()
+            message_length = header_fields['length'] + CoreFrameDecoder.HEADER_LENGTH + CoreFrameDecoder.FOOTER_LENGTH
+            if message_length > buffer.capacity:
+                logger.info('Unexpected length ({0} bytes)'.format(header_fields['length']))
+                self._resync()
+                continue
+            self._header_fields = header_fields
+            self._message_length = message_length
+
+        message_length = self._message_length
+        if len(buffer) < message_length:
+            return None
+
+        # Validate message boundaries
+        end_of_reply = CoreCommunicator.END_OF_REPLY
+        if any(buffer[message_length - len(end_of_reply) + i] != end_of_reply[i] for i in range(len(end_of_reply))):
+            message = buffer.copy(0, message_length)
+            logger.info('Unexpected boundaries: {0}'.format(printable(message)))
+            self._resync()
+            return message, None
+
+        message = buffer.copy(0, message_length)
+
+        # Validate message CRC. The checked payload is everything between the START_OF_REPLY and the 'C'.
+        crc = message[-3]
+        expected_crc = (sum(message) - sum(CoreCommunicator.START_OF_REPLY) - sum(message[-4:])) % 256
+        if crc != expected_crc:
+            logger.info('Unexpected CRC ({0} vs expected {1}): {2}'.format(crc, expected_crc, printable(message)))
+            self._resync()
+            return message, None
+
+        fields = self._header_fields
+        buffer.skip(message_length)
+        self._header_fields = None
+        self._message_length = None
+        return message, fields
+
+    def _resync(self):  # type: () -> None
+        """ Strip the START_OF_REPLY, so we'll wait for the next RTR """
+        self._buffer.skip(len(CoreCommunicator.START_OF_REPLY))
+        self._header_fields = None
+        self._message_length = None
+
+    def _parse_header(self):  # type: () -> Dict[str, Any]
+        header = self._buffer.copy(0, CoreFrameDecoder.HEADER_LENGTH)
+        return CoreCommunicator._parse_header(header)
+
+
 class Consumer(object):
     """
     A consumer is registered to the read thread before a command is issued.  If an output
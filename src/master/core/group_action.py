@@ -19,7 +19,7 @@ Contains Group Action related code
 from __future__ import absolute_import
 import logging
 from master.core.memory_models import GroupActionAddressConfiguration, GroupActionConfiguration, GroupActionBasicAction
-from master.core.memory_types import MemoryActivator
+from master.core.memory_types import MemoryActivator, memory_transaction
 
 if False:  # MYPY
     from typing import List, Dict, Optional
@@ -86,60 +86,59 @@ class GroupActionController(object):
         if not (0 <= group_action_id <= 255):
             raise ValueError('GroupAction ID {0} not in range 0 <= id <= 255'.format(group_action_id))
 
-        if 'actions' in fields:
-            address_configuration = GroupActionAddressConfiguration(group_action_id)
-            previous_length = address_configuration.end - address_configuration.start + 1
-            if GroupActionController.MAX_WORD in [address_configuration.start, address_configuration.end]:
-                previous_length = 0
-            needed_length = len(group_action.actions)
-            if needed_length == 0:
-                # Empty, clear addresses
-                address_configuration.start = GroupActionController.MAX_WORD
-                address_configuration.end = GroupActionController.MAX_WORD
-                address_configuration.save(activate=False)
-            else:
-                if needed_length == previous_length:
-                    # No new location needed
-                    start_address = address_configuration.start
+        with memory_transaction():
+            if 'actions' in fields:
+                address_configuration = GroupActionAddressConfiguration(group_action_id)
+                previous_length = address_configuration.end - address_configuration.start + 1
+                if GroupActionController.MAX_WORD in [address_configuration.start, address_configuration.end]:
+                    previous_length = 0
+                needed_length = len(group_action.actions)
+                if needed_length == 0:
+                    # Empty, clear addresses
+                    address_configuration.start = GroupActionController.MAX_WORD
+                    address_configuration.end = GroupActionController.MAX_WORD
+                    address_configuration.save(activate=False)
                 else:
-                    # Different length, search for (better) location
-                    free_space_map = GroupActionController._free_address_space_map(group_action_id)
-                    found_length = None
-                    for length in sorted(list(free_space_map.keys())):
-                        if length >= needed_length:
-                            found_length = length
-                            break
-                    if found_length is None:
-                        logger.error('Insufficient storage saving GroupAction with {0} BAs: {1}'.format(needed_length, free_space_map))
-                        raise RuntimeError('Cannot save GroupAction {0}. Insufficient storage'.format(group_action_id))
-                    available_start_addresses = free_space_map[found_length]
-                    if address_configuration.start in available_start_addresses:
-                        start_address = address_configuration.start  # Prefer same location
+                    if needed_length == previous_length:
+                        # No new location needed
+                        start_address = address_configuration.start
                     else:
-                        start_address = available_start_addresses[0]
-                    address_configuration.start = start_address
-                    address_configuration.end = start_address + needed_length - 1
-                    address_configuration.save(activate=False)
-                # Store BAs
-                for i, new_action in enumerate(group_action.actions):
-                    basic_action = GroupActionBasicAction(start_address + i)
-                    basic_action.basic_action = new_action
-                    basic_action.save(activate=False)
-        if 'name' in fields:
-            group_action_configuration = GroupActionConfiguration(group_action.id)
-            group_action_configuration.name = group_action.name
-            group_action_configuration.save(activate=False)
-
-        if fields:
-            MemoryActivator.activate()
+                        # Different length, search for (better) location
+                        free_space_map = GroupActionController._free_address_space_map(group_action_id)
+                        found_length = None
+                        for length in sorted(list(free_space_map.keys())):
+                            if length >= needed_length:
+                                found_length = length
+                                break
+                        if found_length is None:
+                            logger.error('Insufficient storage saving GroupAction with {0} BAs: {1}'.format(needed_length, free_space_map))
+                            raise RuntimeError('Cannot save GroupAction {0}. Insufficient storage'.format(group_action_id))
+                        available_start_addresses = free_space_map[found_length]
+                        if address_configuration.start in available_start_addresses:
+                            start_address = address_configuration.start  # Prefer same location
+                        else:
+                            start_address = available_start_addresses[0]
+                        address_configuration.start = start_address
+                        address_configuration.end = start_address + needed_length - 1
+                        address_configuration.save(activate=False)
+                    # Store BAs
+                    for i, new_action in enumerate(group_action.actions):
+                        basic_action = GroupActionBasicAction(start_address + i)
+                        basic_action.basic_action = new_action
+                        basic_action.save(activate=False)
+            if 'name' in fields:
+                group_action_configuration = GroupActionConfiguration(group_action.id)
+                group_action_configuration.name = group_action.name
+                group_action_configuration.save(activate=False)
+
+            if fields:
+                MemoryActivator.activate()
 
     @staticmethod
     def _free_address_space_map(exclude_group_action_id=None):  # type: (Optional[int]) -> Dict[int, List[int]]
         free_addresses_set = set(range(4200))
-        for i in range(256):
-            if i == exclude_group_action_id:
-                continue
-            used_address_configuration = GroupActionAddressConfiguration(i)
+        group_action_ids = [i for i in range(256) if i != exclude_group_action_id]
+        for used_address_configuration in GroupActionAddressConfiguration.load_many(group_action_ids, fields=['start', 'end']):
             if GroupActionController.MAX_WORD not in [used_address_configuration.start,
                                                       used_address_configuration.end]:
                 free_addresses_set -= set(range(used_address_configuration.start, used_address_configuration.end + 1))
@@ -23,7 +23,9 @@ import time
 from threading import Lock
 
 from gateway.daemon_thread import BaseThread
+from gateway.hal.master_event import MasterEvent
 from gateway.maintenance_communicator import MaintenanceCommunicator
+from gateway.pubsub import PubSub
 from ioc import INJECTED, Inject
 
 logger = logging.getLogger('openmotics')
@@ -32,12 +34,13 @@ logger = logging.getLogger('openmotics')
 class MaintenanceCoreCommunicator(MaintenanceCommunicator):
 
     @Inject
-    def __init__(self, cli_serial=INJECTED):
+    def __init__(self, cli_serial=INJECTED, pubsub=INJECTED):
         """
         :param cli_serial: Serial port to communicate with
         :type cli_serial: serial.Serial
         """
         self._serial = cli_serial
+        self._pubsub = pubsub
         self._write_lock = Lock()
 
         self._receiver_callback = None
@@ -67,6 +70,8 @@ class MaintenanceCoreCommunicator(MaintenanceCommunicator):
         self._active = False  # Core has a separate serial port
         if self._deactivated_callback is not None:
             self._deactivated_callback()
+        master_event = MasterEvent(MasterEvent.Types.MAINTENANCE_EXIT, {})
+        self._pubsub.publish_master_event(PubSub.MasterTopics.MAINTENANCE, master_event)
 
     def set_receiver(self, callback):
         self._receiver_callback = callback
@@ -19,7 +19,9 @@ from __future__ import absolute_import
 
 import copy
 import logging
-from threading import Event as ThreadingEvent
+import random
+from contextlib import contextmanager
+from threading import Event as ThreadingEvent, RLock
 
 from gateway.hal.master_event import MasterEvent
 from gateway.pubsub import PubSub
@@ -28,9 +30,10 @@ from master.core.core_api import CoreAPI
 from master.core.core_communicator import BackgroundConsumer, CoreCommunicator
 from master.core.events import Event
 from master.core.memory_types import MemoryAddress
+from master.memory_snapshot import MemorySnapshot
 
 if False:  # MYPY
-    from typing import List, Dict, Callable, Any, Optional
+    from typing import List, Dict, Callable, Any, Optional, Set, Iterator, Iterable, Tuple
 
 logger = logging.getLogger("openmotics")
 
@@ -42,24 +45,23 @@ class MemoryTypes(object):
 
 class MemoryFile(object):
 
-    # TODO:
-    #  * Multiple writes in a single page should only write the page once
-    #  * Writes to FRAM must only overwrite the changed data, not the entire page
-    #  * Optimize eeprom activates so there's only a single activation if both EEPROM and FRAM are updated
-
     WRITE_TIMEOUT = 5
     READ_TIMEOUT = 5
     ACTIVATE_TIMEOUT = 5
+    READ_CHUNK_SIZE = 32
     WRITE_CHUNK_SIZE = 32
+    WRITE_MERGE_GAP = 8  # Unchanged bytes that are rewritten rather than starting a new write (saves the command overhead)
+    SNAPSHOT_SAMPLES = 8
     SIZES = {MemoryTypes.EEPROM: (512, 256),
              MemoryTypes.FRAM: (128, 256)}
 
     @Inject
-    def __init__(self, memory_type, master_communicator=INJECTED, pubsub=INJECTED):
-        # type: (str, CoreCommunicator, PubSub) -> None
+    def __init__(self, memory_type, master_communicator=INJECTED, pubsub=INJECTED, snapshot_path=None):
+        # type: (str, CoreCommunicator, PubSub, Optional[str]) -> None
         """
         Initializes the MemoryFile instance, reprensenting one of the supported memory types.
-        It provides caching for EEPROM, and direct write/read through for FRAM
+        It provides caching for EEPROM, and direct write/read through for FRAM.
+        The EEPROM cache is persisted to `snapshot_path` (if given), so it survives a restart.
         """
         if not master_communicator:
             raise RuntimeError('Could not inject argument: core_communicator')
@@ -73,6 +75,17 @@ class MemoryFile(object):
         self._self_activated = False
         self._dirty = False
         self._activation_event = ThreadingEvent()
+        self._transaction_lock = RLock()
+        self._transaction_depth = 0
+        self._pending_writes = {}  # type: Dict[int, Dict[int, int]]
+        self._snapshot = None  # type: Optional[MemorySnapshot]
+        self._snapshot_verified = False
+        self._unverified_pages = set()  # type: Set[int]
+        if snapshot_path is not None and memory_type == MemoryTypes.EEPROM:
+            try:
+                self._snapshot = MemorySnapshot(snapshot_path, self._pages, self._page_length)
+            except Exception:
+                logger.exception('MEMORY.{0}: Could not open snapshot {1}'.format(self.type, snapshot_path))
 
         self._core_communicator.register_consumer(
             BackgroundConsumer(CoreAPI.event_information(), 0, self._handle_event)
@@ -97,67 +110,232 @@ class MemoryFile(object):
             self._activation_event.set()
 
     def read(self, addresses):  # type: (List[MemoryAddress]) -> Dict[MemoryAddress, bytearray]
+        page_data = self.read_pages(set(address.page for address in addresses))
         data = {}
         for address in addresses:
-            page_data = self.read_page(address.page)
-            data[address] = page_data[address.offset:address.offset + address.length]
+            data[address] = page_data[address.page][address.offset:address.offset + address.length]
         return data
 
+    def read_pages(self, pages):  # type: (Iterable[int]) -> Dict[int, bytearray]
+        """
+        Reads all given pages at once. To avoid copies, the returned pages can be shared with the cache
+        so they should be considered read-only.
+        """
+        pages = set(pages)
+        if self.type == MemoryTypes.FRAM:
+            page_cache = self._read_pages(sorted(pages))
+        else:
+            self._load_pages(pages)
+            page_cache = self._cache
+        with self._transaction_lock:
+            return dict((page, self._apply_pending_writes(page, page_cache[page])) for page in pages)
+
     def write(self, data_map):  # type: (Dict[MemoryAddress, bytearray]) -> None
-        for address, data in data_map.items():
-            page_data = self.read_page(address.page)
-            for index, data_byte in enumerate(data):
-                page_data[address.offset + index] = data_byte
-            self.write_page(address.page, page_data)
+        """
+        Writes the given data. Inside a `write_transaction` the changes are only written to the Core
+        when the (outer) transaction ends, so multiple writes to a single page result in a single page update.
+        """
+        with self.write_transaction():
+            for address, data in data_map.items():
+                page_changes = self._pending_writes.setdefault(address.page, {})
+                for index, data_byte in enumerate(data):
+                    page_changes[address.offset + index] = data_byte
 
-    def read_page(self, page):  # type: (int) -> bytearray
-        def _read_page():
-            page_data = bytearray()
-            for i in range(self._page_length // 32):
-                page_data += self._core_communicator.do_command(
-                    command=CoreAPI.memory_read(),
-                    fields={'type': self.type, 'page': page, 'start': i * 32, 'length': 32},
-                    timeout=MemoryFile.READ_TIMEOUT
-                )['data']
+    @contextmanager
+    def write_transaction(self):  # type: () -> Iterator[None]
+        """ Buffers all writes until the (outer) transaction ends. Other threads can't write in the meantime """
+        with self._transaction_lock:
+            self._transaction_depth += 1
+            try:
+                yield
+            except Exception:
+                if self._transaction_depth == 1:
+                    self._pending_writes = {}
+                raise
+            else:
+                if self._transaction_depth == 1:
+                    self._flush_pending_writes()
+            finally:
+                self._transaction_depth -= 1
+
+    def _apply_pending_writes(self, page, page_data, pending_writes=None):
+        # type: (int, bytearray, Optional[Dict[int, Dict[int, int]]]) -> bytearray
+        if pending_writes is None:
+            pending_writes = self._pending_writes
+        page_changes = pending_writes.get(page)
+        if not page_changes:
             return page_data
+        page_data = copy.copy(page_data)
+        for offset, data_byte in page_changes.items():
+            page_data[offset] = data_byte
+        return page_data
+
+    def _flush_pending_writes(self):  # type: () -> None
+        pending_writes, self._pending_writes = self._pending_writes, {}
+        if not pending_writes:
+            return
+        if self.type == MemoryTypes.EEPROM:
+            self._load_pages(set(pending_writes.keys()))
+            # Only changed bytes are written, so the pages need to be up to date
+            unverified_pages = sorted(self._unverified_pages.intersection(pending_writes.keys()))
+            if unverified_pages:
+                self._cache_pages(self._read_pages(unverified_pages))
+
+        commands = []
+        new_pages = {}  # type: Dict[int, bytearray]
+        for page in sorted(pending_writes):
+            page_changes = pending_writes[page]
+            if self.type == MemoryTypes.EEPROM:
+                # Only the bytes that differ from the cache need to be written
+                cached_data = self._cache[page]
+                new_pages[page] = self._apply_pending_writes(page, cached_data, pending_writes)
+                offsets = sorted(offset for offset, data_byte in page_changes.items() if cached_data[offset] != data_byte)
+                ranges = self._get_write_ranges(offsets, gap=MemoryFile.WRITE_MERGE_GAP)
+                page_data = new_pages[page]
+            else:
+                # There's no FRAM cache, so only the bytes that were written are sent. Since the data
+                # in between is unknown, only adjacent bytes can be merged.
+                offsets = sorted(page_changes.keys())
+                ranges = self._get_write_ranges(offsets, gap=0)
+                page_data = bytearray(self._page_length)
+                for offset, data_byte in page_changes.items():
+                    page_data[offset] = data_byte
+            for start, length in ranges:
+                data_chunk = page_data[start:start + length]
+                logger.info('MEMORY.{0}: Write P{1} S{2} D[{3}]'.format(self.type, page, start, ' '.join(str(b) for b in data_chunk)))
+                commands.append((CoreAPI.memory_write(length),
+                                 {'type': self.type, 'page': page, 'start': start, 'data': data_chunk}))
+
+        try:
+            if commands:
+                self._dirty = True
+                self._core_communicator.do_commands(commands=commands,
+                                                    timeout=MemoryFile.WRITE_TIMEOUT)
+        except Exception:
+            # Failure writing, these pages might be partially written
+            for page in new_pages:
+                self.invalidate_cache(page)
+            raise
+
+        for page, page_data in new_pages.items():
+            self._cache[page] = page_data
+            if self._snapshot is not None:
+                self._snapshot.store(page, page_data)
 
+    @staticmethod
+    def _get_write_ranges(offsets, gap):  # type: (List[int], int) -> List[Tuple[int, int]]
+        """
+        Converts a sorted list of changed offsets into (start, length) ranges of at most WRITE_CHUNK_SIZE bytes.
+        Offsets that are less than `gap` bytes apart are written in a single range.
+        """
+        ranges = []  # type: List[Tuple[int, int]]
+        start = None  # type: Optional[int]
+        end = 0
+        for offset in offsets:
+            if start is not None and offset - end <= gap and offset - start < MemoryFile.WRITE_CHUNK_SIZE:
+                end = offset + 1
+                continue
+            if start is not None:
+                ranges.append((start, end - start))
+            start = offset
+            end = offset + 1
+        if start is not None:
+            ranges.append((start, end - start))
+        return ranges
+
+    def _read_pages(self, pages):  # type: (List[int]) -> Dict[int, bytearray]
+        """ Reads the given pages, pipelining all memory reads so they share the bus latency """
+        chunks = self._page_length // MemoryFile.READ_CHUNK_SIZE
+        results = self._core_communicator.do_commands(
+            commands=[(CoreAPI.memory_read(), {'type': self.type, 'page': page, 'start': i * MemoryFile.READ_CHUNK_SIZE, 'length': MemoryFile.READ_CHUNK_SIZE})
+                      for page in pages
+                      for i in range(chunks)],
+            timeout=MemoryFile.READ_TIMEOUT
+        )
+        page_data = {}  # type: Dict[int, bytearray]
+        for index, page in enumerate(pages):
+            page_data[page] = bytearray().join(result['data'] for result in results[index * chunks:(index + 1) * chunks])
+        return page_data
+
+    def read_page(self, page):  # type: (int) -> bytearray
         if self.type == MemoryTypes.FRAM:
-            return _read_page()
+            page_data = self._read_pages([page])[page]
+        else:
+            if page not in self._cache:
+                self._load_pages({page})
+            page_data = self._cache[page]
+        with self._transaction_lock:
+            return copy.copy(self._apply_pending_writes(page, page_data))
+
+    def _load_pages(self, pages):  # type: (Set[int]) -> None
+        """ Loads the given pages in the cache, from the snapshot if possible or else from the Core """
+        if not self._snapshot_verified:
+            self._verify_snapshot()
+        missing_pages = pages - set(self._cache.keys())
+        self._cache_pages(self._read_pages(sorted(missing_pages)))
+
+    def _cache_pages(self, page_cache):  # type: (Dict[int, bytearray]) -> None
+        """ Caches pages that were read from the Core """
+        self._cache.update(page_cache)
+        self._unverified_pages.difference_update(page_cache.keys())
+        if self._snapshot is not None:
+            for page, page_data in page_cache.items():
+                self._snapshot.store(page, page_data)
+
+    def _verify_snapshot(self):  # type: () -> None
+        """
+        Compares a few sampled pages of the snapshot with the Core when the snapshot is first used (on startup).
+        If they all match, the snapshot is used to fill the cache, otherwise it is discarded. Since changes to
+        the other pages can't be ruled out, pages from the snapshot are read again before they are written.
+        """
+        self._snapshot_verified = True
+        if self._snapshot is None:
+            return
+        snapshot_pages = {}  # type: Dict[int, bytearray]
+        for page in range(self._pages):
+            page_data = self._snapshot.load(page)
+            if page_data is not None:
+                snapshot_pages[page] = page_data
+        if not snapshot_pages:
+            return
 
-        if page not in self._cache:
-            self._cache[page] = _read_page()
-        return copy.copy(self._cache[page])
+        # Page 0 contains the module configuration, so it's always checked
+        samples = [page for page in snapshot_pages if page != 0]
+        samples = random.sample(samples, min(MemoryFile.SNAPSHOT_SAMPLES, len(samples)))
+        if 0 in snapshot_pages:
+            samples.append(0)
+        core_pages = self._read_pages(sorted(samples))
+
+        changed_pages = [page for page in samples if core_pages[page] != snapshot_pages[page]]
+        if changed_pages:
+            logger.info('MEMORY.{0}: Snapshot outdated (changed pages: {1}), discarding'.format(self.type, sorted(changed_pages)))
+            self._snapshot.invalidate()
+        else:
+            logger.info('MEMORY.{0}: Snapshot verified, reusing {1} pages'.format(self.type, len(snapshot_pages)))
+            for page, page_data in snapshot_pages.items():
+                if page not in self._cache:
+                    self._cache[page] = page_data
+                    self._unverified_pages.add(page)
+        self._cache_pages(core_pages)
 
     def write_page(self, page, data):  # type: (int, bytearray) -> None
-        cached_data = None
-        if self.type == MemoryTypes.EEPROM:
-            cached_data = self._cache.get(page)
-
-        for i in range(self._page_length // MemoryFile.WRITE_CHUNK_SIZE):
-            start = i * MemoryFile.WRITE_CHUNK_SIZE
-            cache_chunk = None
-            if cached_data is not None:
-                cache_chunk = cached_data[start:start + MemoryFile.WRITE_CHUNK_SIZE]
-            data_chunk = data[start:start + MemoryFile.WRITE_CHUNK_SIZE]
-            if data_chunk != cache_chunk:
-                logger.info('MEMORY.{0}: Write P{1} S{2} D[{3}]'.format(self.type, page, start, ' '.join(str(b) for b in data_chunk)))
-                self._core_communicator.do_command(
-                    command=CoreAPI.memory_write(MemoryFile.WRITE_CHUNK_SIZE),
-                    fields={'type': self.type, 'page': page, 'start': start, 'data': data_chunk},
-                    timeout=MemoryFile.WRITE_TIMEOUT
-                )
-                self._dirty = True
+        self.write({MemoryAddress(self.type, page, 0, len(data)): data})
 
-        if self.type == MemoryTypes.EEPROM:
-            self._cache[page] = data
+    @property
+    def dirty(self):  # type: () -> bool
+        return self._dirty
+
+    def expect_activation(self):  # type: () -> None
+        """ Prepares for an activation that will be triggered by this gateway (e.g. via another MemoryFile) """
+        self._dirty = False
+        self._self_activated = True
+        self._activation_event.clear()
 
     def activate(self):  # type: () -> bool
         activated = False
         if self._dirty:
-            self._dirty = False
-            self._self_activated = True
+            self.expect_activation()
             logger.info('MEMORY.{0}: Activate'.format(self.type))
-            self._activation_event.clear()
             self._core_communicator.do_basic_action(action_type=200, action=1, timeout=MemoryFile.ACTIVATE_TIMEOUT)
             self._activation_event.wait(timeout=60.0)
             activated = True
@@ -170,5 +348,8 @@ class MemoryFile(object):
             pages = list(range(self._pages))  # type: List[int]
         else:
             pages = [page]
-        for page in pages:
-            self._cache.pop(page, None)
+        for page_to_invalidate in pages:
+            self._cache.pop(page_to_invalidate, None)
+            self._unverified_pages.discard(page_to_invalidate)
+        if self._snapshot is not None:
+            self._snapshot.invalidate(page)
@@ -20,14 +20,15 @@ import inspect
 import logging
 import ujson as json
 import struct
+from contextlib import contextmanager
 from peewee import DoesNotExist
-from threading import Lock
+from threading import Lock, RLock
 from ioc import INJECTED, Inject
 from master.core.exceptions import InvalidMemoryChecksum
 from master.core.system_value import Temperature
 
 if False:  # MYPY
-    from typing import Any, Dict, List, Optional, Union, Tuple, Callable, Set
+    from typing import Any, Dict, List, Optional, Union, Tuple, Callable, Set, Iterator
     from master.core.basic_action import BasicAction
     from master.core.memory_file import MemoryFile
 
@@ -41,6 +42,7 @@ class MemoryModelDefinition(object):
 
     _cache_fields = {}  # type: Dict[str,Any]
     _cache_addresses = {}  # type: Dict[str,Any]
+    _cache_record_types = {}  # type: Dict[Tuple[str, Tuple[str, ...]], type]
     _cache_lock = Lock()
 
     @Inject
@@ -140,18 +142,101 @@ class MemoryModelDefinition(object):
         return getattr(self, '_{0}'.format(field_name))
 
     def save(self, activate=True):  # type: (bool) -> None
-        for field_name in self._loaded_fields:
-            container = getattr(self, '_{0}'.format(field_name))  # type: Union[MemoryFieldContainer, CompositionContainer]
-            if self._verbose:
-                logger.info('Saving {0}({1}).{2}'.format(
-                    self.__class__.__name__,
-                    '' if self._id is None else self._id,
-                    field_name
-                ))
-            container.save()
+        # All fields are written in a single transaction, so every page is only written once
+        with write_transaction(list(self._memory_files.values())):
+            for field_name in self._loaded_fields:
+                container = getattr(self, '_{0}'.format(field_name))  # type: Union[MemoryFieldContainer, CompositionContainer]
+                if self._verbose:
+                    logger.info('Saving {0}({1}).{2}'.format(
+                        self.__class__.__name__,
+                        '' if self._id is None else self._id,
+                        field_name
+                    ))
+                container.save()
         if activate:
             MemoryActivator.activate()
 
+    @classmethod
+    @Inject
+    def load_many(cls, ids, fields=None, memory_files=INJECTED):
+        # type: (List[Optional[int]], Optional[List[str]], Dict[str, MemoryFile]) -> List[MemoryRecord]
+        """
+        Loads the given fields (or all fields and compositions) of multiple instances at once. All addresses
+        are calculated up front so every page is only read once, and the fields are decoded straight into
+        lightweight, read-only records instead of building containers for every field of every instance.
+        """
+        field_dict = cls._get_field_dict()
+        composite_fields = cls._get_composite_fields()
+        if fields is None:
+            fields = sorted(field_dict.keys()) + sorted(composite_fields.keys())
+        for field_name in fields:
+            if field_name not in field_dict and field_name not in composite_fields:
+                raise ValueError('Unknown field: {0}'.format(field_name))
+        id_field = cls._get_id_field()
+        if id_field is not None:
+            limits = id_field.get_limits()
+            for id in ids:
+                id_field.validate(cls.__name__, id, limits=limits)
+
+        pages = {}  # type: Dict[str, Set[int]]
+        instances = []  # type: List[Tuple[Optional[int], List[Tuple[str, Any, MemoryAddress, Optional[MemoryAddress]]]]]
+        for id in ids:
+            address_cache = cls._get_address_cache(id)
+            entries = []
+            for field_name in fields:
+                checksum_address = None
+                if field_name in field_dict:
+                    field_type = field_dict[field_name]
+                    address = address_cache[field_name]
+                    if field_type._checksum is not None:
+                        checksum_address = field_type._checksum._field.get_address(id)
+                        pages.setdefault(checksum_address.memory_type, set()).add(checksum_address.page)
+                else:
+                    field_type = composite_fields[field_name]
+                    address = field_type._field.get_address(id)
+                pages.setdefault(address.memory_type, set()).add(address.page)
+                entries.append((field_name, field_type, address, checksum_address))
+            instances.append((id, entries))
+        page_data = dict((memory_type, memory_files[memory_type].read_pages(memory_pages))
+                         for memory_type, memory_pages in pages.items())
+
+        def _read(address):  # type: (MemoryAddress) -> bytearray
+            return page_data[address.memory_type][address.page][address.offset:address.offset + address.length]
+
+        record_type = cls._get_record_type(fields)
+        records = []
+        for id, entries in instances:
+            record = record_type()
+            record.id = id
+            for field_name, field_type, address, checksum_address in entries:
+                data = _read(address)
+                if field_name in composite_fields:
+                    composite_value = field_type._field.decode(data)
+                    value = dict((name, getattr(field_type, name).decompose(composite_value))
+                                 for name in field_type.__class__._get_field_names())
+                elif checksum_address is not None and not MemoryChecksumContainer.validate(check=field_type._checksum._check,
+                                                                                             data=data,
+                                                                                             current_checksum=_read(checksum_address),
+                                                                                             field_name=field_name):
+                    value = field_type._checksum._default
+                    if value is None:
+                        raise InvalidMemoryChecksum('The field `{0}` fails its checksum'.format(field_name))
+                else:
+                    value = field_type.decode(data)
+                setattr(record, field_name, value)
+            records.append(record)
+        return records
+
+    @classmethod
+    def _get_record_type(cls, fields):  # type: (List[str]) -> type
+        key = (cls.__name__, tuple(fields))
+        if key not in MemoryModelDefinition._cache_record_types:
+            with MemoryModelDefinition._cache_lock:
+                MemoryModelDefinition._cache_record_types[key] = type('{0}Record'.format(cls.__name__),
+                                                                      (MemoryRecord,),
+                                                                      {'__slots__': tuple(fields)})
+        return MemoryModelDefinition._cache_record_types[key]
+
     @classmethod
     def deserialize(cls, data):  # type: (Dict[str, Any]) -> MemoryModelDefinition
         instance_id = data['id']
@@ -238,17 +323,91 @@ class MemoryModelDefinition(object):
         return cache
 
 
+@contextmanager
+def write_transaction(memory_files):  # type: (List[MemoryFile]) -> Iterator[None]
+    """ Starts a write transaction on all given memory files """
+    if not memory_files:
+        yield
+        return
+    with memory_files[0].write_transaction():
+        with write_transaction(memory_files[1:]):
+            yield
+
+
+@contextmanager
+@Inject
+def memory_transaction(memory_files=INJECTED):  # type: (Dict[str, MemoryFile]) -> Iterator[None]
+    """
+    Groups all memory changes, over all memory types. The writes are buffered per page and
+    all activations are deferred to a single activation once the (outer) transaction ends.
+    """
+    with MemoryActivator._transaction_lock:
+        MemoryActivator._transaction_depth += 1
+        try:
+            with write_transaction(list(memory_files.values())):
+                yield
+        except Exception:
+            if MemoryActivator._transaction_depth == 1:
+                MemoryActivator._activation_pending = False
+            raise
+        finally:
+            MemoryActivator._transaction_depth -= 1
+        if MemoryActivator._transaction_depth == 0 and MemoryActivator._activation_pending:
+            MemoryActivator._activation_pending = False
+            MemoryActivator.activate()
+
+
 class MemoryActivator(object):
     """ Holds a static method to activate memory """
+
+    _transaction_lock = RLock()
+    _transaction_depth = 0
+    _activation_pending = False
+
     @staticmethod
     @Inject
     def activate(memory_files=INJECTED):  # type: (Dict[str, MemoryFile]) -> None
-        # There's only one call to activate all memory devices at once. Once a memory
-        # device is activated, the others will also be activated, so no need to activate
-        # multiple times
-        for memory_file in memory_files.values():
-            if memory_file.activate():
-                break
+        with MemoryActivator._transaction_lock:
+            if MemoryActivator._transaction_depth > 0:
+                # Inside a `memory_transaction`, activation happens when the transaction ends
+                MemoryActivator._activation_pending = True
+                return
+            # There's only one call to activate all memory devices at once. Once a memory
+            # device is activated, the others will also be activated, so they only need to
+            # expect the activation.
+            dirty_files = [memory_file for memory_file in memory_files.values() if memory_file.dirty]
+            if not dirty_files:
+                logger.info('Ignore activation, not dirty')
+                return
+            for memory_file in memory_files.values():
+                if memory_file is not dirty_files[0]:
+                    memory_file.expect_activation()
+            dirty_files[0].activate()
+
+
+class MemoryRecord(object):
+    """
+    Read-only snapshot of (some) fields of a model instance, as loaded by `MemoryModelDefinition.load_many`
+    """
+
+    __slots__ = ('id',)
+
+    def __init__(self):
+        self.id = None  # type: Optional[int]
+
+    def __str__(self):
+        return str(json.dumps(self.serialize(), indent=4))
+
+    def __repr__(self):
+        return str(self)
+
+    def serialize(self):  # type: () -> Dict[str, Any]
+        data = {}
+        if self.id is not None:
+            data['id'] = self.id
+        for field_name in self.__slots__:
+            data[field_name] = getattr(self, field_name)
+        return data
 
 
 class GlobalMemoryModelDefinition(MemoryModelDefinition):
@@ -609,19 +768,21 @@ class IdField(object):
         elif not callable(limits):
             raise ValueError('Limits should be generated at runtime if a field is given')
 
-    @Inject
-    def validate(self, class_name, id):  # type: (str, Optional[int]) -> None
+    def get_limits(self):  # type: () -> Tuple[int, int]
         if self._field is None:
             if not isinstance(self._limits, tuple):
                 raise RuntimeError('Expected a fixed limit')
-            limits = self._limits
-        else:
-            if not callable(self._limits):
-                raise RuntimeError('Expected a limit generator')
-            container = MemoryFieldContainer(name='id',
-                                             memory_field=self._field,
-                                             memory_address=self._field.get_address(None))
-            limits = self._limits(container.decode())
+            return self._limits
+        if not callable(self._limits):
+            raise RuntimeError('Expected a limit generator')
+        container = MemoryFieldContainer(name='id',
+                                         memory_field=self._field,
+                                         memory_address=self._field.get_address(None))
+        return self._limits(container.decode())
+
+    def validate(self, class_name, id, limits=None):  # type: (str, Optional[int], Optional[Tuple[int, int]]) -> None
+        if limits is None:
+            limits = self.get_limits()
         if id is None or not (limits[0] <= id <= limits[1]):
             if limits[0] > limits[1]:
                 limit_info = 'No records available.'
@@ -710,11 +871,18 @@ class MemoryChecksumContainer(object):
         current_checksum = self._field_container._data
         if current_checksum is None:
             raise RuntimeError('No data was read from memory')
+        return MemoryChecksumContainer.validate(check=self._check,
+                                                data=data,
+                                                current_checksum=current_checksum,
+                                                field_name=self._field_container._field_name)
+
+    @staticmethod
+    def validate(check, data, current_checksum, field_name):  # type: (str, bytearray, bytearray, str) -> bool
         if set(current_checksum) | set(data) in [{0}, {255}]:
             return True  # Ignore uninitialized data
-        expected_checksum = self._calculate(data)
+        expected_checksum = MemoryChecksumContainer.calculate(check, data)
         if expected_checksum != current_checksum:
-            logger.warning('Invalid memory checksum for `{0}`'.format(self._field_container._field_name))
+            logger.warning('Invalid memory checksum for `{0}`'.format(field_name))
             return False
         return True
 
@@ -726,7 +894,11 @@ class MemoryChecksumContainer(object):
             self._field_container.save()
 
     def _calculate(self, data):  # type: (bytearray) -> bytearray
-        if self._check == MemoryChecksum.Types.INVERTED:
+        return MemoryChecksumContainer.calculate(self._check, data)
+
+    @staticmethod
+    def calculate(check, data):  # type: (str, bytearray) -> bytearray
+        if check == MemoryChecksum.Types.INVERTED:
             return bytearray([value ^ 255 for value in data])
         raise RuntimeError('Unknown checksum type')
 
@@ -0,0 +1,116 @@
+# Copyright (C) 2021 OpenMotics BV
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Memory mapped snapshot of master memory
+"""
+from __future__ import absolute_import
+
+import logging
+import mmap
+import os
+import struct
+import zlib
+from threading import Lock
+
+if False:  # MYPY
+    from typing import Optional
+
+logger = logging.getLogger('openmotics')
+
+
+class MemorySnapshot(object):
+    """
+    Memory mapped on-disk copy of memory pages.
+
+    The file starts with a header containing a generation marker. Every page record stores the generation it was
+    written in and a checksum of its data. A page is only valid if its generation matches the header and the checksum
+    is correct, so all pages can be invalidated at once by incrementing the generation.
+    """
+
+    MAGIC = b'OMMS'
+    VERSION = 1
+    HEADER = struct.Struct('>4sBxxxI')  # Magic, version, padding, generation
+    RECORD_HEADER = struct.Struct('>II')  # Generation, CRC32
+
+    def __init__(self, path, pages, page_length):  # type: (str, int, int) -> None
+        self._pages = pages
+        self._page_length = page_length
+        self._record_length = MemorySnapshot.RECORD_HEADER.size + page_length
+        self._lock = Lock()
+        size = MemorySnapshot.HEADER.size + pages * self._record_length
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+            self._mmap = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        magic, version, generation = MemorySnapshot.HEADER.unpack_from(self._mmap, 0)
+        if magic != MemorySnapshot.MAGIC or version != MemorySnapshot.VERSION or generation == 0:
+            logger.info('SNAPSHOT: Initializing {0}'.format(path))
+            self._generation = 1
+            self._write_header()
+        else:
+            self._generation = generation
+
+    def load(self, page):  # type: (int) -> Optional[bytearray]
+        """ Returns the page data, or None if the page is not (validly) present in the snapshot """
+        offset = self._get_offset(page)
+        with self._lock:
+            generation, crc = MemorySnapshot.RECORD_HEADER.unpack_from(self._mmap, offset)
+            if generation != self._generation:
+                return None
+            start = offset + MemorySnapshot.RECORD_HEADER.size
+            data = self._mmap[start:start + self._page_length]
+        if zlib.crc32(data) & 0xffffffff != crc:
+            logger.warning('SNAPSHOT: Checksum mismatch on page {0}'.format(page))
+            return None
+        return bytearray(data)
+
+    def store(self, page, data):  # type: (int, bytearray) -> None
+        if len(data) != self._page_length:
+            logger.warning('SNAPSHOT: Not storing page {0}, unexpected length {1}'.format(page, len(data)))
+            self.invalidate(page)
+            return
+        offset = self._get_offset(page)
+        start = offset + MemorySnapshot.RECORD_HEADER.size
+        raw_data = bytes(data)
+        with self._lock:
+            # Data first, so a partially written record can never carry a valid generation and checksum
+            self._mmap[start:start + self._page_length] = raw_data
+            self._mmap[offset:start] = MemorySnapshot.RECORD_HEADER.pack(self._generation, zlib.crc32(raw_data) & 0xffffffff)
+
+    def invalidate(self, page=None):  # type: (Optional[int]) -> None
+        """ Invalidates a single page, or all pages when no page is given """
+        with self._lock:
+            if page is None:
+                self._generation = self._generation % 0xffffffff + 1
+                self._write_header()
+            else:
+                offset = self._get_offset(page)
+                self._mmap[offset:offset + MemorySnapshot.RECORD_HEADER.size] = MemorySnapshot.RECORD_HEADER.pack(0, 0)
+
+    def _write_header(self):  # type: () -> None
+        self._mmap[0:MemorySnapshot.HEADER.size] = MemorySnapshot.HEADER.pack(MemorySnapshot.MAGIC, MemorySnapshot.VERSION, self._generation)
+        # Make sure an invalidation survives a power loss
+        self._mmap.flush()
+
+    def _get_offset(self, page):  # type: (int) -> int
+        if not 0 <= page < self._pages:
+            raise ValueError('Page {0} out of range'.format(page))
+        return MemorySnapshot.HEADER.size + page * self._record_length
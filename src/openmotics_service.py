@@ -47,6 +47,7 @@ if False:  # MYPY
     from gateway.maintenance_controller import MaintenanceController
     from gateway.metrics_collector import MetricsCollector
     from gateway.metrics_controller import MetricsController
+    from gateway.metrics_store import MetricsStore
     from gateway.observer import Observer
     from gateway.pulse_counter_controller import PulseCounterController
     from gateway.scheduling import SchedulingController
@@ -74,6 +75,7 @@ class OpenmoticsService(object):
     @Inject
     def fix_dependencies(
                 metrics_controller=INJECTED,  # type: MetricsController
+                metrics_store=INJECTED,  # type: MetricsStore
                 message_client=INJECTED,  # type: MessageClient
                 web_interface=INJECTED,  # type: WebInterface
                 scheduling_controller=INJECTED,  # type: SchedulingController
@@ -107,9 +109,11 @@ class OpenmoticsService(object):
         web_interface.set_plugin_controller(plugin_controller)
         web_interface.set_metrics_collector(metrics_collector)
         web_interface.set_metrics_controller(metrics_controller)
+        web_interface.set_metrics_store(metrics_store)
         gateway_api.set_plugin_controller(plugin_controller)
-        metrics_controller.add_receiver(metrics_controller.receiver)
-        metrics_controller.add_receiver(web_interface.distribute_metric)
+        metrics_controller.add_receiver(metrics_controller.receive_batch)
+        metrics_controller.add_receiver(web_interface.distribute_metrics)
+        metrics_controller.add_receiver(metrics_store.receive_batch)
         scheduling_controller.set_webinterface(web_interface)
         metrics_collector.set_controllers(metrics_controller, plugin_controller)
         plugin_controller.set_webservice(web_service)
@@ -127,6 +131,7 @@ class OpenmoticsService(object):
                 power_communicator=INJECTED,  # type: PowerCommunicator
                 power_serial=INJECTED,  # type: RS485
                 metrics_controller=INJECTED,  # type: MetricsController
+                metrics_store=INJECTED,  # type: MetricsStore
                 passthrough_service=INJECTED,  # type: PassthroughService
                 scheduling_controller=INJECTED,  # type: SchedulingController
                 metrics_collector=INJECTED,  # type: MetricsCollector
@@ -220,6 +225,7 @@ class OpenmoticsService(object):
             maintenance_controller.stop()
             metrics_collector.stop()
             metrics_controller.stop()
+            metrics_store.close()
             user_controller.stop()
             ventilation_controller.start()
             thermostat_controller.stop()
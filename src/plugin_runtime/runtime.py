@@ -21,6 +21,7 @@ from plugin_runtime.interfaces import has_interface
 from plugin_runtime.utils import get_plugin_class, check_plugin, get_special_methods
 from plugin_runtime.web import WebInterfaceDispatcher
 from six.moves.configparser import ConfigParser, NoSectionError, NoOptionError
+from six.moves.queue import Empty, Queue
 from toolbox import PluginIPCReader, PluginIPCWriter, Toolbox
 
 logger = logging.getLogger('openmotics')
@@ -40,6 +41,9 @@ class PluginRuntime(object):
                                     'receive_events': [1],
                                     'background_task': [1],
                                     'on_remove': [1]}
+    # Commands that are handled right away, so their responses can be buffered while they're processed
+    NON_BLOCKING_ACTIONS = ['input_status', 'output_status', 'shutter_status', 'thermostat_status',
+                            'thermostat_group_status', 'ventilation_status', 'distribute_metrics']
 
     def __init__(self, path):
         # type: (str) -> None
@@ -65,6 +69,7 @@ class PluginRuntime(object):
         self._metric_receivers = []  # type: List[Any]
 
         self._plugin = None
+        self._request_queue = Queue()  # type: Queue[Dict[str,Any]]
         self._writer = PluginIPCWriter(os.fdopen(sys.stdout.fileno(), 'wb', 0))
         self._reader = PluginIPCReader(os.fdopen(sys.stdin.fileno(), 'rb', 0),
                                        self._writer.log_exception)
@@ -75,7 +80,8 @@ class PluginRuntime(object):
             http_port = int(config.get('OpenMotics', 'http_port'))
         except (NoSectionError, NoOptionError):
             http_port = 80
-        self._webinterface = WebInterfaceDispatcher(self._writer.log, port=http_port)
+        self._webinterface = WebInterfaceDispatcher(self._writer.log, port=http_port,
+                                                    socket_path=constants.get_api_socket_file())
 
     def _init_plugin(self):
         # type: () -> None
@@ -168,64 +174,90 @@ class PluginRuntime(object):
     def process_stdin(self):
         # type: () -> None
         self._reader.start()
+        # Web requests are handled separately, so a slow request doesn't hold back e.g. status events
+        request_thread = BaseThread(name='pluginrequest', target=self._process_requests)
+        request_thread.daemon = True
+        request_thread.start()
         while not self._stopped:
             command = self._reader.get(block=True)
             if command is None:
                 continue
-
-            action = command['action']
-            action_version = command['action_version']
-            response = {'cid': command['cid'], 'action': action}
+            if command['action'] == 'request':
+                self._request_queue.put(command)
+                continue
+            if command['action'] not in PluginRuntime.NON_BLOCKING_ACTIONS:
+                # Buffered responses shouldn't wait for a command that might take a while (e.g. collect_metrics)
+                self._writer.flush()
+            self._process_command(command)
+            if self._reader.qsize() == 0:
+                # Responses are buffered while commands are waiting, and written together when idle
+                self._writer.flush()
+        self._writer.flush()
+
+    def _process_requests(self):
+        # type: () -> None
+        while not self._stopped:
             try:
-                ret = None
-                if action == 'start':
-                    ret = self._handle_start()
-                elif action == 'stop':
-                    ret = self._handle_stop()
-                elif action == 'input_status':
-                    ret = self._handle_input_status(command['event'])
-                elif action == 'output_status':
-                    # v1 = state, v2 = event
-                    if action_version == 1:
-                        ret = self._handle_output_status(command['status'], data_type='status')
-                    else:
-                        ret = self._handle_output_status(command['event'], data_type='event')
-                elif action == 'ventilation_status':
-                    ret = self._handle_ventilation_status(command['event'])
-                elif action == 'thermostat_status':
-                    ret = self._handle_thermostat_status(command['event'])
-                elif action == 'thermostat_group_status':
-                    ret = self._handle_thermostat_group_status(command['event'])
-                elif action == 'shutter_status':
-                    # v1 = state as list, v2 = state as dict, v3 = event
-                    if action_version == 1:
-                        ret = self._handle_shutter_status(command['status'], data_type='status')
-                    elif action_version == 2:
-                        ret = self._handle_shutter_status(command['status'], data_type='status_dict')
-                    else:
-                        ret = self._handle_shutter_status(command['event'], data_type='event')
-                elif action == 'receive_events':
-                    ret = self._handle_receive_events(command['code'])
-                elif action == 'get_metric_definitions':
-                    ret = self._handle_get_metric_definitions()
-                elif action == 'collect_metrics':
-                    ret = self._handle_collect_metrics(command['name'])
-                elif action == 'distribute_metrics':
-                    ret = self._handle_distribute_metrics(command['name'], command['metrics'])
-                elif action == 'request':
-                    ret = self._handle_request(command['method'], command['args'], command['kwargs'])
-                elif action == 'remove_callback':
-                    ret = self._handle_remove_callback()
-                elif action == 'ping':
-                    pass  # noop
+                command = self._request_queue.get(block=True, timeout=1)
+            except Empty:
+                continue
+            self._process_command(command, flush=True)
+
+    def _process_command(self, command, flush=False):
+        # type: (Dict[str,Any], bool) -> None
+        action = command['action']
+        action_version = command['action_version']
+        response = {'cid': command['cid'], 'action': action}
+        try:
+            ret = None
+            if action == 'start':
+                ret = self._handle_start()
+            elif action == 'stop':
+                ret = self._handle_stop()
+            elif action == 'input_status':
+                ret = self._handle_input_status(command['event'])
+            elif action == 'output_status':
+                # v1 = state, v2 = event
+                if action_version == 1:
+                    ret = self._handle_output_status(command['status'], data_type='status')
+                else:
+                    ret = self._handle_output_status(command['event'], data_type='event')
+            elif action == 'ventilation_status':
+                ret = self._handle_ventilation_status(command['event'])
+            elif action == 'thermostat_status':
+                ret = self._handle_thermostat_status(command['event'])
+            elif action == 'thermostat_group_status':
+                ret = self._handle_thermostat_group_status(command['event'])
+            elif action == 'shutter_status':
+                # v1 = state as list, v2 = state as dict, v3 = event
+                if action_version == 1:
+                    ret = self._handle_shutter_status(command['status'], data_type='status')
+                elif action_version == 2:
+                    ret = self._handle_shutter_status(command['status'], data_type='status_dict')
                 else:
-                    raise RuntimeError('Unknown action: {0}'.format(action))
+                    ret = self._handle_shutter_status(command['event'], data_type='event')
+            elif action == 'receive_events':
+                ret = self._handle_receive_events(command['code'])
+            elif action == 'get_metric_definitions':
+                ret = self._handle_get_metric_definitions()
+            elif action == 'collect_metrics':
+                ret = self._handle_collect_metrics(command['name'])
+            elif action == 'distribute_metrics':
+                ret = self._handle_distribute_metrics(command['name'], command['metrics'])
+            elif action == 'request':
+                ret = self._handle_request(command['method'], command['args'], command['kwargs'])
+            elif action == 'remove_callback':
+                ret = self._handle_remove_callback()
+            elif action == 'ping':
+                pass  # noop
+            else:
+                raise RuntimeError('Unknown action: {0}'.format(action))
 
-                if ret is not None:
-                    response.update(ret)
-            except Exception as exception:
-                response['_exception'] = str(exception)
-            self._writer.write(response)
+            if ret is not None:
+                response.update(ret)
+        except Exception as exception:
+            response['_exception'] = str(exception)
+        self._writer.write(response, flush=flush)
 
     def _handle_start(self):
         # type: () -> Dict[str,Any]
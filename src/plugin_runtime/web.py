@@ -1,6 +1,11 @@
 from __future__ import absolute_import
+import os
 import re
+import socket
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connection import HTTPConnection
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool
 
 try:
     import ujson as json
@@ -35,15 +40,65 @@ def _load_webinterface():
     return calls
 
 
+class UnixSocketConnection(HTTPConnection):
+    """ A HTTP connection over a unix domain socket """
+
+    def __init__(self, socket_path, timeout=None):
+        HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self._socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if isinstance(self.timeout, (int, float)):
+            sock.settimeout(self.timeout)
+        sock.connect(self._socket_path)
+        self.sock = sock
+
+
+class UnixSocketConnectionPool(HTTPConnectionPool):
+    def __init__(self, socket_path, maxsize):
+        HTTPConnectionPool.__init__(self, 'localhost', maxsize=maxsize)
+        self._socket_path = socket_path
+
+    def _new_conn(self):
+        return UnixSocketConnection(self._socket_path, timeout=self.timeout.connect_timeout)
+
+
+class UnixSocketAdapter(HTTPAdapter):
+    """ Sends all requests over (a pool of keep-alive connections on) a unix domain socket """
+
+    def __init__(self, socket_path, maxsize):
+        super(UnixSocketAdapter, self).__init__()
+        self._pool = UnixSocketConnectionPool(socket_path, maxsize)
+
+    def get_connection(self, url, proxies=None):
+        return self._pool
+
+    def get_connection_with_tls_context(self, request, verify, proxies=None, cert=None):
+        return self._pool
+
+    def close(self):
+        super(UnixSocketAdapter, self).close()
+        self._pool.close()
+
+
 class WebInterfaceDispatcher(object):
     # TODO: Use SDK in the future
 
-    def __init__(self, logger, hostname='localhost', port=80):
+    POOL_SIZE = 4  # Plugins mostly call from their main and background threads
+
+    def __init__(self, logger, hostname='localhost', port=80, socket_path=None):
         self.__logger = logger
         self.__hostname = hostname
         self.__port = port
+        self.__socket_path = socket_path
         self.__warned = False
         self.__available_calls = _load_webinterface()
+        # Connections are kept alive and reused, instead of a new connection for every call
+        self.__session = requests.Session()
+        self.__session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=WebInterfaceDispatcher.POOL_SIZE))
+        if socket_path is not None:
+            self.__session.mount('http+unix://', UnixSocketAdapter(socket_path, WebInterfaceDispatcher.POOL_SIZE))
 
     def __getattr__(self, attribute):
         if attribute in self.__available_calls:
@@ -59,6 +114,32 @@ class WebInterfaceDispatcher(object):
             self.__logger('[W] - Plugins should use keyword arguments for API calls')
             self.__warned = True
 
+    def _get_url(self, name):
+        # The api socket is only available while the gateway's webserver is running
+        if self.__socket_path is not None and os.path.exists(self.__socket_path):
+            return 'http+unix://localhost/{0}'.format(name)
+        return 'http://{0}:{1}/{2}'.format(self.__hostname, self.__port, name)
+
+    def batch(self, calls):
+        """
+        Executes multiple API calls in a single round trip.
+
+        :param calls: list of (name, kwargs) tuples, e.g. [('get_output_status', {})]
+        :returns: the response of the `batch_calls` API call, containing the response of every call under 'responses'
+        """
+        for name, _ in calls:
+            if name not in self.__available_calls:
+                raise AttributeError('The call \'{0}\' does not exist'.format(name))
+        try:
+            response = self.__session.post(self._get_url('batch_calls'),
+                                           data={'calls': json.dumps([{'name': name, 'params': kwargs}
+                                                                      for name, kwargs in calls])},
+                                           timeout=30.0)
+            return response.text
+        except Exception:
+            return json.dumps({'success': False,
+                               'msg': 'Call temporarily unavailable'})
+
     def get_wrapper(self, name):
         params = self.__available_calls[name]
 
@@ -81,9 +162,9 @@ class WebInterfaceDispatcher(object):
                     kwargs[arg] = 'None'
             # 4. Perform the http call
             try:
-                response = requests.get('http://{0}:{1}/{2}'.format(self.__hostname, self.__port, name),
-                                        params=kwargs,
-                                        timeout=30.0)
+                response = self.__session.get(self._get_url(name),
+                                              params=kwargs,
+                                              timeout=30.0)
                 return response.text
             except Exception:
                 return json.dumps({'success': False,
@@ -16,6 +16,7 @@
 
 from __future__ import absolute_import
 
+import copy
 import logging
 import os
 import pkgutil
@@ -27,12 +28,15 @@ import six
 
 import constants
 from gateway.events import GatewayEvent
+from gateway.metrics_record import MetricRecord
 from gateway.models import Config, Plugin
 from ioc import INJECTED, Inject, Injectable, Singleton
 from plugins.runner import PluginRunner, RunnerWatchdog
+from toolbox import EncodedPayload
 
 if False:  # MYPY
-    from typing import Dict, List, Optional
+    from typing import Any, Callable, Dict, List, Optional, Tuple
+    from gateway.metrics_controller import MetricsController
     from gateway.output_controller import OutputController
     from gateway.shutter_controller import ShutterController
     from gateway.webservice import WebInterface
@@ -69,9 +73,13 @@ class PluginController(object):
         self._dependencies_timer = None  # type: Optional[Timer]
         self._dependencies_lock = Lock()
 
-        self._metrics_controller = None
+        self._metrics_controller = None  # type: Optional[MetricsController]
         self._metrics_collector = None
         self._web_service = None
+        # (source, type) > (rate key, [(runner, receiver name)]), filled as metrics pass by
+        self._metric_receiver_index = None  # type: Optional[Dict[Tuple[str, str], Tuple[str, List[Tuple[PluginRunner, str]]]]]
+        self._metric_receiver_statistics = {}  # type: Dict[str, Dict[str, Dict[str, int]]]
+        self._metric_receiver_statistics_lock = Lock()
 
     def start(self):
         # type: () -> None
@@ -118,6 +126,7 @@ class PluginController(object):
             return
         if state == PluginRunner.State.RUNNING:
             PluginController._update_orm(runner.name, runner.version)
+        self._metric_receiver_index = None
         with self._dependencies_lock:
             if self._dependencies_timer is not None:
                 self._dependencies_timer.cancel()
@@ -205,6 +214,9 @@ class PluginController(object):
         self._logs.pop(runner_name, None)
         self._runners.pop(runner_name, None)
         self._runner_watchdogs.pop(runner_name, None)
+        with self._metric_receiver_statistics_lock:
+            self._metric_receiver_statistics.pop(runner_name, None)
+        self._metric_receiver_index = None
 
     def _update_dependencies(self):
         """ When a runner is added/removed, this call updates all code that needs to know about plugins """
@@ -214,6 +226,7 @@ class PluginController(object):
             self._metrics_collector.set_plugin_intervals(self._get_metric_receivers())
         if self._metrics_controller is not None:
             self._metrics_controller.set_plugin_definitions(self._get_metric_definitions())
+        self._metric_receiver_index = None  # The receivers and/or the definitions they filter on changed
 
     @staticmethod
     def _update_orm(name, version):
@@ -392,34 +405,51 @@ class PluginController(object):
                 yield runner
 
     def process_observer_event(self, event):
+        # type: (GatewayEvent) -> None
+        """
+        Sends a status change to all plugins. Each (versioned) payload is only built and encoded once,
+        and only when at least one running plugin subscribes to that version.
+        """
+        shutter_states = []  # type: List[Dict[str, Any]]
+
+        def _get_output_states():
+            return [(state.id, state.dimmer) for state in self._output_controller.get_output_statuses() if state.status]
+
+        def _get_shutter_states():
+            if not shutter_states:
+                shutter_states.append(self._shuttercontroller.get_states())
+            return shutter_states[0]
+
+        payloads = []  # type: List[Tuple[str, int, Callable[[], Dict[str, Any]]]]
         if event.type == GatewayEvent.Types.INPUT_CHANGE:
-            # Should be called when the input status changes, notifies all plugins.
-            for runner in self._iter_running_runners():
-                runner.process_input_status(event)
-        if event.type == GatewayEvent.Types.OUTPUT_CHANGE:
+            payloads = [('input_status', 1, lambda: {'event': event.serialize()})]
+        elif event.type == GatewayEvent.Types.OUTPUT_CHANGE:
             # TODO: deprecate old versions that use state and move to events
-            states = [(state.id, state.dimmer) for state in self._output_controller.get_output_statuses() if state.status]
-            for runner in self._iter_running_runners():
-                runner.process_output_status(data=states, action_version=1)  # send states as action version 1
-                runner.process_output_status(data=event, action_version=2)   # send event as action version 2
-        if event.type == GatewayEvent.Types.SHUTTER_CHANGE:
+            payloads = [('output_status', 1, lambda: {'status': _get_output_states()}),
+                        ('output_status', 2, lambda: {'event': event.serialize()})]
+        elif event.type == GatewayEvent.Types.SHUTTER_CHANGE:
             # TODO: deprecate old versions that use state and move to events
-            states = self._shuttercontroller.get_states()
-            status = states['status']
-            details = states['detail']
-            for runner in self._iter_running_runners():
-                runner.process_shutter_status(data=status, action_version=1)  # send states as action version 1
-                runner.process_shutter_status(data=(status, details), action_version=2)  # send event as action version 2
-                runner.process_shutter_status(data=event, action_version=3)  # send event as action version 3
-        if event.type == GatewayEvent.Types.VENTILATION_CHANGE:
-            for runner in self._iter_running_runners():
-                runner.process_ventilation_status(data=event)
-        if event.type == GatewayEvent.Types.THERMOSTAT_CHANGE:
-            for runner in self._iter_running_runners():
-                runner.process_thermostat_status(data=event)
-        if event.type == GatewayEvent.Types.THERMOSTAT_GROUP_CHANGE:
-            for runner in self._iter_running_runners():
-                runner.process_thermostat_group_status(data=event)
+            payloads = [('shutter_status', 1, lambda: {'status': _get_shutter_states()['status']}),
+                        ('shutter_status', 2, lambda: {'status': {'status': _get_shutter_states()['status'],
+                                                                  'detail': _get_shutter_states()['detail']}}),
+                        ('shutter_status', 3, lambda: {'event': event.serialize()})]
+        elif event.type == GatewayEvent.Types.VENTILATION_CHANGE:
+            payloads = [('ventilation_status', 1, lambda: {'event': event.serialize()})]
+        elif event.type == GatewayEvent.Types.THERMOSTAT_CHANGE:
+            payloads = [('thermostat_status', 1, lambda: {'event': event.serialize()})]
+        elif event.type == GatewayEvent.Types.THERMOSTAT_GROUP_CHANGE:
+            payloads = [('thermostat_group_status', 1, lambda: {'event': event.serialize()})]
+        if not payloads:
+            return
+
+        runners = list(self._iter_running_runners())
+        for action, action_version, build_payload in payloads:
+            receivers = [runner for runner in runners if runner.has_receiver(action, action_version)]
+            if not receivers:
+                continue
+            payload = EncodedPayload(build_payload())
+            for runner in receivers:
+                runner.process_status(action, payload, action_version=action_version)
 
     def process_event(self, code):
         """ Should be called when an event is triggered, notifies all plugins. """
@@ -444,29 +474,57 @@ class PluginController(object):
     def distribute_metrics(self, metrics):
         """ Enqueues all metrics in a separate queue per plugin """
         rates = {'total': 0}
-        rate_keys = []
-        # Preprocess rate keys
+        index = self._metric_receiver_index
+        if index is None:
+            index = self._metric_receiver_index = {}
+        deliveries = {}  # type: Dict[Tuple[str, str], Tuple[PluginRunner, List[Dict[str, Any]]]]
         for metric in metrics:
-            rate_key = '{0}.{1}'.format(metric['source'].lower(), metric['type'].lower())
-            if rate_key not in rates:
-                rates[rate_key] = 0
-            rate_keys.append(rate_key)
-        # Distribute
+            key = (metric['source'], metric['type'])
+            route = index.get(key)
+            if route is None:
+                route = index[key] = self._route_metric(*key)
+            rate_key, receivers = route
+            rates.setdefault(rate_key, 0)
+            if not receivers:
+                continue
+            metric = MetricRecord.as_dict(metric)  # Plugins receive the dict form
+            rates[rate_key] += len(receivers)
+            rates['total'] += len(receivers)
+            for runner, receiver_name in receivers:
+                deliveries.setdefault((runner.name, receiver_name), (runner, []))[1].append(metric)
+        for (runner_name, receiver_name), (runner, receiver_metrics) in six.iteritems(deliveries):
+            try:
+                queued = runner.distribute_metrics(receiver_name, receiver_metrics)
+            except Exception as ex:
+                queued = False
+                self.log(runner_name, 'Exception while distributing metrics', ex, traceback.format_exc())
+            with self._metric_receiver_statistics_lock:
+                statistics = self._metric_receiver_statistics.setdefault(runner_name, {}).setdefault(receiver_name, {'delivered': 0,
+                                                                                                                  'dropped': 0})
+                statistics['delivered' if queued else 'dropped'] += len(receiver_metrics)
+        return rates
+
+    def _route_metric(self, source, metric_type):
+        # type: (str, str) -> Tuple[str, List[Tuple[PluginRunner, str]]]
+        """ Finds the plugin metric receivers for a given source and type """
+        assert self._metrics_controller, 'Metrics are distributed by the metrics controller'
+        receivers = []
         for runner in self._iter_running_runners():
             for receiver in runner.get_metric_receivers():
-                receiver_metrics = []
                 try:
                     sources = self._metrics_controller.get_filter('source', receiver['source'])
                     metric_types = self._metrics_controller.get_filter('metric_type', receiver['metric_type'])
-                    for index, metric in enumerate(metrics):
-                        if metric['source'] in sources and metric['type'] in metric_types:
-                            receiver_metrics.append(metric)
-                            rates[rate_keys[index]] += 1
-                            rates['total'] += 1
-                    runner.distribute_metrics(receiver['name'], receiver_metrics)
+                    if source in sources and metric_type in metric_types:
+                        receivers.append((runner, receiver['name']))
                 except Exception as ex:
-                    self.log(runner.name, 'Exception while distributing metrics', ex, traceback.format_exc())
-        return rates
+                    self.log(runner.name, 'Exception while routing metrics', ex, traceback.format_exc())
+        return '{0}.{1}'.format(source.lower(), metric_type.lower()), receivers
+
+    def get_metric_receiver_statistics(self):
+        # type: () -> Dict[str, Dict[str, Dict[str, int]]]
+        """ Returns (a copy of) the amount of delivered and dropped metrics, per plugin and metric receiver """
+        with self._metric_receiver_statistics_lock:
+            return copy.deepcopy(self._metric_receiver_statistics)
 
     def _get_cherrypy_mounts(self):
         mounts = []
@@ -6,21 +6,22 @@ import subprocess
 import sys
 import time
 import traceback
-from threading import Lock, Thread
+from itertools import count
+from threading import Event, Lock, Thread
 
 import cherrypy
 import six
 import ujson as json
-from six.moves.queue import Empty, Full, Queue
+from six.moves.queue import Empty, Full, PriorityQueue
 
 import constants
 
 from gateway.daemon_thread import BaseThread
 from platform_utils import System
-from toolbox import PluginIPCReader, PluginIPCWriter
+from toolbox import EncodedPayload, PluginIPCReader, PluginIPCWriter
 
 if False:  # MYPY
-    from typing import Any, Dict, Callable, List, Optional
+    from typing import Any, Dict, Callable, List, Optional, Tuple
     from gateway.webservice import WebInterface
 
 logger_ = logging.getLogger('openmotics')
@@ -61,11 +62,44 @@ class Service(object):
             return contents.encode()
 
 
+class CommandFuture(object):
+    """ The pending response of a command that was sent to the plugin """
+
+    def __init__(self, cid):
+        # type: (int) -> None
+        self.cid = cid
+        self._event = Event()
+        self._response = None  # type: Optional[Dict[str,Any]]
+
+    def set_response(self, response):
+        # type: (Dict[str,Any]) -> None
+        self._response = response
+        self._event.set()
+
+    def result(self, timeout):
+        # type: (float) -> Dict[str,Any]
+        if not self._event.wait(timeout):
+            raise Empty()
+        assert self._response is not None
+        return self._response
+
+
 class PluginRunner(object):
     class State(object):
         RUNNING = 'RUNNING'
         STOPPED = 'STOPPED'
 
+    # Async commands with a lower value are sent first, so status changes overtake e.g. metric deliveries
+    ACTION_PRIORITIES = {'input_status': 0,
+                         'output_status': 0,
+                         'shutter_status': 0,
+                         'ventilation_status': 0,
+                         'thermostat_status': 0,
+                         'thermostat_group_status': 0,
+                         'receive_events': 0,
+                         'distribute_metrics': 2}
+    DEFAULT_PRIORITY = 1
+
     def __init__(self, name, runtime_path, plugin_path, logger, command_timeout=5.0, state_callback=None):
         self.runtime_path = runtime_path
         self.plugin_path = plugin_path
@@ -77,7 +111,7 @@ class PluginRunner(object):
         self._running = False
         self._process_running = False
         self._command_lock = Lock()
-        self._response_queue = Queue()  # type: Queue[Dict[str,Any]]
+        self._pending_commands = {}  # type: Dict[int,CommandFuture]
         self._writer = None  # type: Optional[PluginIPCWriter]
         self._reader = None  # type: Optional[PluginIPCReader]
         self._state_callback = state_callback  # type: Optional[Callable[[str, str], None]]
@@ -92,7 +126,8 @@ class PluginRunner(object):
         self._metric_receivers = []
 
         self._async_command_thread = None
-        self._async_command_queue = None  # type: Optional[Queue[Optional[Dict[str, Any]]]]
+        self._async_command_queue = None  # type: Optional[PriorityQueue[Tuple[int, int, Optional[Dict[str, Any]]]]]
+        self._async_command_sequence = count()
 
         self._commands_executed = 0
         self._commands_failed = 0
@@ -141,7 +176,7 @@ class PluginRunner(object):
         if exception is not None:
             raise RuntimeError(exception)
 
-        self._async_command_queue = Queue(1000)
+        self._async_command_queue = PriorityQueue(1000)
         self._async_command_thread = BaseThread(name='plugincmd{0}'.format(self.plugin_path),
                                                 target=self._perform_async_commands)
         self._async_command_thread.daemon = True
@@ -180,8 +215,9 @@ class PluginRunner(object):
             if self._reader:
                 self._reader.stop()
             self._process_running = False
+            self._abort_pending_commands()
             if self._async_command_queue is not None:
-                self._async_command_queue.put(None)  # Triggers an abort on the read thread
+                self._async_command_queue.put((-1, 0, None))  # Triggers an abort on the read thread
 
             if self._proc and self._proc.poll() is None:
                 self.logger('[Runner] Terminating process')
@@ -202,58 +238,10 @@ class PluginRunner(object):
                 self._state_callback(self.name, PluginRunner.State.STOPPED)
             self.logger('[Runner] Stopped')
 
-    def process_input_status(self, input_event):
-        event_json = input_event.serialize()
-        self._do_async(action='input_status', payload={'event': event_json}, should_filter=True)
-
-    def process_output_status(self, data, action_version=1):
-        if action_version in [1, 2]:
-            if action_version == 1:
-                payload = {'status': data}
-            else:
-                event_json = data.serialize()
-                payload = {'event': event_json}
-            self._do_async(action='output_status', payload=payload, should_filter=True, action_version=action_version)
-        else:
-            self.logger('Output status version {} not supported.'.format(action_version))
-
-    def process_shutter_status(self, data, action_version=1):
-        if action_version in [1, 2, 3]:
-            if action_version == 1:
-                payload = {'status': data}
-            elif action_version == 2:
-                status, detail = data
-                payload = {'status': {'status': status, 'detail': detail}}
-            else:
-                event_json = data.serialize()
-                payload = {'event': event_json}
-            self._do_async(action='shutter_status', payload=payload, should_filter=True, action_version=action_version)
-        else:
-            self.logger('Shutter status version {} not supported.'.format(action_version))
-
-    def process_ventilation_status(self, data, action_version=1):
-        if action_version in [1]:
-            event_json = data.serialize()
-            payload = {'event': event_json}
-            self._do_async(action='ventilation_status', payload=payload, should_filter=True, action_version=action_version)
-        else:
-            self.logger('Ventilation status version {} not supported.'.format(action_version))
-
-    def process_thermostat_status(self, data, action_version=1):
-        if action_version in [1]:
-            event_json = data.serialize()
-            payload = {'event': event_json}
-            self._do_async(action='thermostat_status', payload=payload, should_filter=True, action_version=action_version)
-        else:
-            self.logger('Thermostat status version {} not supported.'.format(action_version))
-
-    def process_thermostat_group_status(self, data, action_version=1):
-        if action_version in [1]:
-            event_json = data.serialize()
-            payload = {'event': event_json}
-            self._do_async(action='thermostat_group_status', payload=payload, should_filter=True, action_version=action_version)
-        else:
-            self.logger('Thermostat group status version {} not supported.'.format(action_version))
+    def process_status(self, action, payload, action_version=1):
+        # type: (str, EncodedPayload, int) -> None
+        """ Sends a status action of which the payload was prepared (and encoded) once for all runners """
+        self._do_async(action=action, payload=payload, should_filter=True, action_version=action_version)
 
     def process_event(self, code):
         self._do_async('receive_events', {'code': code}, should_filter=True)
@@ -279,8 +267,9 @@ class PluginRunner(object):
         return self._metric_receivers
 
     def distribute_metrics(self, method, metrics):
-        self._do_async('distribute_metrics', {'name': method,
-                                              'metrics': metrics})
+        # type: (str, List[Dict[str,Any]]) -> bool
+        return self._do_async('distribute_metrics', {'name': method,
+                                                     'metrics': metrics})
 
     def get_metric_definitions(self):
         return self._do_command('get_metric_definitions')['metric_definitions']
@@ -312,15 +301,27 @@ class PluginRunner(object):
         if exit_code is not None:
             self.logger('[Runner] Stopped with exit code {0}'.format(exit_code))
             self._process_running = False
+            self._abort_pending_commands()
             return
 
         if response['cid'] == 0:
             self._handle_async_response(response)
-        elif response['cid'] == self._cid:
-            self._response_queue.put(response)
+            return
+        with self._command_lock:
+            future = self._pending_commands.pop(response['cid'], None)
+        if future is not None:
+            future.set_response(response)
         else:
             self.logger('[Runner] Received message with unknown cid: {0}'.format(response))
 
+    def _abort_pending_commands(self):
+        # type: () -> None
+        with self._command_lock:
+            pending_commands = list(self._pending_commands.values())
+            self._pending_commands = {}
+        for future in pending_commands:
+            future.set_response({'cid': future.cid, '_exception': 'Plugin was stopped'})
+
     def _handle_async_response(self, response):
         # type: (Dict[str,Any]) -> None
         if response['action'] == 'logs':
@@ -328,19 +329,26 @@ class PluginRunner(object):
         else:
             self.logger('[Runner] Unkown async message: {0}'.format(response))
 
+    def has_receiver(self, action, action_version=1):
+        # type: (str, int) -> bool
+        # the action version is linked to a specific decorator version
+        return action_version in self._decorators_in_use.get(action, [])
+
     def _do_async(self, action, payload, should_filter=False, action_version=1):
-        # type: (str, Dict[str,Any], bool, int) -> None
-        has_receiver = False
-        for decorator_name, decorator_versions in six.iteritems(self._decorators_in_use):
-            # the action version is linked to a specific decorator version
-            has_receiver |= (action == decorator_name and action_version in decorator_versions)
-        if not self._process_running or (should_filter and not has_receiver):
-            return
+        # type: (str, Any, bool, int) -> bool
+        """ Queues an async command, returns whether it was queued """
+        if not self._process_running or (should_filter and not self.has_receiver(action, action_version)):
+            return False
         try:
             assert self._async_command_queue, 'Command Queue not defined'
-            self._async_command_queue.put({'action': action, 'payload': payload, 'action_version': action_version}, block=False)
+            priority = PluginRunner.ACTION_PRIORITIES.get(action, PluginRunner.DEFAULT_PRIORITY)
+            command = {'action': action, 'payload': payload, 'action_version': action_version}
+            # The sequence keeps the order within a priority, and avoids comparing the commands themselves
+            self._async_command_queue.put((priority, next(self._async_command_sequence), command), block=False)
+            return True
         except Full:
             self.logger('Async action cannot be queued, queue is full')
+            return False
 
     def _perform_async_commands(self):
         # type: () -> None
@@ -348,7 +356,7 @@ class PluginRunner(object):
             try:
                 # Give it a timeout in order to check whether the plugin is not stopped.
                 assert self._async_command_queue, 'Command Queue not defined'
-                command = self._async_command_queue.get(block=True, timeout=10)
+                _, _, command = self._async_command_queue.get(block=True, timeout=10)
                 if command is None:
                     continue  # Used to exit this thread
                 self._do_command(command['action'], payload=command['payload'], action_version=command['action_version'])
@@ -358,7 +366,10 @@ class PluginRunner(object):
                 self.logger('[Runner] Failed to perform async command: {0}'.format(exception))
 
     def _do_command(self, action, payload=None, timeout=None, action_version=1):
-        # type: (str, Dict[str,Any], Optional[float], int) -> Dict[str,Any]
+        # type: (str, Any, Optional[float], int) -> Dict[str,Any]
+        encoded_payload = None
+        if isinstance(payload, EncodedPayload):
+            encoded_payload, payload = payload, {}
         if payload is None:
             payload = {}
         self._commands_executed += 1
@@ -368,31 +379,36 @@ class PluginRunner(object):
         if not self._process_running:
             raise Exception('Plugin was stopped')
 
+        # Multiple commands can be waiting for their response, the reader thread dispatches them by cid
         with self._command_lock:
-            try:
-                command = self._create_command(action, payload, action_version)
-                assert self._writer, 'Plugin stdin not defined'
-                self._writer.write(command)
-            except Exception:
-                self._commands_failed += 1
-                raise
+            command = self._create_command(action, payload, action_version)
+            future = CommandFuture(command['cid'])
+            self._pending_commands[future.cid] = future
+        try:
+            assert self._writer, 'Plugin stdin not defined'
+            self._writer.write(command, payload=encoded_payload)
+        except Exception:
+            with self._command_lock:
+                self._pending_commands.pop(future.cid, None)
+            self._commands_failed += 1
+            raise
 
-            try:
-                response = self._response_queue.get(block=True, timeout=timeout)
-                while response['cid'] != self._cid:
-                    response = self._response_queue.get(block=False)
-                exception = response.get('_exception')
-                if exception is not None:
-                    raise RuntimeError(exception)
-                return response
-            except Empty:
-                metadata = ''
-                if action == 'request':
-                    metadata = ' {0}'.format(payload['method'])
-                if self._running:
-                    self.logger('[Runner] No response within {0}s ({1}{2})'.format(timeout, action, metadata))
-                self._commands_failed += 1
-                raise Exception('Plugin did not respond')
+        try:
+            response = future.result(timeout)
+        except Empty:
+            with self._command_lock:
+                self._pending_commands.pop(future.cid, None)
+            metadata = ''
+            if action == 'request':
+                metadata = ' {0}'.format(payload['method'])
+            if self._running:
+                self.logger('[Runner] No response within {0}s ({1}{2})'.format(timeout, action, metadata))
+            self._commands_failed += 1
+            raise Exception('Plugin did not respond')
+        exception = response.get('_exception')
+        if exception is not None:
+            raise RuntimeError(exception)
+        return response
 
     def _create_command(self, action, payload=None, action_version=1):
         # type: (str, Dict[str,Any], int) -> Dict[str,Any]
@@ -32,7 +32,7 @@ from power import power_api
 from power.power_command import PowerCommand
 from power.time_keeper import TimeKeeper
 from serial_utils import CommunicationStatus, CommunicationTimedOutException, \
-    printable
+    DebugBuffer, printable
 
 if False:  # MYPY:
     from typing import Any, Dict, List, Literal, Optional, Tuple, Union
@@ -83,9 +83,8 @@ class PowerCommunicator(object):
         self.__communication_stats_bytes = {'bytes_written': 0,
                                             'bytes_read': 0}  # type: Dict[str, int]
 
-        self.__debug_buffer = {'read': {},
-                               'write': {}}  # type: Dict[str,Dict[float,str]]
-        self.__debug_buffer_duration = 300
+        self.__debug_buffer = {'read': DebugBuffer(),
+                               'write': DebugBuffer()}  # type: Dict[str, DebugBuffer]
 
     def start(self):
         # type: () -> None
@@ -148,8 +147,9 @@ class PowerCommunicator(object):
             return CommunicationStatus.FAILURE
 
     def get_debug_buffer(self):
-        # type: () -> Dict[str, Dict[Any, Any]]
-        return self.__debug_buffer
+        # type: () -> Dict[str, Dict[float, str]]
+        return {'read': self.__debug_buffer['read'].get(),
+                'write': self.__debug_buffer['write'].get()}
 
     def get_seconds_since_last_success(self):
         # type: () -> float
@@ -179,11 +179,7 @@ class PowerCommunicator(object):
         self.__debug('writing to', data)
         self.__serial.write(data)
         self.__communication_stats_bytes['bytes_written'] += len(data)
-        threshold = time.time() - self.__debug_buffer_duration
-        self.__debug_buffer['write'][time.time()] = printable(data)
-        for t in self.__debug_buffer['write'].keys():
-            if t < threshold:
-                del self.__debug_buffer['write'][t]
+        self.__debug_buffer['write'].append(data)
 
     def do_command(self, address, cmd, *data):
         # type: (int, PowerCommand, DataType) -> Tuple[Any, ...]
@@ -447,11 +443,7 @@ class PowerCommunicator(object):
         finally:
             self.__debug('reading from', command)
 
-        threshold = time.time() - self.__debug_buffer_duration
-        self.__debug_buffer['read'][time.time()] = printable(command)
-        for t in self.__debug_buffer['read'].keys():
-            if t < threshold:
-                del self.__debug_buffer['read'][t]
+        self.__debug_buffer['read'].append(command)
 
         return header, data
 
@@ -20,6 +20,9 @@ from __future__ import absolute_import
 
 import fcntl
 import struct
+import time
+from collections import deque
+from threading import Lock
 
 from six.moves.queue import Queue
 
@@ -27,9 +30,14 @@ from gateway.daemon_thread import BaseThread
 from gateway.hal.master_controller import CommunicationFailure
 
 if False:  # MYPY
-    from typing import Literal
+    from typing import Deque, Dict, Literal, Optional, Tuple, Union
     from serial import Serial
 
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic  # Python 2 fallback
+
 
 class CommunicationTimedOutException(CommunicationFailure):
     """ An exception that is raised when the master did not respond in time. """
@@ -57,6 +65,54 @@ def printable(data):
     return '{0}    {1}'.format(byte_notation, string_notation)
 
 
+class DebugBuffer(object):
+    """
+    Keeps the serial data of the last `duration` seconds, optionally limited to `max_bytes`.
+    Entries are appended in time order, so eviction only needs to look at the oldest entries.
+    """
+
+    def __init__(self, duration=300, max_bytes=None):
+        # type: (float, Optional[int]) -> None
+        self._duration = duration
+        self._max_bytes = max_bytes
+        self._entries = deque()  # type: Deque[Tuple[float, float, Union[bytes, bytearray]]]
+        self._size = 0
+        self._lock = Lock()
+
+    def __len__(self):
+        # type: () -> int
+        return len(self._entries)
+
+    def append(self, data):
+        # type: (Union[bytes, bytearray]) -> None
+        """ Adds data, and evicts entries that are too old or exceed the byte budget """
+        with self._lock:
+            self._entries.append((monotonic(), time.time(), data))
+            self._size += len(data)
+            self._evict()
+
+    def clear(self):
+        # type: () -> None
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def get(self):
+        # type: () -> Dict[float, str]
+        """ Returns the buffered data in a human-readable way, keyed by timestamp """
+        with self._lock:
+            self._evict()
+            return {timestamp: printable(data) for _, timestamp, data in self._entries}
+
+    def _evict(self):
+        # type: () -> None
+        threshold = monotonic() - self._duration
+        entries = self._entries
+        while entries and (entries[0][0] < threshold or
+                           (self._max_bytes is not None and self._size > self._max_bytes)):
+            self._size -= len(entries.popleft()[2])
+
+
 TIOCSRS485 = 0x542F
 SER_RS485_ENABLED = 0b00000001
 SER_RS485_RTS_ON_SEND = 0b00000010
@@ -20,10 +20,11 @@ from __future__ import absolute_import
 
 import inspect
 import logging
+import os
 import time
 import traceback
 from collections import deque
-from threading import Thread
+from threading import Condition, Lock, Thread
 
 import msgpack
 import six
@@ -48,46 +49,54 @@ class Queue(object):
     def __init__(self, size=None):
         self._queue = deque()  # type: deque
         self._size = size  # Not used
+        self._condition = Condition()
 
     def put(self, value, block=False):
         _ = block
-        self._queue.appendleft(value)
+        with self._condition:
+            self._queue.appendleft(value)
+            self._condition.notify()
 
     def get(self, block=True, timeout=None):
-        if not block:
+        with self._condition:
+            if block:
+                end = None if timeout is None else time.time() + timeout
+                while not self._queue:
+                    if end is None:
+                        self._condition.wait()
+                        continue
+                    remaining = end - time.time()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
             try:
                 return self._queue.pop()
             except IndexError:
                 raise Empty()
-        start = time.time()
-        while timeout is None or time.time() - start < timeout:
-            try:
-                return self._queue.pop()
-            except IndexError:
-                sleep = 0.025
-                if timeout is None or timeout > 1:
-                    sleep = 0.1
-                time.sleep(sleep)
-        raise Empty()
 
     def qsize(self):
         return len(self._queue)
 
     def clear(self):
-        return self._queue.clear()
+        with self._condition:
+            return self._queue.clear()
 
 
 class PluginIPCReader(object):
     """
     This class handles IPC communications.
 
-    It uses a stream of msgpack encoded dict values.
+    It uses a stream of msgpack encoded dict values. The stream is read in chunks (whatever
+    is available, up to READ_SIZE) and all complete values in a chunk are handled at once.
     """
 
+    READ_SIZE = 64 * 1024
+
     def __init__(self, stream, logger, command_receiver=None, name=None):
         # type: (IO[bytes], Callable[[str,Exception],None], Callable[[Dict[str,Any]],None],Optional[str]) -> None
         self._command_queue = Queue()
-        self._unpacker = msgpack.Unpacker(stream, read_size=1, raw=False)  # type: msgpack.Unpacker[Dict[str,Any]]
+        self._stream = stream
+        self._unpacker = msgpack.Unpacker(raw=False)  # type: msgpack.Unpacker[Dict[str,Any]]
         self._read_thread = None  # type: Optional[Thread]
         self._logger = logger
         self._running = False
@@ -109,30 +118,68 @@ class PluginIPCReader(object):
 
     def _read(self):
         # type: () -> None
+        fileno = self._stream.fileno()
         while self._running:
             try:
-                command = next(self._unpacker)
-                if not isinstance(command, dict):
-                    raise ValueError('invalid value %s' % command)
-                if self._command_receiver is not None:
-                    self._command_receiver(command)
-                else:
-                    self._command_queue.put(command)
-            except StopIteration as ex:
+                data = os.read(fileno, PluginIPCReader.READ_SIZE)
+                if not data:
+                    raise EOFError('End of stream')
+                self._unpacker.feed(data)
+                for command in self._unpacker:
+                    self._handle_command(command)
+            except EOFError as ex:
                 self._logger('PluginIPCReader %s stopped' % self._name, ex)
                 self._running = False
             except Exception as ex:
                 self._logger('Unexpected read exception', ex)
 
+    def _handle_command(self, command):
+        # type: (Dict[str,Any]) -> None
+        try:
+            if not isinstance(command, dict):
+                raise ValueError('invalid value %s' % command)
+            if self._command_receiver is not None:
+                self._command_receiver(command)
+            else:
+                self._command_queue.put(command)
+        except Exception as ex:
+            self._logger('Unexpected read exception', ex)
+
     def get(self, block=True, timeout=None):
         return self._command_queue.get(block, timeout)
 
+    def qsize(self):
+        # type: () -> int
+        return self._command_queue.qsize()
+
+
+class EncodedPayload(object):
+    """
+    Msgpack encoded key/value pairs, that can be added to several commands (see `PluginIPCWriter.write`)
+    without encoding them again.
+    """
+
+    def __init__(self, payload):
+        # type: (Dict[str,Any]) -> None
+        packer = msgpack.Packer()  # type: msgpack.Packer[Any]
+        self.size = len(payload)
+        self.data = b''.join(packer.pack(key) + packer.pack(value) for key, value in six.iteritems(payload))
+
 
 class PluginIPCWriter(object):
+    """
+    Writes msgpack encoded dict values to a stream. Values written with `flush=False` are buffered
+    until a value is written with `flush=True`, `flush()` is called or FLUSH_SIZE is reached.
+    """
+
+    FLUSH_SIZE = 64 * 1024
+
     def __init__(self, stream):
         # type: (IO[bytes]) -> None
-        self._packer = msgpack.Packer()  # type: msgpack.Packer[Dict[str,Any]]
+        self._packer = msgpack.Packer()  # type: msgpack.Packer[Any]
         self._stream = stream
+        self._buffer = bytearray()
+        self._lock = Lock()  # Responses can be written from multiple threads
 
     def log(self, msg):
         # type: (str) -> None
@@ -150,10 +197,34 @@ class PluginIPCWriter(object):
         except Exception as exception:
             self.log_exception(name, exception)
 
-    def write(self, response):
-        # type: (Dict[str,Any]) -> None
+    def write(self, response, flush=True, payload=None):
+        # type: (Dict[str,Any], bool, Optional[EncodedPayload]) -> None
+        """ Writes the response, extended with the (already encoded) key/value pairs of `payload` """
+        with self._lock:
+            if payload is None:
+                self._buffer += self._packer.pack(response)
+            else:
+                self._buffer += self._packer.pack_map_header(len(response) + payload.size)
+                for key, value in six.iteritems(response):
+                    self._buffer += self._packer.pack(key)
+                    self._buffer += self._packer.pack(value)
+                self._buffer += payload.data
+            if flush or len(self._buffer) >= PluginIPCWriter.FLUSH_SIZE:
+                self._flush()
+
+    def flush(self):
+        # type: () -> None
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        # type: () -> None
+        if not self._buffer:
+            return
+        data = bytes(self._buffer)
+        self._buffer = bytearray()
         try:
-            self._stream.write(self._packer.pack(response))
+            self._stream.write(data)
             self._stream.flush()
         except IOError:
             pass  # Ignore exceptions if the stream is not available (nothing that can be done anyway)
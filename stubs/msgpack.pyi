@@ -19,10 +19,12 @@ class Packer(Generic[T]):
 
     def pack(self, obj: T) -> bytes: ...
 
+    def pack_map_header(self, n: int) -> bytes: ...
+
 
 class Unpacker(Iterator[T]):
     def __init__(self,
-                 file_like: IO[bytes],
+                 file_like: Optional[IO[bytes]] = None,
                  read_size=0,
                  use_list=True,
                  raw=False,
@@ -43,6 +45,8 @@ class Unpacker(Iterator[T]):
 
     def __next__(self) -> T: ...
 
+    def feed(self, next_bytes: bytes) -> None: ...
+
     def unpack(self) -> T: ...
 
 
@@ -61,6 +61,7 @@ class MasterCoreControllerTest(unittest.TestCase):
 
         self.communicator = mock.Mock(CoreCommunicator)
         self.communicator.do_command = _do_command
+        self.communicator.do_commands = lambda commands, timeout=None: [_do_command(command, fields, timeout) for command, fields in commands]
         self.communicator.do_basic_action = _do_basic_action
         self.pubsub = PubSub()
         SetUpTestInjections(master_communicator=self.communicator,
@@ -297,6 +298,13 @@ class MasterCoreControllerTest(unittest.TestCase):
         self.pubsub._publish_all_events()
         assert self.controller._output_last_updated == 0
 
+    def test_master_maintenance_event(self):
+        master_event = MasterEvent(MasterEvent.Types.MAINTENANCE_EXIT, {})
+        with mock.patch.object(self.controller._memory_files[MemoryTypes.EEPROM], 'invalidate_cache') as invalidate:
+            self.pubsub.publish_master_event(PubSub.MasterTopics.MAINTENANCE, master_event)
+            self.pubsub._publish_all_events()
+            invalidate.assert_called_once_with()
+
 
 class MasterInputState(unittest.TestCase):
     @classmethod
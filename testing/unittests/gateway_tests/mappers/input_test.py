@@ -52,6 +52,7 @@ class InputCoreMapperTest(unittest.TestCase):
 
         self.communicator = Mock(CoreCommunicator)
         self.communicator.do_command = _do_command
+        self.communicator.do_commands = lambda commands, timeout=None: [_do_command(command, fields, timeout) for command, fields in commands]
         SetUpTestInjections(master_communicator=self.communicator)
 
         eeprom_file = MemoryFile(MemoryTypes.EEPROM)
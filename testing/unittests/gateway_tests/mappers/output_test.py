@@ -15,7 +15,7 @@
 from __future__ import absolute_import
 
 import unittest
-from mock import Mock
+from mock import MagicMock, Mock
 from ioc import SetTestMode, SetUpTestInjections
 from gateway.dto import OutputDTO
 from gateway.hal.mappers_core import OutputMapper
@@ -42,7 +42,7 @@ class OutputMapperTest(unittest.TestCase):
                 for index, data_byte in enumerate(data_):
                     self.memory_map[address.page][address.offset + index] = data_byte
 
-        memory_file_mock = Mock(MemoryFile)
+        memory_file_mock = MagicMock(MemoryFile)
         memory_file_mock.read = _read
         memory_file_mock.write = _write
 
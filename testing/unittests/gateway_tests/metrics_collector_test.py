@@ -14,6 +14,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 from __future__ import absolute_import
 
+import time
 import unittest
 
 import mock
@@ -183,3 +184,37 @@ class MetricsCollectorTest(unittest.TestCase):
                                       tags={'type': 'openmotics', 'id': '11.0', 'name': 'foo'},
                                       values={'counter_day': 10.0, 'counter_night': 2.1, 'counter': 12.1})
             assert enqueue.call_args_list == [expected_call]
+
+    def test_scheduler(self):
+        runs = {'sensor': 0, 'fixed': 0, 'slow': 0}
+
+        def workload(name):
+            runs[name] += 1
+            if name == 'slow':
+                time.sleep(0.2)
+
+        def wait_for(condition):
+            end = time.time() + 5
+            while not condition() and time.time() < end:
+                time.sleep(0.01)
+            self.assertTrue(condition())
+
+        self.controller.intervals['sensor'] = 900
+        self.controller._add_job(workload, 'sensor')
+        self.controller._add_job(workload, 'fixed', 0.05)
+        self.controller._add_job(workload, 'slow', 0.1)
+        self.controller._stopped = False
+        self.controller._start_scheduler()
+        try:
+            wait_for(lambda: runs['fixed'] >= 3 and runs['slow'] >= 2)
+            self.assertEqual(1, runs['sensor'])
+            self.controller.maybe_wake_earlier('sensor', 0)  # E.g. a websocket requesting a lower interval
+            wait_for(lambda: runs['sensor'] == 2)
+        finally:
+            self.controller.stop()
+        statistics = self.controller.get_job_statistics()
+        self.assertEqual(2, statistics['sensor']['runs'])
+        self.assertGreaterEqual(statistics['slow']['duration'], 0.2)
+        self.assertGreaterEqual(statistics['slow']['overruns'], 1)
+        self.assertEqual(0, statistics['fixed']['overruns'])
+
@@ -0,0 +1,86 @@
+# Copyright (C) 2020 OpenMotics BV
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the compact metric records
+"""
+from __future__ import absolute_import
+
+import logging
+import sys
+import unittest
+
+import xmlrunner
+
+from gateway.metrics_record import MetricRecord
+
+logger = logging.getLogger('test')
+
+
+class MetricRecordTest(unittest.TestCase):
+    @staticmethod
+    def _build_metric(i):
+        return {'source': 'OpenMotics',
+                'type': 'energy',
+                'timestamp': 1600000000.0 + i,
+                'tags': {'type': 'openmotics', 'id': '11.{0}'.format(i % 8), 'name': 'power {0}'.format(i % 8)},
+                'values': {'voltage': 230.0, 'frequency': 50.0, 'current': 1.5, 'power': 345.0}}
+
+    @staticmethod
+    def _sizeof(obj, seen):
+        if id(obj) in seen:
+            return 0
+        seen.add(id(obj))
+        size = sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            size += sum(MetricRecordTest._sizeof(key, seen) + MetricRecordTest._sizeof(value, seen) for key, value in obj.items())
+        elif isinstance(obj, (list, tuple)):
+            size += sum(MetricRecordTest._sizeof(item, seen) for item in obj)
+        elif isinstance(obj, MetricRecord):
+            size += sum(MetricRecordTest._sizeof(getattr(obj, slot), seen) for slot in MetricRecord.__slots__)
+        return size
+
+    def test_conversion(self):
+        metric = MetricRecordTest._build_metric(1)
+        record = MetricRecord.from_dict(metric)
+        self.assertEqual(metric, record.to_dict())
+        self.assertEqual('energy', record['type'])
+        self.assertEqual('11.1', record['tags']['id'])
+        self.assertEqual(345.0, record['values']['power'])
+        self.assertIs(record, MetricRecord.from_dict(record))
+        self.assertIs(metric, MetricRecord.as_dict(metric))
+        with self.assertRaises(KeyError):
+            _ = record['_values']
+
+        record.set_value('power', 350.0)
+        self.assertEqual(350.0, record.values['power'])
+        self.assertEqual(345.0, metric['values']['power'])
+
+        other = MetricRecord.from_dict(MetricRecordTest._build_metric(2))
+        self.assertIs(record._tag_keys, other._tag_keys)
+        self.assertIs(record._value_keys, other._value_keys)
+
+    def test_memory_usage(self):
+        amount = 10000
+        metrics = [MetricRecordTest._build_metric(i) for i in range(amount)]
+        records = [MetricRecord.from_dict(metric) for metric in metrics]
+        # The tag values and timestamps are distinct objects per metric in both forms
+        dict_size = MetricRecordTest._sizeof(metrics, set())
+        record_size = MetricRecordTest._sizeof(records, set())
+        logger.info('{0} metrics: {1} bytes as dicts, {2} bytes as records'.format(amount, dict_size, record_size))
+        self.assertLess(record_size, dict_size / 2)
+
+
+if __name__ == "__main__":
+    unittest.main(testRunner=xmlrunner.XMLTestRunner(output='../gw-unit-reports'))
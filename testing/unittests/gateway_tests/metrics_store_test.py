@@ -0,0 +1,194 @@
+# Copyright (C) 2020 OpenMotics BV
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the local metrics store
+"""
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+import xmlrunner
+from peewee import SqliteDatabase
+
+from gateway.metrics_record import MetricRecord
+from gateway.metrics_store import MetricsStore
+from gateway.models import Config
+from ioc import SetTestMode, SetUpTestInjections
+
+MODELS = [Config]
+
+
+class MetricsStoreTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        SetTestMode()
+        cls.test_db = SqliteDatabase(':memory:')
+
+    def setUp(self):
+        self.test_db.bind(MODELS, bind_refs=False, bind_backrefs=False)
+        self.test_db.connect()
+        self.test_db.create_tables(MODELS)
+        self.directory = tempfile.mkdtemp()
+        self.store = MetricsStoreTest._get_store(self.directory)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory)
+        self.test_db.drop_tables(MODELS)
+        self.test_db.close()
+
+    @staticmethod
+    def _get_store(directory):
+        SetUpTestInjections(metrics_store_dir=directory)
+        return MetricsStore()
+
+    @staticmethod
+    def _build_metrics(start, amount, step=1, device_id=1, modulo=10):
+        return [MetricRecord.from_dict({'source': 'OpenMotics',
+                                        'type': 'energy',
+                                        'timestamp': start + i * step,
+                                        'tags': {'type': 'openmotics', 'id': device_id},
+                                        'values': {'power': float(i % modulo),
+                                                   'on': i % 2 == 0,
+                                                   'name': 'foo'}})
+                for i in range(amount)]
+
+    def test_raw_values(self):
+        self.store.receive_batch(MetricsStoreTest._build_metrics(1000, 20))
+        self.store.receive_batch(MetricsStoreTest._build_metrics(1000, 20, device_id=2))
+        history = self.store.query('OpenMotics', 'energy', 'power', 1005, 1010)
+        self.assertEqual(MetricsStore.RAW, history['resolution'])
+        self.assertEqual(2, len(history['series']))
+        self.assertEqual([[1005.0, 5.0], [1006.0, 6.0], [1007.0, 7.0], [1008.0, 8.0], [1009.0, 9.0]],
+                         history['series'][0]['values'])
+        history = self.store.query('OpenMotics', 'energy', 'on', 1000, 1004, tags={'id': 2})
+        self.assertEqual(1, len(history['series']))
+        self.assertEqual({'type': 'openmotics', 'id': 2}, history['series'][0]['tags'])
+        self.assertEqual([1.0, 0.0, 1.0, 0.0], [value for _, value in history['series'][0]['values']])
+        history = self.store.query('OpenMotics', 'energy', 'name', 1000, 1020)
+        self.assertEqual([], history['series'])
+        with self.assertRaises(ValueError):
+            self.store.query('OpenMotics', 'energy', 'power', 1000, 1020, aggregation='foo')
+        for interval in [0, -60]:
+            with self.assertRaises(ValueError):
+                self.store.query('OpenMotics', 'energy', 'power', 1000, 1020, interval=interval)
+        with self.assertRaises(ValueError):
+            self.store.query('OpenMotics', 'energy', 'power', 1020, 1000)
+
+    def test_downsampling(self):
+        # Values 0..5 every 10 seconds, during 3 hours
+        self.store.receive_batch(MetricsStoreTest._build_metrics(0, 3 * 360, step=10, modulo=6))
+        history = self.store.query('OpenMotics', 'energy', 'power', 0, 300, interval=60)
+        self.assertEqual(60, history['resolution'])
+        self.assertEqual([[0.0, 2.5], [60.0, 2.5], [120.0, 2.5], [180.0, 2.5], [240.0, 2.5]],
+                         history['series'][0]['values'])
+        history = self.store.query('OpenMotics', 'energy', 'power', 0, 3600, interval=300, aggregation='max')
+        self.assertEqual(60, history['resolution'])
+        self.assertEqual([5.0] * 12, [value for _, value in history['series'][0]['values']])
+        history = self.store.query('OpenMotics', 'energy', 'power', 0, 3600, interval=3600, aggregation='count')
+        self.assertEqual(3600, history['resolution'])
+        self.assertEqual([[0.0, 360.0]], history['series'][0]['values'])
+        history = self.store.query('OpenMotics', 'energy', 'power', 0, 3600, interval=1800, aggregation='avg')
+        self.assertEqual(900, history['resolution'])
+        self.assertEqual([[0.0, 2.5], [1800.0, 2.5]], history['series'][0]['values'])
+        # The last, incomplete hour is not stored yet
+        history = self.store.query('OpenMotics', 'energy', 'power', 0, 4 * 3600, interval=3600)
+        self.assertEqual(2, len(history['series'][0]['values']))
+
+    def test_reopen(self):
+        self.store.receive_batch(MetricsStoreTest._build_metrics(1000, 10))
+        self.store.close()
+        self.store = MetricsStoreTest._get_store(self.directory)
+        self.store.receive_batch(MetricsStoreTest._build_metrics(1010, 10))
+        self.store.receive_batch(MetricsStoreTest._build_metrics(1020, 10, device_id=2))
+        history = self.store.query('OpenMotics', 'energy', 'power', 1000, 1030)
+        self.assertEqual(2, len(history['series']))
+        self.assertEqual([float(i % 10) for i in range(20)], [value for _, value in history['series'][0]['values']])
+        self.assertEqual(2, len(os.listdir(os.path.join(self.directory, str(MetricsStore.RAW)))))  # A segment per run
+
+    def test_partial_record(self):
+        self.store.receive_batch(MetricsStoreTest._build_metrics(1000, 10))
+        self.store.close()
+        raw_directory = os.path.join(self.directory, str(MetricsStore.RAW))
+        filename = os.path.join(raw_directory, os.listdir(raw_directory)[0])
+        with open(filename, 'r+b') as segment_file:
+            segment_file.truncate(os.path.getsize(filename) - 1)
+        self.store = MetricsStoreTest._get_store(self.directory)
+        self.store.receive_batch(MetricsStoreTest._build_metrics(1010, 10))
+        # Only the last field of the last metric of the first run is lost
+        amounts = [len(self.store.query('OpenMotics', 'energy', field, 1000, 1020)['series'][0]['values'])
+                   for field in ['power', 'on']]
+        self.assertEqual([19, 20], sorted(amounts))
+
+    def test_failed_write(self):
+        self.store.receive_batch(MetricsStoreTest._build_metrics(1000, 10))
+        segment = self.store._segments[(MetricsStore._get_key('OpenMotics', 'energy'), MetricsStore.RAW)]
+        segment_file = mock.Mock(wraps=segment['file'])
+        segment_file.name = segment['file'].name
+        segment_file.flush.side_effect = IOError('No space left on device')
+        segment['file'] = segment_file
+        self.store.receive_batch(MetricsStoreTest._build_metrics(1010, 10))
+        segment_file.close.assert_called_once_with()
+        self.store.receive_batch(MetricsStoreTest._build_metrics(1020, 10))
+        history = self.store.query('OpenMotics', 'energy', 'power', 1000, 1030)
+        self.assertEqual([float(i % 10) for i in range(30)], [value for _, value in history['series'][0]['values']])
+        self.assertEqual(2, len(os.listdir(os.path.join(self.directory, str(MetricsStore.RAW)))))
+
+    def test_keys(self):
+        self.assertNotEqual(MetricsStore._get_key('a-b', 'c'), MetricsStore._get_key('a', 'b-c'))
+        for source, metric_type in [('a-b', 'c'), ('a', 'b-c')]:
+            self.store.receive_batch([MetricRecord.from_dict({'source': source,
+                                                              'type': metric_type,
+                                                              'timestamp': 1000,
+                                                              'tags': {'id': 1},
+                                                              'values': {'power': 1.0 if source == 'a' else 2.0}})])
+        history = self.store.query('a', 'b-c', 'power', 0, 2000)
+        self.assertEqual([[1000.0, 1.0]], history['series'][0]['values'])
+
+    def test_retention(self):
+        original_segment_size, original_max_sizes = MetricsStore.SEGMENT_SIZE, MetricsStore.MAX_SIZES
+        try:
+            MetricsStore.SEGMENT_SIZE = 1024
+            MetricsStore.MAX_SIZES = dict(original_max_sizes)
+            MetricsStore.MAX_SIZES[MetricsStore.RAW] = 4 * 1024
+            for i in range(20):
+                self.store.receive_batch(MetricsStoreTest._build_metrics(i * 1000, 1000))
+            path = os.path.join(self.directory, str(MetricsStore.RAW))
+            size = sum(os.path.getsize(os.path.join(path, filename)) for filename in os.listdir(path))
+            self.assertLessEqual(size, 5 * 1024)
+            history = self.store.query('OpenMotics', 'energy', 'power', 0, 20000)
+            values = history['series'][0]['values']
+            self.assertGreater(values[0][0], 15000)
+            self.assertEqual(19999.0, values[-1][0])
+            history = self.store.query('OpenMotics', 'energy', 'power', 0, 20000, interval=60, aggregation='count')
+            self.assertEqual(0.0, history['series'][0]['values'][0][0])
+        finally:
+            MetricsStore.SEGMENT_SIZE, MetricsStore.MAX_SIZES = original_segment_size, original_max_sizes
+
+    def test_disabled(self):
+        Config.set_entry('metrics_store_enabled', False)
+        try:
+            self.store.receive_batch(MetricsStoreTest._build_metrics(1000, 10))
+            self.assertEqual([], self.store.query('OpenMotics', 'energy', 'power', 0, 2000)['series'])
+        finally:
+            Config.set_entry('metrics_store_enabled', True)  # The config values are cached
+
+
+if __name__ == "__main__":
+    unittest.main(testRunner=xmlrunner.XMLTestRunner(output='../gw-unit-reports'))
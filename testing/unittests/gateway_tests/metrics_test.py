@@ -19,17 +19,19 @@ from __future__ import absolute_import
 import logging
 import os
 import unittest
-import requests
 import copy
 import ujson as json
 import fakesleep
 import xmlrunner
 import time
 import tempfile
+import zlib
 from peewee import SqliteDatabase
 from threading import Lock
-from mock import Mock
+from mock import Mock, patch
+from six.moves.urllib.parse import parse_qs
 from ioc import SetTestMode, SetUpTestInjections
+from gateway.daemon_thread import DaemonThreadWait
 from gateway.migrations.config import ConfigMigrator
 from gateway.metrics_controller import MetricsController
 from gateway.metrics_caching import MetricsCacheController
@@ -75,7 +77,8 @@ class MetricsTest(unittest.TestCase):
                                                           'get_metric_definitions': lambda: [],
                                                           'get_definitions': lambda *args, **kwargs: {},
                                                           'set_cloud_interval': MetricsTest._set_cloud_interval})()
-        metrics_cache_controller = type('MetricsCacheController', (), {'load_buffer': lambda *args, **kwargs: []})()
+        metrics_cache_controller = type('MetricsCacheController', (), {'load_buffer': lambda *args, **kwargs: [],
+                                                                       'count_buffer': lambda *args, **kwargs: 0})()
         plugin_controller = type('PluginController', (), {'get_metric_definitions': lambda *args, **kwargs: {}})()
         SetUpTestInjections(plugin_controller=plugin_controller,
                             metrics_collector=metrics_collector,
@@ -105,8 +108,13 @@ class MetricsTest(unittest.TestCase):
             _ = before
             return []
 
+        def count_buffer(before=None):
+            _ = before
+            return 0
+
         metrics_cache_mock = Mock()
         metrics_cache_mock.load_buffer = load_buffer
+        metrics_cache_mock.count_buffer = count_buffer
         metrics_collector_mock = Mock()
         metrics_collector_mock.intervals = []
         metrics_collector_mock.get_definitions = lambda: []
@@ -117,7 +125,7 @@ class MetricsTest(unittest.TestCase):
         Config.set_entry('cloud_metrics_sources', ['openmotics'])
         Config.set_entry('cloud_metrics_enabled|energy', True)
 
-        definitions = {'OpenMotics': {'counter': Mock(), 'energy': Mock()}}
+        definitions = {'OpenMotics': {'counter': {'tags': ['id']}, 'energy': {'tags': ['device', 'id']}}}
 
         SetUpTestInjections(plugin_controller=Mock(),
                             metrics_collector=metrics_collector_mock,
@@ -160,7 +168,7 @@ class MetricsTest(unittest.TestCase):
         self.assertFalse(needs_upload)
 
         # 5. configure definition, now test again
-        definitions['MBus'] = {'counter': Mock(), 'energy': Mock()}
+        definitions['MBus'] = {'counter': {'tags': ['id']}, 'energy': {'tags': ['device', 'id']}}
         needs_upload = metrics_controller._needs_upload_to_cloud(metric)
         self.assertFalse(needs_upload)
 
@@ -176,22 +184,107 @@ class MetricsTest(unittest.TestCase):
         needs_upload = metrics_controller._needs_upload_to_cloud(metric)
         self.assertFalse(needs_upload)
 
+    def test_routing_table(self):
+        Config.set_entry('cloud_enabled', True)
+        Config.set_entry('cloud_metrics_types', ['energy'])
+        Config.set_entry('cloud_metrics_sources', [])
+        metrics_controller = MetricsTest._get_controller(intervals=[])
+        metrics_controller.definitions = {'OpenMotics': {'energy': {'tags': ['id', 'device']}}}
+
+        route = metrics_controller._get_route('OpenMotics', 'energy')
+        self.assertTrue(route['upload'])
+        self.assertEqual(['device', 'id'], route['tags'])
+        self.assertEqual('openmotics.energy', route['rate_key'])
+        self.assertEqual(900, route['modulo_interval'])
+        self.assertIs(route, metrics_controller._get_route('OpenMotics', 'energy'))  # Compiled only once
+        self.assertFalse(metrics_controller._get_route('Plugin', 'energy')['upload'])
+
+        # Configuration changes rebuild the table
+        Config.set_entry('cloud_metrics_interval|energy', 300)
+        route = metrics_controller._get_route('OpenMotics', 'energy')
+        self.assertEqual(300, route['modulo_interval'])
+
+        # Definition changes rebuild the table
+        metrics_controller._plugin_controller = Mock()
+        Config.set_entry('cloud_metrics_sources', ['plugin'])
+        metrics_controller.set_plugin_definitions({'Plugin': [{'type': 'energy',
+                                                               'tags': ['id'],
+                                                               'metrics': []}]})
+        self.assertTrue(metrics_controller._get_route('Plugin', 'energy')['upload'])
+
+        # Changes made by other processes are picked up once the Config cache expires
+        Config.CACHE['cloud_enabled'] = (False, time.time() + Config.CACHE_EXPIRY_DURATION)
+        self.assertTrue(metrics_controller._needs_upload_to_cloud({'source': 'Plugin', 'type': 'energy'}))
+        time.sleep(Config.CACHE_EXPIRY_DURATION + 1)
+        Config.CACHE['cloud_enabled'] = (False, time.time() + Config.CACHE_EXPIRY_DURATION)
+        self.assertFalse(metrics_controller._needs_upload_to_cloud({'source': 'Plugin', 'type': 'energy'}))
+
+    def test_distribute_benchmark(self):
+        """ Pushes synthetic metrics through the collection and internal distribution path """
+        Config.set_entry('cloud_enabled', True)
+        Config.set_entry('cloud_metrics_types', ['energy'])
+        metrics_controller = MetricsTest._get_controller(intervals=[])
+        metrics_controller.definitions = {'OpenMotics': {'energy': {'tags': ['id', 'device']},
+                                                         'counter': {'tags': ['id']}}}
+        batches = []
+        metrics_controller.add_receiver(metrics_controller.receive_batch)
+        metrics_controller.add_receiver(lambda metrics: batches.append(len(metrics)))
+
+        amount = 10000
+        start = time.time()
+        for i in range(amount):
+            metrics_controller._put({'source': 'OpenMotics',
+                                     'type': 'energy' if i % 2 else 'counter',
+                                     'timestamp': i,
+                                     'tags': {'device': 'device {0}'.format(i % 10), 'id': i % 10},
+                                     'values': {'power': i}})
+        while True:
+            try:
+                metrics_controller._distribute_openmotics()
+            except DaemonThreadWait:
+                break
+        duration = time.time() - start
+        self.assertEqual(amount // 2, len(metrics_controller._cloud_upload_queue))
+        self.assertEqual([250] * (amount // 250), batches)
+        self.assertEqual({'total': 2 * amount, 'openmotics.energy': amount, 'openmotics.counter': amount},
+                         metrics_controller.outbound_rates)  # Accounted per receiver
+        logger.info('Distributed {0} metrics in {1:.3f}s'.format(amount, duration))
+
+    def test_distribute_failing_receiver(self):
+        metrics_controller = MetricsTest._get_controller(intervals=[])
+        metrics_controller.definitions = {'OpenMotics': {'energy': {'tags': ['id']}}}
+        batches = []
+        metrics_controller.add_receiver(Mock(side_effect=IOError('No space left on device')))
+        metrics_controller.add_receiver(lambda metrics: batches.append(len(metrics)))
+        for i in range(10):
+            metrics_controller._put({'source': 'OpenMotics',
+                                     'type': 'energy',
+                                     'timestamp': i,
+                                     'tags': {'id': i},
+                                     'values': {'power': i}})
+        metrics_controller._distribute_openmotics()
+        self.assertEqual([10], batches)
+        self.assertEqual({'total': 10, 'openmotics.energy': 10}, metrics_controller.outbound_rates)
+
     def test_metrics_receiver(self):
 
         Config.set_entry('cloud_endpoint', 'tests.openmotics.com')
         Config.set_entry('cloud_endpoint_metrics', 'metrics')
         Config.set_entry('cloud_metrics_interval|foobar', 5)
+        Config.set_entry('cloud_metrics_compression', True)
 
         # Add interceptors
 
         send_metrics = []
         response_data = {}
 
-        def post(url, data, timeout):
+        def post(url, data, headers, timeout):
             _ = url, timeout
+            self.assertEqual('gzip', headers.get('Content-Encoding'))
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
             # Extract metrics, parse assumed data format
             time.sleep(1)
-            send_metrics.append([m[0] for m in json.loads(data['metrics'])])
+            send_metrics.append([m[0] for m in json.loads(parse_qs(data.decode())['metrics'][0])])
             response = type('response', (), {})()
             response.text = json.dumps(copy.deepcopy(response_data))
             return response
@@ -204,8 +297,6 @@ class MetricsTest(unittest.TestCase):
                        'tags': {'name': 'name', 'id': 0},
                        'values': {'counter': 0}}
 
-        requests.post = post
-
         SetUpTestInjections(metrics_db=':memory:', metrics_db_lock=Lock())
 
         metrics_cache = MetricsCacheController()
@@ -228,6 +319,7 @@ class MetricsTest(unittest.TestCase):
 
         metrics_controller = MetricsController()
         metrics_controller._needs_upload_to_cloud = lambda *args, **kwargs: True
+        metrics_controller._cloud_session.post = post
         self.assertEqual(metrics_controller._buffer_counters, {'OpenMotics': {'foobar': {'counter': True}}})
 
         # Add some helper methods
@@ -241,13 +333,14 @@ class MetricsTest(unittest.TestCase):
             metric['timestamp'] = time.time()
             metric['values']['counter'] = counter
             metrics_controller.receiver(metric)
+            metrics_controller._upload_cloud_metrics()  # Normally done by the cloud uploader thread
             return metric
 
         def assert_fields(controller, cache, queue, stats, buffer, last_send, last_try, retry_interval):
             self.assertDictEqual(controller._cloud_cache, cache)
             self.assertListEqual(controller._cloud_queue, queue)
-            self.assertDictEqual(controller.cloud_stats, stats)
-            self.assertListEqual(controller._cloud_buffer, buffer)
+            self.assertDictEqual(dict((key, controller.cloud_stats[key]) for key in stats), stats)
+            self.assertListEqual([batch for batch, _, _ in controller._iter_cloud_batches()], [buffer + queue] if buffer + queue else [])
             self.assertEqual(controller._cloud_last_send, last_send)
             self.assertEqual(controller._cloud_last_try, last_try)
             self.assertEqual(controller._cloud_retry_interval, retry_interval)
@@ -431,6 +524,7 @@ class MetricsTest(unittest.TestCase):
 
         metrics_controller = MetricsController()
         metrics_controller._needs_upload_to_cloud = lambda *args, **kwargs: True
+        metrics_controller._cloud_session.post = post
 
         # Validate startup state
 
@@ -466,6 +560,50 @@ class MetricsTest(unittest.TestCase):
                       retry_interval=300)
         buffered_metrics = MetricsTest._load_buffered_metrics(metrics_cache)
         self.assertEqual(buffered_metrics, [])
+        self.assertEqual(0, metrics_controller.cloud_stats['upload_queue'])
+        self.assertGreater(metrics_controller.cloud_stats['bytes_sent'], 0)
+
+        # Consecutive failures back off exponentially
+        for failures, backoff in [(0, 0), (1, 5), (2, 10), (3, 20), (100, 60 * 60)]:
+            metrics_controller._cloud_failures = failures
+            self.assertEqual(backoff, metrics_controller._get_cloud_backoff())
+
+    def test_partial_upload(self):
+        SetUpTestInjections(metrics_db=':memory:',
+                            metrics_db_lock=Lock())
+        metrics_cache = MetricsCacheController()
+        for i in range(3):
+            metrics_cache.buffer_counter('OpenMotics', 'foobar', {'id': i}, {'counter': i}, 300)
+        SetUpTestInjections(plugin_controller=Mock(),
+                            metrics_collector=Mock(get_definitions=lambda: []),
+                            metrics_cache_controller=metrics_cache,
+                            gateway_uuid='uuid')
+        controller = MetricsController()
+        controller._load_cloud_buffer()
+        queue = [[{'source': 'OpenMotics', 'type': 'foobar', 'timestamp': 400 + i, 'tags': {'id': i}, 'values': {'counter': i}}]
+                 for i in range(3)]
+        controller._cloud_queue = list(queue)
+
+        sent = []
+
+        def post(endpoint, batch):
+            _ = endpoint
+            if len(sent) == 2:
+                raise RuntimeError('error')
+            sent.append(batch)
+
+        with patch.object(MetricsController, 'CLOUD_UPLOAD_BATCH_SIZE', 2), \
+                patch.object(controller, '_post_cloud_metrics', side_effect=post):
+            with self.assertRaises(RuntimeError):
+                controller._send_cloud_batches('endpoint')
+            # The sent batches (3 buffered metrics and the first queued metric) are cleared
+            self.assertEqual([], MetricsTest._load_buffered_metrics(metrics_cache))
+            self.assertEqual(0, controller._cloud_buffer_outstanding)
+            self.assertEqual(queue[1:], controller._cloud_queue)
+            del sent[:]
+            controller._send_cloud_batches('endpoint')
+            self.assertEqual([queue[1:]], sent)
+            self.assertEqual([], controller._cloud_queue)
 
     def test_buffer(self):
         SetUpTestInjections(metrics_db=':memory:',
@@ -485,12 +623,49 @@ class MetricsTest(unittest.TestCase):
         self.assertEqual(5, len(buffered_metrics))
         self.assertEqual(expected_metrics, buffered_metrics)
 
+        pages = list(controller.iter_buffer(before=-1, page_size=2))
+        self.assertEqual([2, 2, 1], [len(page) for page in pages])
+        self.assertEqual(expected_metrics, [{'counter': metric['values']['counter'], 'timestamp': metric['timestamp']}
+                                            for page in pages for metric in page])
+        pages = list(controller.iter_buffer(before=expected_metrics[3]['timestamp'], page_size=2))
+        self.assertEqual(expected_metrics[:3], [{'counter': metric['values']['counter'], 'timestamp': metric['timestamp']}
+                                                for page in pages for metric in page])
+        self.assertEqual(3, controller.count_buffer(before=expected_metrics[3]['timestamp']))
+
         removed = controller.clear_buffer(60 * 60 * 24 * 2)
         self.assertEqual(2, removed)
         buffered_metrics = MetricsTest._load_buffered_metrics(controller)
         self.assertEqual(3, len(buffered_metrics))
         self.assertEqual(expected_metrics[2:], buffered_metrics)
 
+    def test_counters(self):
+        _, metrics_db = tempfile.mkstemp()
+        try:
+            SetUpTestInjections(metrics_db=metrics_db,
+                                metrics_db_lock=Lock())
+            controller = MetricsCacheController()
+            tags = {'name': 'name', 'id': 0}
+
+            self.assertEqual(10, controller.process_counter('OpenMotics', 'foobar', tags, 'counter', 10, 1))
+            self.assertEqual(15, controller.process_counter('OpenMotics', 'foobar', tags, 'counter', 15, 2))
+            self.assertEqual(18, controller.process_counter('OpenMotics', 'foobar', tags, 'counter', 3, 3))  # Counter reset
+            self.assertEqual(0, controller._execute("SELECT COUNT(*) FROM counters;").fetchone()[0])  # Nothing written yet
+
+            controller.flush()
+            self.assertEqual([(3, 18, 3)], controller._execute("SELECT last_value, counter, timestamp FROM counters;").fetchall())
+            self.assertEqual(20, controller.process_counter('OpenMotics', 'foobar', tags, 'counter', 5, 4))
+            controller.stop()  # Flushes as well
+            controller.close()
+
+            controller = MetricsCacheController()
+            self.assertEqual(25, controller.process_counter('OpenMotics', 'foobar', tags, 'counter', 10, 5))
+            self.assertEqual(1, controller.process_counter('OpenMotics', 'foobar', {'name': 'other', 'id': 1}, 'counter', 1, 5))
+            controller.flush()
+            self.assertEqual([(10, 25, 5), (1, 1, 5)], controller._execute("SELECT last_value, counter, timestamp FROM counters ORDER BY id;").fetchall())
+            controller.close()
+        finally:
+            os.remove(metrics_db)
+
     @staticmethod
     def _load_buffered_metrics(controller):
         buffered_metrics = []
@@ -15,11 +15,17 @@
 from __future__ import absolute_import
 
 import json
+import os
+import shutil
+import tempfile
 import unittest
 
+import cherrypy
 import mock
+import msgpack
 
 from bus.om_bus_client import MessageClient
+from gateway.events import GatewayEvent
 from gateway.dto import OutputStateDTO, ScheduleDTO, VentilationDTO, \
     VentilationSourceDTO, VentilationStatusDTO
 from gateway.gateway_api import GatewayApi
@@ -27,6 +33,7 @@ from gateway.group_action_controller import GroupActionController
 from gateway.hal.frontpanel_controller import FrontpanelController
 from gateway.input_controller import InputController
 from gateway.maintenance_controller import MaintenanceController
+from gateway.metrics_controller import MetricsController
 from gateway.module_controller import ModuleController
 from gateway.output_controller import OutputController
 from gateway.pulse_counter_controller import PulseCounterController
@@ -37,8 +44,9 @@ from gateway.shutter_controller import ShutterController
 from gateway.thermostat.thermostat_controller import ThermostatController
 from gateway.user_controller import UserController
 from gateway.ventilation_controller import VentilationController
-from gateway.webservice import WebInterface
+from gateway.webservice import WebInterface, WebService
 from ioc import SetTestMode, SetUpTestInjections
+from plugin_runtime.web import WebInterfaceDispatcher
 
 
 class WebInterfaceTest(unittest.TestCase):
@@ -51,6 +59,7 @@ class WebInterfaceTest(unittest.TestCase):
         self.scheduling_controller = mock.Mock(SchedulingController)
         self.ventilation_controller = mock.Mock(VentilationController)
         self.gateway_api = mock.Mock(GatewayApi)
+        self.user_controller = mock.Mock(UserController)
         SetUpTestInjections(frontpanel_controller=mock.Mock(FrontpanelController),
                             gateway_api=self.gateway_api,
                             group_action_controller=mock.Mock(GroupActionController),
@@ -64,7 +73,7 @@ class WebInterfaceTest(unittest.TestCase):
                             sensor_controller=mock.Mock(SensorController),
                             shutter_controller=mock.Mock(ShutterController),
                             thermostat_controller=mock.Mock(ThermostatController),
-                            user_controller=mock.Mock(UserController),
+                            user_controller=self.user_controller,
                             ventilation_controller=self.ventilation_controller,
                             module_controller=mock.Mock(ModuleController))
         self.web = WebInterface()
@@ -75,6 +84,44 @@ class WebInterfaceTest(unittest.TestCase):
             response = self.web.get_output_status()
             self.assertEqual([{'id': 0, 'status': 1, 'ctimer': 0, 'dimmer': 0, 'locked': False}], json.loads(response)['status'])
 
+    def test_api_socket(self):
+        directory = tempfile.mkdtemp()
+        socket_file = os.path.join(directory, 'api.sock')
+        try:
+            if hasattr(cherrypy._cpserver.Server, 'peercreds'):
+                self._call_api_socket(socket_file)
+                self.assertTrue(os.path.exists(socket_file))  # The socket file is left behind
+            else:
+                open(socket_file, 'w').close()  # e.g. CherryPy 3.2.2, left behind by a previous run
+            with mock.patch.object(cherrypy._cpserver, 'Server', type('Server', (object,), {})):
+                self.assertIsNone(WebService._build_socket_server(socket_file))  # No peer credentials support
+            self.assertFalse(os.path.exists(socket_file))
+        finally:
+            shutil.rmtree(directory)
+
+    def _call_api_socket(self, socket_file):
+        cherrypy.config.update({'engine.autoreload.on': False, 'log.screen': False})
+        cherrypy.server.unsubscribe()
+        cherrypy.tree.mount(root=self.web, config={'/': {'tools.sessions.on': False}})
+        server = WebService._build_socket_server(socket_file)
+        cherrypy.engine.start()
+        try:
+            dispatcher = WebInterfaceDispatcher(mock.Mock(), port=0, socket_path=socket_file)
+            self.user_controller.check_token.return_value = False
+            with mock.patch.object(self.output_controller, 'get_output_statuses',
+                                   return_value=[OutputStateDTO(id=0, status=True)]):
+                # The calling process runs as the same user, so no token is needed
+                response = json.loads(dispatcher.get_output_status())
+            self.assertTrue(response['success'])
+            self.assertEqual([{'id': 0, 'status': 1, 'ctimer': 0, 'dimmer': 0, 'locked': False}], response['status'])
+            self.user_controller.check_token.assert_not_called()
+        finally:
+            cherrypy.engine.exit()
+            if server is not None:
+                server.unsubscribe()
+            cherrypy.server.subscribe()
+            del cherrypy.tree.apps['']
+
     def test_schedules(self):
         with mock.patch.object(self.scheduling_controller, 'load_schedules',
                                return_value=[ScheduleDTO(id=1, name='test', start=0, action='BASIC_ACTION')]):
@@ -133,6 +180,24 @@ class WebInterfaceTest(unittest.TestCase):
             }, json.loads(response)['config'])
             save.assert_called()
 
+    def test_batch_calls(self):
+        with mock.patch.object(self.output_controller, 'get_output_statuses',
+                               return_value=[OutputStateDTO(id=0, status=True)]), \
+                mock.patch.object(self.output_controller, 'set_output_status') as set_status:
+            calls = [{'name': 'get_output_status', 'params': {}},
+                     {'name': 'set_output', 'params': {'id': '2', 'is_on': 'true', 'dimmer': None}},
+                     {'name': 'set_output', 'params': {'id': 3, 'is_on': False}},
+                     {'name': 'get_plugin_metric_statistics', 'params': {}},
+                     {'name': 'unknown_call', 'params': {}}]
+            response = json.loads(self.web.batch_calls(calls=calls))
+            self.assertTrue(response['success'])
+            responses = response['responses']
+            self.assertEqual(5, len(responses))
+            self.assertEqual(0, responses[0]['status'][0]['id'])
+            self.assertEqual([{'success': True}] * 2, responses[1:3])
+            self.assertEqual([mock.call(2, True, None, None), mock.call(3, False, None, None)], set_status.call_args_list)
+            self.assertEqual([{'success': False, 'msg': 'invalid_call'}] * 2, responses[3:])
+
     def test_set_ventilation_status(self):
         with mock.patch.object(self.ventilation_controller, 'set_status',
                                return_value=VentilationStatusDTO(id=1,
@@ -148,3 +213,43 @@ class WebInterfaceTest(unittest.TestCase):
                 'remaining_time': 60.0
             }, json.loads(response)['status'])
             set_status.assert_called()
+
+    def test_distribute_metrics(self):
+        metrics_controller = mock.Mock(MetricsController)
+        metrics_controller.get_filter = lambda filter_type, metric_filter: {'source': {'OpenMotics'},
+                                                                            'metric_type': {'energy'} if metric_filter == 'energy' else {'energy', 'counter'}}[filter_type]
+        self.web.set_metrics_controller(metrics_controller)
+        self.user_controller.check_token.return_value = True
+        sockets = [mock.Mock(), mock.Mock(), mock.Mock()]
+        receivers = {'a': {'source': None, 'metric_type': 'energy', 'token': 'a', 'socket': sockets[0]},
+                     'b': {'source': None, 'metric_type': 'energy', 'token': 'b', 'socket': sockets[1]},
+                     'c': {'source': None, 'metric_type': None, 'token': 'c', 'socket': sockets[2]}}
+        metrics = [{'source': 'OpenMotics', 'type': 'energy', 'timestamp': 0, 'tags': {'id': 0}, 'values': {'power': 1}},
+                   {'source': 'OpenMotics', 'type': 'counter', 'timestamp': 0, 'tags': {'id': 0}, 'values': {'counter': 1}}]
+        with mock.patch.object(cherrypy.engine, 'publish', side_effect=lambda *args: [receivers]), \
+                mock.patch.object(cherrypy.request.remote, 'ip', '10.0.0.2'), \
+                mock.patch('gateway.webservice.msgpack.dumps', side_effect=msgpack.dumps) as dumps:
+            self.web.distribute_metrics(metrics)
+            self.web.distribute_metrics(metrics)
+        self.assertEqual(4, dumps.call_count)  # Once per metric, per batch
+        self.assertEqual(3, self.user_controller.check_token.call_count)  # Once per socket
+        for socket in sockets[:2]:
+            self.assertEqual([mock.call(msgpack.dumps(metrics[0]))] * 2, socket.enqueue.call_args_list)
+        self.assertEqual(4, sockets[2].enqueue.call_count)
+
+    def test_send_event_websocket(self):
+        self.user_controller.check_token.side_effect = lambda token: token == 'valid'
+        sockets = [mock.Mock(), mock.Mock(), mock.Mock()]
+        receivers = {'a': {'subscribed_types': [GatewayEvent.Types.OUTPUT_CHANGE], 'token': 'valid', 'socket': sockets[0]},
+                     'b': {'subscribed_types': [GatewayEvent.Types.OUTPUT_CHANGE], 'token': 'expired', 'socket': sockets[1]},
+                     'c': {'subscribed_types': [], 'token': 'valid', 'socket': sockets[2]}}
+        event = GatewayEvent(GatewayEvent.Types.OUTPUT_CHANGE, {'id': 1, 'status': {'on': True}})
+        with mock.patch.object(cherrypy.engine, 'publish', side_effect=lambda *args: [receivers]), \
+                mock.patch.object(cherrypy.request.remote, 'ip', '10.0.0.2'), \
+                mock.patch('gateway.webservice.msgpack.dumps', side_effect=msgpack.dumps) as dumps:
+            self.web.send_event_websocket(event)
+        self.assertEqual(1, dumps.call_count)
+        sockets[0].enqueue.assert_called_once_with(msgpack.dumps(event.serialize()), key=(GatewayEvent.Types.OUTPUT_CHANGE, 1))
+        sockets[1].enqueue.assert_not_called()
+        sockets[1].close.assert_called_once_with(401, 'invalid_token')
+        sockets[2].enqueue.assert_not_called()
@@ -0,0 +1,103 @@
+# Copyright (C) 2020 OpenMotics BV
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the websockets
+"""
+from __future__ import absolute_import
+
+import threading
+import time
+import unittest
+
+import mock
+import xmlrunner
+
+from gateway.events import GatewayEvent
+from gateway.websockets import EventsSocket, OMSocket, SendQueueStopped
+
+
+class WebSocketsTest(unittest.TestCase):
+    def setUp(self):
+        self.socket = OMSocket(mock.Mock())
+        self.sent = []
+        self.unblock = threading.Event()
+        self.unblock.set()
+
+        def send(payload, binary=False):
+            self.assertTrue(binary)
+            self.unblock.wait(2)
+            self.sent.append(payload)
+
+        self.socket.send = send
+        self.socket.close = mock.Mock()
+
+    def _wait_for(self, condition):
+        end = time.time() + 2
+        while not condition() and time.time() < end:
+            time.sleep(0.01)
+        self.assertTrue(condition())
+
+    def tearDown(self):
+        self.unblock.set()
+        self.socket.closed(1000)
+
+    def test_send_queue(self):
+        totals = OMSocket.get_statistics()
+        for i in range(3):
+            self.socket.enqueue(bytearray([i]))
+        self._wait_for(lambda: len(self.sent) == 3)
+        self.assertEqual([bytearray([0]), bytearray([1]), bytearray([2])], self.sent)
+        self.assertEqual(3, self.socket.send_statistics['sent'])
+        self.assertEqual(0, self.socket.send_statistics['queue'])
+        self.assertEqual(totals['sent'] + 3, OMSocket.get_statistics()['sent'])
+        self.assertIsNot(OMSocket.STATISTICS, OMSocket.get_statistics())
+
+    def test_coalescing(self):
+        self.unblock.clear()  # Simulate a slow client
+        self.socket.enqueue(b'first')
+        self._wait_for(lambda: self.socket.send_statistics['queue'] == 0)  # Being sent
+        for status in [b'on', b'off', b'on']:
+            self.socket.enqueue(status, key=('OUTPUT_CHANGE', 1))
+        self.socket.enqueue(b'other', key=('OUTPUT_CHANGE', 2))
+        self.unblock.set()
+        self._wait_for(lambda: len(self.sent) == 3)
+        self.assertEqual([b'first', b'on', b'other'], self.sent)
+        self.assertEqual(2, self.socket.send_statistics['coalesced'])
+
+        event = GatewayEvent(GatewayEvent.Types.OUTPUT_CHANGE, {'id': 1, 'status': {'on': True}})
+        self.assertEqual((GatewayEvent.Types.OUTPUT_CHANGE, 1), EventsSocket.get_coalesce_key(event))
+        event = GatewayEvent(GatewayEvent.Types.INPUT_CHANGE, {'id': 1, 'status': True})
+        self.assertIsNone(EventsSocket.get_coalesce_key(event))
+
+    def test_overflow(self):
+        self.unblock.clear()
+        with mock.patch.object(OMSocket, 'SEND_QUEUE_SIZE', 5):
+            self.socket.enqueue(b'first')
+            self._wait_for(lambda: self.socket.send_statistics['queue'] == 0)
+            for _ in range(5):
+                self.socket.enqueue(b'data')
+            with self.assertRaises(SendQueueStopped):
+                self.socket.enqueue(b'data')
+        self.assertEqual(6, self.socket.send_statistics['dropped'])
+        self.unblock.set()
+        self._wait_for(lambda: self.socket.close.called)
+        self.socket.close.assert_called_once_with(1013, 'send queue overflow')
+        self.assertEqual([b'first'], self.sent)
+        with self.assertRaises(SendQueueStopped):
+            self.socket.enqueue(b'data')
+
+
+if __name__ == '__main__':
+    unittest.main(testRunner=xmlrunner.XMLTestRunner(output='../gw-unit-reports'))
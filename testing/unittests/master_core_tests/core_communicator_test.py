@@ -13,6 +13,9 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 from __future__ import absolute_import
+import logging
+import random
+import time
 import unittest
 
 import mock
@@ -20,7 +23,12 @@ import xmlrunner
 
 import master.core.core_communicator
 from ioc import SetTestMode, SetUpTestInjections
-from master.core.core_communicator import Consumer, CoreCommunicator
+from master.core.core_api import CoreAPI
+from master.core.core_communicator import Consumer, CoreCommunicator, \
+    CoreFrameDecoder, RingBuffer
+from serial_utils import CommunicationTimedOutException
+
+logger = logging.getLogger('openmotics')
 
 
 class CoreCommunicatorTest(unittest.TestCase):
@@ -34,6 +42,180 @@ class CoreCommunicatorTest(unittest.TestCase):
             self.assertRaises(AttributeError, communicator.do_command, None, {})
             discard.assert_called_with(3)
 
+    def test_do_commands(self):
+        communicator = CoreCommunicator(controller_serial=mock.Mock())
+        counters = {'sent': 0, 'received': 0, 'max_in_flight': 0}
+        wait_for_result = communicator._wait_for_result
+
+        def _send_command(cid, command, fields):
+            counters['sent'] += 1
+            counters['max_in_flight'] = max(counters['max_in_flight'], counters['sent'] - counters['received'])
+            # Simulate the read thread delivering the reply
+            for consumer in communicator._consumers[Consumer(command, cid).get_hash()]:
+                consumer.consume(bytearray([fields['type'], fields['action'], 0, fields['device_nr'], 0, 0]))
+
+        def _wait_for_result(consumer, timeout):
+            counters['received'] += 1
+            return wait_for_result(consumer, timeout)
+
+        with mock.patch.object(communicator, '_send_command', side_effect=_send_command), \
+                mock.patch.object(communicator, '_wait_for_result', side_effect=_wait_for_result):
+            results = communicator.do_commands([(CoreAPI.basic_action(), {'type': 1, 'action': i, 'device_nr': i, 'extra_parameter': 0})
+                                                for i in range(5)], window_size=2)
+        self.assertEqual([{'type': 1, 'action': i, 'device_nr': i, 'extra_parameter': 0} for i in range(5)], results)
+        self.assertEqual(2, counters['max_in_flight'])
+
+    def test_do_commands_timeout(self):
+        communicator = CoreCommunicator(controller_serial=mock.Mock())
+        with mock.patch.object(communicator, '_send_command'):
+            with self.assertRaises(CommunicationTimedOutException):
+                communicator.do_commands([(CoreAPI.basic_action(), {'type': 1, 'action': i, 'device_nr': 0, 'extra_parameter': 0})
+                                          for i in range(3)], timeout=0.01)
+        # All consumers are unregistered and their CIDs released
+        self.assertEqual(set(), communicator._cids_in_use)
+        self.assertEqual([], [c for consumers in communicator._consumers.values() for c in consumers])
+
+    def test_read_thread(self):
+        frames = [CoreCommunicatorTest._build_reply(5, 'BA', bytearray([1, 2, 0, 3, 0, 4])),
+                  CoreCommunicatorTest._build_reply(0, 'EV', bytearray([0, 1, 0, 2, 0, 0, 0, 0]))]
+        stream = bytearray(b'\x00junk') + frames[0] + frames[1]
+        serial = mock.Mock()
+        serial.inWaiting.side_effect = lambda: len(stream)
+
+        def _read(size):
+            data = stream[:size]
+            del stream[:size]
+            return bytes(data)
+
+        serial.read.side_effect = _read
+        communicator = CoreCommunicator(controller_serial=serial)
+        consumer = Consumer(CoreAPI.basic_action(), 5)
+        communicator.register_consumer(consumer)
+        events = []
+        event_consumer = mock.Mock(cid=0)
+        event_consumer.get_hash.return_value = Consumer(CoreAPI.event_information(), 0).get_hash()
+        event_consumer.consume.side_effect = events.append
+        communicator.register_consumer(event_consumer)
+
+        def _select(*args):
+            if communicator._consumers[consumer.get_hash()] == [] and events:
+                communicator._stop = True
+            return [], [], []
+
+        with mock.patch.object(master.core.core_communicator.select, 'select', side_effect=_select):
+            communicator._read()
+        self.assertEqual({'type': 1, 'action': 2, 'device_nr': 3, 'extra_parameter': 4}, consumer.get(0))
+        self.assertEqual([bytearray([0, 1, 0, 2, 0, 0, 0, 0])], events)
+        self.assertEqual(len(frames[0]) + len(frames[1]) + 5, communicator.get_communication_statistics()['bytes_read'])
+
+
+    @staticmethod
+    def _build_reply(cid, instruction, payload):
+        checked_payload = (bytearray([cid]) +
+                           bytearray(instruction.encode()) +
+                           bytearray([len(payload) // 256, len(payload) % 256]) +
+                           payload)
+        return (CoreCommunicator.START_OF_REPLY +
+                checked_payload +
+                bytearray(b'C') +
+                CoreCommunicator._calculate_crc(checked_payload) +
+                CoreCommunicator.END_OF_REPLY)
+
+
+class RingBufferTest(unittest.TestCase):
+    def test_wrap_around(self):
+        ring = RingBuffer(8)
+        ring.write(b'abcdef')
+        ring.skip(4)
+        ring.write(b'ghijkl')
+        self.assertEqual(8, len(ring))
+        self.assertEqual(0, ring.free)
+        self.assertEqual(bytearray(b'efghijkl'), ring.copy(0, 8))
+        self.assertEqual(bytearray(b'ghi'), ring.copy(2, 3))
+        self.assertEqual(ord('h'), ring[3])
+        with self.assertRaises(IndexError):
+            ring.copy(6, 3)
+        # Overflow drops the oldest data
+        ring.write(b'mn')
+        self.assertEqual(bytearray(b'ghijklmn'), ring.copy(0, 8))
+
+    def test_find(self):
+        ring = RingBuffer(8)
+        ring.write(b'xxxxxx')
+        ring.skip(5)
+        ring.write(b'xRTRxxx')  # 'RTR' straddles the wrap point
+        self.assertEqual(2, ring.find(bytearray(b'RTR')))
+        self.assertEqual(-1, ring.find(bytearray(b'RTR'), 3))
+        ring.skip(3)
+        self.assertEqual(0, ring.find(bytearray(b'TRx')))
+        self.assertEqual(2, ring.find(bytearray(b'xxx')))
+        self.assertEqual(-1, ring.find(bytearray(b'RTR')))
+
+
+class CoreFrameDecoderTest(unittest.TestCase):
+    def test_decode(self):
+        frame = CoreCommunicatorTest._build_reply(3, 'MR', bytearray(b'E\x00\x01\x00abcd'))
+        decoder = CoreFrameDecoder()
+        for i in range(len(frame) - 1):
+            decoder.feed(frame[i:i + 1])
+            self.assertIsNone(decoder.decode())
+        decoder.feed(frame[-1:])
+        message, header_fields = decoder.decode()
+        self.assertEqual(frame, message)
+        self.assertEqual({'cid': 3,
+                          'command': bytearray(b'MR'),
+                          'hash': Consumer(CoreAPI.memory_read(), 3).get_hash(),
+                          'length': 8}, header_fields)
+        self.assertIsNone(decoder.decode())
+
+    def test_resync(self):
+        valid = CoreCommunicatorTest._build_reply(4, 'BA', bytearray([1, 2, 0, 3, 0, 4]))
+        bad_crc = bytearray(valid)
+        bad_crc[-3] = (bad_crc[-3] + 1) % 256
+        bad_boundaries = bytearray(valid)
+        bad_boundaries[-1] = 0
+        decoder = CoreFrameDecoder(capacity=64)
+        decoder.feed(b'\x00RT\x00' + bad_crc + b'RTR\x00' + bad_boundaries + b'\x00\x00' + valid)
+        results = []
+        while True:
+            frame = decoder.decode()
+            if frame is None:
+                break
+            results.append(frame)
+        self.assertEqual([(bad_crc, None), (bad_boundaries, None)], [r for r in results if r[1] is None])
+        self.assertEqual([valid], [r[0] for r in results if r[1] is not None])
+
+    def test_decoder_benchmark(self):
+        """ Feeds a recorded RTR stream (events, memory reads and basic action replies) in random chunks """
+        recorded = [CoreCommunicatorTest._build_reply(0, 'EV', bytearray([0, 1, 0, 12, 0, 0, 0, 0])),
+                    CoreCommunicatorTest._build_reply(7, 'MR', bytearray(b'E\x00\x10\x00') + bytearray(range(32))),
+                    CoreCommunicatorTest._build_reply(9, 'BA', bytearray([0, 1, 0, 12, 0, 0])),
+                    CoreCommunicatorTest._build_reply(1, 'TM', bytearray(range(16)))]
+        amount = 5000
+        stream = bytearray().join(recorded[i % len(recorded)] for i in range(amount))
+        random.seed(0)
+        chunks = []
+        offset = 0
+        while offset < len(stream):
+            size = random.randint(1, 512)
+            chunks.append(bytes(stream[offset:offset + size]))
+            offset += size
+
+        decoder = CoreFrameDecoder()
+        decoded = 0
+        start = time.time()
+        for chunk in chunks:
+            decoder.feed(chunk)
+            while True:
+                frame = decoder.decode()
+                if frame is None:
+                    break
+                self.assertIsNotNone(frame[1])
+                decoded += 1
+        duration = time.time() - start
+        self.assertEqual(amount, decoded)
+        logger.info('Decoded {0} frames ({1} bytes) in {2:.3f}s'.format(decoded, len(stream), duration))
+
 
 if __name__ == "__main__":
     unittest.main(testRunner=xmlrunner.XMLTestRunner(output='../gw-unit-reports'))
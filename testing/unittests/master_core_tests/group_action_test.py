@@ -90,6 +90,7 @@ class GroupActionTest(unittest.TestCase):
 
         master_communicator = Mock()
         master_communicator.do_command = _do_command
+        master_communicator.do_commands = lambda commands, timeout=None: [_do_command(command, fields, timeout) for command, fields in commands]
         master_communicator.do_basic_action = _do_basic_action
 
         SetUpTestInjections(master_communicator=master_communicator,
@@ -17,12 +17,16 @@ Tests for the memory_file module
 """
 
 from __future__ import absolute_import
+import os
+import shutil
+import tempfile
 import unittest
 import xmlrunner
 import logging
 from mock import Mock
 from ioc import SetTestMode, SetUpTestInjections
 from master.core.memory_file import MemoryTypes, MemoryFile
+from master.memory_snapshot import MemorySnapshot
 from master.core.memory_types import MemoryAddress
 from logs import Logs
 
@@ -35,6 +39,12 @@ class MemoryFileTest(unittest.TestCase):
         SetTestMode()
         Logs.setup_logger(log_level=logging.DEBUG)
 
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._tempdir)
+
     def test_data_consistency(self):
         memory = {}
 
@@ -55,7 +65,8 @@ class MemoryFileTest(unittest.TestCase):
 
         master_communicator = Mock()
         master_communicator.do_command = _do_command
-        SetUpTestInjections(master_communicator=master_communicator)
+        master_communicator.do_commands = lambda commands, timeout=None: [_do_command(command, fields, timeout) for command, fields in commands]
+        SetUpTestInjections(master_communicator=master_communicator, pubsub=Mock())
 
         memory_file = MemoryFile(MemoryTypes.EEPROM)
 
@@ -71,5 +82,169 @@ class MemoryFileTest(unittest.TestCase):
         self.assertEqual(bytearray([6, 7, 8]), memory[5][10:13])
 
 
+    def test_snapshot(self):
+        memory = dict((page, bytearray([page] * 256)) for page in range(20))
+        memory[5] = bytearray(range(256))
+        reads = []
+        writes = []
+
+        def _do_command(command, fields, timeout=None):
+            _ = timeout
+            instruction = ''.join(str(chr(c)) for c in command.instruction)
+            if instruction == 'MR':
+                reads.append(fields['page'])
+                return {'data': memory[fields['page']][fields['start']:fields['start'] + fields['length']]}
+            if instruction == 'MW':
+                writes.append((fields['page'], fields['start'], fields['data']))
+                for index, data_byte in enumerate(fields['data']):
+                    memory[fields['page']][fields['start'] + index] = data_byte
+
+        master_communicator = Mock()
+        master_communicator.do_commands = lambda commands, timeout=None: [_do_command(command, fields, timeout) for command, fields in commands]
+        SetUpTestInjections(master_communicator=master_communicator, pubsub=Mock())
+
+        path = os.path.join(self._tempdir, 'eeprom.snapshot')
+        address = MemoryAddress(memory_type=MemoryTypes.EEPROM, page=5, offset=10, length=3)
+        memory_file = MemoryFile(MemoryTypes.EEPROM, snapshot_path=path)
+        memory_file.read_pages(range(20))
+        self.assertEqual(20 * 8, len(reads))
+
+        # A restart only reads the sampled pages
+        del reads[:]
+        memory_file = MemoryFile(MemoryTypes.EEPROM, snapshot_path=path)
+        self.assertEqual(bytearray([10, 11, 12]), memory_file.read([address])[address])
+        self.assertIn(0, reads)
+        self.assertEqual((MemoryFile.SNAPSHOT_SAMPLES + 1) * 8, len(reads))
+
+        # Pages from the snapshot are read again before writing, since they might have been changed in the meantime
+        sampled_pages = set(reads)
+        page = [page for page in range(1, 20) if page not in sampled_pages][0]
+        memory[page][0] = 42
+        del reads[:]
+        memory_file.write({MemoryAddress(MemoryTypes.EEPROM, page, 0, 2): bytearray([page, page])})
+        self.assertEqual([page] * 8, reads)
+        self.assertEqual([(page, 0, bytearray([page]))], writes)
+
+        # An EEPROM_ACTIVATE from another source invalidates the snapshot
+        memory[5][10] = 42
+        memory_file._handle_event({'type': 254, 'action': 0, 'device_nr': 0, 'data': bytearray([0, 0, 0, 0])})
+        del reads[:]
+        memory_file = MemoryFile(MemoryTypes.EEPROM, snapshot_path=path)
+        self.assertEqual(bytearray([42, 11, 12]), memory_file.read([address])[address])
+        self.assertEqual([5] * 8, reads)
+
+    def test_snapshot_outdated(self):
+        memory = dict((page, bytearray([page] * 256)) for page in range(4))
+        reads = []
+
+        def _do_command(command, fields, timeout=None):
+            _ = timeout
+            reads.append(fields['page'])
+            return {'data': memory[fields['page']][fields['start']:fields['start'] + fields['length']]}
+
+        master_communicator = Mock()
+        master_communicator.do_commands = lambda commands, timeout=None: [_do_command(command, fields, timeout) for command, fields in commands]
+        SetUpTestInjections(master_communicator=master_communicator, pubsub=Mock())
+
+        path = os.path.join(self._tempdir, 'eeprom.snapshot')
+        MemoryFile(MemoryTypes.EEPROM, snapshot_path=path).read_pages(range(4))
+
+        # Changed while the gateway wasn't running (e.g. a firmware update)
+        memory[2] = bytearray([255] * 256)
+        del reads[:]
+        memory_file = MemoryFile(MemoryTypes.EEPROM, snapshot_path=path)
+        self.assertEqual(bytearray([255] * 256), memory_file.read_pages([2])[2])
+        self.assertEqual([0, 1, 2, 3], sorted(set(reads)))
+
+        # Invalidating the cache (e.g. after maintenance mode) discards the snapshot
+        memory[3] = bytearray([255] * 256)
+        memory_file.invalidate_cache()
+        del reads[:]
+        memory_file = MemoryFile(MemoryTypes.EEPROM, snapshot_path=path)
+        self.assertEqual(bytearray([255] * 256), memory_file.read_pages([3])[3])
+        self.assertEqual([3] * 8, reads)
+
+    def test_snapshot_validation(self):
+        path = os.path.join(self._tempdir, 'eeprom.snapshot')
+        snapshot = MemorySnapshot(path, pages=4, page_length=16)
+        snapshot.store(1, bytearray(range(16)))
+        snapshot.store(2, bytearray(range(16)))
+        self.assertEqual(bytearray(range(16)), snapshot.load(1))
+        self.assertIsNone(snapshot.load(0))
+        snapshot.invalidate(2)
+        self.assertIsNone(snapshot.load(2))
+        snapshot._mmap.close()
+
+        # Corrupt a data byte of page 1
+        offset = MemorySnapshot.HEADER.size + 1 * (MemorySnapshot.RECORD_HEADER.size + 16) + MemorySnapshot.RECORD_HEADER.size
+        with open(path, 'r+b') as snapshot_file:
+            snapshot_file.seek(offset)
+            snapshot_file.write(b'\xff')
+        snapshot = MemorySnapshot(path, pages=4, page_length=16)
+        self.assertIsNone(snapshot.load(1))
+
+        # A different layout discards the snapshot
+        snapshot.store(1, bytearray(range(16)))
+        snapshot._mmap.close()
+        snapshot = MemorySnapshot(path, pages=8, page_length=16)
+        self.assertIsNone(snapshot.load(1))
+        snapshot._mmap.close()
+
+    def test_write_coalescing(self):
+        memory = {5: bytearray([255] * 256), 6: bytearray([255] * 256)}
+        writes = []
+
+        def _do_command(command, fields, timeout=None):
+            _ = timeout
+            instruction = ''.join(str(chr(c)) for c in command.instruction)
+            if instruction == 'MR':
+                return {'data': memory[fields['page']][fields['start']:fields['start'] + fields['length']]}
+            if instruction == 'MW':
+                writes.append((fields['type'], fields['page'], fields['start'], fields['data']))
+                page_data = memory[fields['page']]
+                for index, data_byte in enumerate(fields['data']):
+                    page_data[fields['start'] + index] = data_byte
+
+        master_communicator = Mock()
+        master_communicator.do_commands = lambda commands, timeout=None: [_do_command(command, fields, timeout) for command, fields in commands]
+        SetUpTestInjections(master_communicator=master_communicator, pubsub=Mock())
+
+        # EEPROM: only changed bytes are written, once per page, close changes are merged
+        memory_file = MemoryFile(MemoryTypes.EEPROM)
+        with memory_file.write_transaction():
+            memory_file.write({MemoryAddress(MemoryTypes.EEPROM, 5, 10, 3): bytearray([1, 255, 3])})
+            memory_file.write({MemoryAddress(MemoryTypes.EEPROM, 5, 14, 2): bytearray([4, 5])})
+            memory_file.write({MemoryAddress(MemoryTypes.EEPROM, 5, 100, 1): bytearray([6])})
+            memory_file.write({MemoryAddress(MemoryTypes.EEPROM, 6, 0, 4): bytearray([255] * 4)})
+            address = MemoryAddress(MemoryTypes.EEPROM, 5, 10, 6)
+            self.assertEqual(bytearray([1, 255, 3, 255, 4, 5]), memory_file.read([address])[address])
+            self.assertEqual([], writes)
+        self.assertEqual([('E', 5, 10, bytearray([1, 255, 3, 255, 4, 5])),
+                          ('E', 5, 100, bytearray([6]))], writes)
+        self.assertEqual(bytearray([1, 255, 3, 255, 4, 5]), memory[5][10:16])
+
+        # A failed transaction doesn't write anything
+        del writes[:]
+        with self.assertRaises(RuntimeError):
+            with memory_file.write_transaction():
+                memory_file.write({MemoryAddress(MemoryTypes.EEPROM, 5, 0, 1): bytearray([0])})
+                raise RuntimeError()
+        self.assertEqual([], writes)
+
+        # FRAM: only written bytes are sent, since the data in between is unknown
+        memory_file = MemoryFile(MemoryTypes.FRAM)
+        memory_file.write({MemoryAddress(MemoryTypes.FRAM, 6, 0, 2): bytearray([1, 2]),
+                           MemoryAddress(MemoryTypes.FRAM, 6, 2, 1): bytearray([3]),
+                           MemoryAddress(MemoryTypes.FRAM, 6, 5, 1): bytearray([4])})
+        self.assertEqual([('F', 6, 0, bytearray([1, 2, 3])),
+                          ('F', 6, 5, bytearray([4]))], writes)
+
+    def test_write_ranges(self):
+        self.assertEqual([], MemoryFile._get_write_ranges([], gap=8))
+        self.assertEqual([(0, 1), (2, 2)], MemoryFile._get_write_ranges([0, 2, 3], gap=0))
+        self.assertEqual([(0, 4)], MemoryFile._get_write_ranges([0, 2, 3], gap=8))
+        self.assertEqual([(0, 32), (32, 8)], MemoryFile._get_write_ranges(list(range(40)), gap=0))
+
+
 if __name__ == "__main__":
     unittest.main(testRunner=xmlrunner.XMLTestRunner(output='../gw-unit-reports'))
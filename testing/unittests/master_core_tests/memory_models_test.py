@@ -20,7 +20,7 @@ from __future__ import absolute_import
 import unittest
 import xmlrunner
 import logging
-from mock import Mock
+from mock import MagicMock, Mock
 from ioc import SetTestMode, SetUpTestInjections
 from master.core.memory_models import *
 from master.core.memory_file import MemoryTypes, MemoryFile, MemoryAddress
@@ -160,7 +160,7 @@ class MemoryModelsTest(unittest.TestCase):
                 for index, data_byte in enumerate(data_):
                     memory_map[address.memory_type][address.page][address.offset + index] = data_byte
 
-        memory_file_mock = Mock(MemoryFile)
+        memory_file_mock = MagicMock(MemoryFile)
         memory_file_mock.read = _read
         memory_file_mock.write = _write
 
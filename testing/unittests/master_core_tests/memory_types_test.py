@@ -20,7 +20,7 @@ from __future__ import absolute_import
 import unittest
 import xmlrunner
 from peewee import DoesNotExist
-from mock import Mock
+from mock import MagicMock, Mock
 from ioc import SetTestMode, SetUpTestInjections
 from master.core.basic_action import BasicAction  # Must be imported
 from master.core.memory_types import *
@@ -139,7 +139,7 @@ class MemoryTypesTest(unittest.TestCase):
 
     def test_memory_field_container(self):
         address = MemoryAddress(MemoryTypes.EEPROM, 0, 1, 1)
-        memory_file_mock = Mock(MemoryFile)
+        memory_file_mock = MagicMock(MemoryFile)
         memory_file_mock.read.return_value = {address: bytearray([1])}
         container = MemoryFieldContainer(name='field',
                                          memory_field=MemoryByteField(MemoryTypes.EEPROM, address_spec=(0, 1)),
@@ -412,6 +412,98 @@ class MemoryTypesTest(unittest.TestCase):
         instance.save()
         self.assertEqual(bytearray([20, 235, 0, 255]), memory_map[0])
 
+    def test_load_many(self):
+        memory_map = {1: bytearray([40, 0b0101, 41, 0b1011]),
+                      2: bytearray([42, 0b1000, 0, 255])}
+        read_pages = MemoryTypesTest._mock_memory(memory_map)
+
+        class Item(MemoryModelDefinition):
+            class _ItemComposed(CompositeMemoryModelDefinition):
+                info = CompositeNumberField(start_bit=0, width=3, value_offset=2)
+                bit = CompositeBitField(bit=3)
+
+            id = IdField(limits=(0, 3))
+            info = MemoryByteField(MemoryTypes.EEPROM, address_spec=lambda id: (1 + id // 2, id % 2 * 2))
+            composed = _ItemComposed(field=MemoryByteField(MemoryTypes.EEPROM, address_spec=lambda id: (1 + id // 2, id % 2 * 2 + 1)))
+            checked = MemoryByteField(MemoryTypes.EEPROM, address_spec=lambda id: (2, 2),
+                                      checksum=MemoryChecksum(field=MemoryByteField(MemoryTypes.EEPROM, address_spec=lambda id: (2, 3)),
+                                                              check=MemoryChecksum.Types.INVERTED))
+
+        records = Item.load_many([0, 1, 2])
+        self.assertEqual([[1, 2]], read_pages)  # Every page is only read once
+        self.assertEqual([Item(i).serialize() for i in range(3)], [record.serialize() for record in records])
+        self.assertEqual({'id': 1, 'info': 41, 'composed': {'bit': True, 'info': 1}, 'checked': 0}, records[1].serialize())
+
+        records = Item.load_many([2, 0], fields=['info'])
+        self.assertEqual([42, 40], [record.info for record in records])
+        self.assertEqual({'id': 2, 'info': 42}, records[0].serialize())
+        with self.assertRaises(AttributeError):
+            _ = records[0].composed
+
+        with self.assertRaises(ValueError):
+            Item.load_many([0], fields=['foo'])
+        with self.assertRaises(DoesNotExist):
+            Item.load_many([0, 4])
+        memory_map[2][3] = 123
+        with self.assertRaises(InvalidMemoryChecksum):
+            Item.load_many([0], fields=['checked'])
+
+    def test_memory_transaction(self):
+        memory_map = {MemoryTypes.EEPROM: {0: bytearray([255] * 256)},
+                      MemoryTypes.FRAM: {0: bytearray([255] * 256)}}
+        actions = []
+
+        def _do_commands(commands, timeout=None):
+            _ = timeout
+            for _command, fields in commands:
+                page_data = memory_map[fields['type']][fields['page']]
+                page_data[fields['start']:fields['start'] + len(fields['data'])] = fields['data']
+                actions.append('write {0}'.format(fields['type']))
+
+        def _do_basic_action(action_type, action, device_nr=0, extra_parameter=0, timeout=2, log=True):
+            _ = device_nr, extra_parameter, timeout, log
+            actions.append('activate {0}.{1}'.format(action_type, action))
+            for memory_file in memory_files.values():
+                memory_file._handle_event({'type': 254, 'action': 0, 'device_nr': 0, 'data': 0})
+
+        master_communicator = Mock()
+        master_communicator.do_commands = _do_commands
+        master_communicator.do_basic_action = _do_basic_action
+        SetUpTestInjections(master_communicator=master_communicator, pubsub=Mock())
+        memory_files = {MemoryTypes.EEPROM: MemoryFile(MemoryTypes.EEPROM),
+                        MemoryTypes.FRAM: MemoryFile(MemoryTypes.FRAM)}
+        memory_files[MemoryTypes.EEPROM]._cache = memory_map[MemoryTypes.EEPROM]
+        SetUpTestInjections(memory_files=memory_files)
+
+        class TransactionObject(MemoryModelDefinition):
+            eeprom_field = MemoryByteField(MemoryTypes.EEPROM, address_spec=(0, 0))
+            fram_field = MemoryByteField(MemoryTypes.FRAM, address_spec=(0, 0))
+
+        with memory_transaction():
+            for value in [1, 2]:
+                instance = TransactionObject(None)
+                instance.eeprom_field = value
+                instance.fram_field = value
+                instance.save()
+            self.assertEqual([], actions)
+        # All writes are flushed once and there's a single activation for both memory types
+        self.assertEqual(['write E', 'write F'], sorted(actions[:2]))
+        self.assertEqual(['activate 200.1'], actions[2:])
+        self.assertEqual(2, memory_map[MemoryTypes.EEPROM][0][0])
+        self.assertEqual(2, memory_map[MemoryTypes.FRAM][0][0])
+        for memory_file in memory_files.values():
+            self.assertFalse(memory_file.dirty)
+
+        # A failing transaction doesn't write nor activate
+        del actions[:]
+        with self.assertRaises(RuntimeError):
+            with memory_transaction():
+                instance = TransactionObject(None)
+                instance.eeprom_field = 3
+                instance.save()
+                raise RuntimeError()
+        self.assertEqual([], actions)
+
     @staticmethod
     def _mock_memory(memory_map):
         def _read(addresses):
@@ -425,11 +517,19 @@ class MemoryTypesTest(unittest.TestCase):
                 for index, data_byte in enumerate(data_):
                     memory_map[address.page][address.offset + index] = data_byte
 
-        memory_file_mock = Mock(MemoryFile)
+        def _read_pages(pages):
+            pages = sorted(pages)
+            read_pages.append(pages)
+            return dict((page, memory_map[page]) for page in pages)
+
+        read_pages = []
+        memory_file_mock = MagicMock(MemoryFile)
         memory_file_mock.read = _read
+        memory_file_mock.read_pages = _read_pages
         memory_file_mock.write = _write
 
         SetUpTestInjections(memory_files={MemoryTypes.EEPROM: memory_file_mock})
+        return read_pages
 
 
 if __name__ == "__main__":
@@ -19,6 +19,8 @@ Tests for the eeprom_controller module.
 from __future__ import absolute_import
 
 import os
+import shutil
+import tempfile
 import unittest
 
 import mock
@@ -112,7 +114,8 @@ def get_eeprom_file_dummy(banks):
 
         banks[data['bank']] = bank[0:address] + data_bytes + bank[address+len(data_bytes):]
 
-    SetUpTestInjections(master_communicator=MasterCommunicator(list_fct, write_fct))
+    SetUpTestInjections(master_communicator=MasterCommunicator(list_fct, write_fct),
+                        eeprom_snapshot_file=None)
     return EepromFile()
 
 
@@ -490,6 +493,19 @@ class MasterCommunicator(object):
 class EepromFileTest(unittest.TestCase):
     """ Tests for EepromFile. """
 
+    @classmethod
+    def setUpClass(cls):
+        SetTestMode()
+
+    def setUp(self):  # pylint: disable=C0103
+        """ Run before each test. """
+        self._tempdir = tempfile.mkdtemp()
+        SetUpTestInjections(eeprom_snapshot_file=None)
+
+    def tearDown(self):  # pylint: disable=C0103
+        """ Run after each test. """
+        shutil.rmtree(self._tempdir)
+
     def test_read_one_bank_one_address(self):
         """ Test read from one bank with one address """
         def read(_data):
@@ -838,6 +854,78 @@ class EepromFileTest(unittest.TestCase):
         eeprom_file.write([EepromData(EepromAddress(117, 248, 8), bytearray(b'test') + bytearray([255] * 4))])
         self.assertTrue(done['done'])
 
+    def test_snapshot(self):
+        """ A verified snapshot is reused after a restart. """
+        banks = dict((bank, bytearray([bank] * 256)) for bank in range(20))
+        reads = []
+
+        def read(data):
+            """ Read dummy. """
+            reads.append(data['bank'])
+            return {'data': banks[data['bank']]}
+
+        def write(data):
+            """ Write dummy. """
+            bank = banks[data['bank']]
+            banks[data['bank']] = bank[:data['address']] + data['data'] + bank[data['address'] + len(data['data']):]
+
+        SetUpTestInjections(master_communicator=MasterCommunicator(read, write),
+                            eeprom_snapshot_file=os.path.join(self._tempdir, 'eeprom.snapshot'))
+
+        eeprom_file = EepromFile()
+        addresses = [EepromAddress(bank, 0, 256) for bank in banks]
+        eeprom_file.read(addresses)
+        self.assertEqual(sorted(banks), sorted(reads))
+
+        # A new instance (e.g. after a restart) only reads the sampled banks
+        del reads[:]
+        eeprom_file = EepromFile()
+        result = eeprom_file.read(addresses)
+        for address in addresses:
+            self.assertEqual(banks[address.bank], result[address].bytes)
+        self.assertIn(0, reads)
+        self.assertEqual(EepromFile.SNAPSHOT_SAMPLES + 1, len(reads))
+
+        # Banks from the snapshot are read again before they're written, as they might have changed
+        bank = sorted(set(banks) - set(reads))[0]
+        banks[bank] = bytearray([255] * 256)
+        del reads[:]
+        eeprom_file.write([EepromData(EepromAddress(bank, 0, 1), bytearray([bank]))])
+        self.assertEqual([bank], reads)
+        self.assertEqual(bytearray([bank] + [255] * 255), banks[bank])
+
+        # Invalidating the cache (e.g. after maintenance mode) verifies the snapshot again
+        del reads[:]
+        eeprom_file.invalidate_cache()
+        result = eeprom_file.read(addresses)
+        self.assertEqual(EepromFile.SNAPSHOT_SAMPLES + 1, len(reads))
+        for address in addresses:
+            self.assertEqual(banks[address.bank], result[address].bytes)
+
+    def test_snapshot_outdated(self):
+        """ A snapshot that doesn't match the master is discarded. """
+        banks = dict((bank, bytearray([bank] * 256)) for bank in range(4))
+        reads = []
+
+        def read(data):
+            """ Read dummy. """
+            reads.append(data['bank'])
+            return {'data': banks[data['bank']]}
+
+        SetUpTestInjections(master_communicator=MasterCommunicator(read),
+                            eeprom_snapshot_file=os.path.join(self._tempdir, 'eeprom.snapshot'))
+
+        addresses = [EepromAddress(bank, 0, 256) for bank in banks]
+        EepromFile().read(addresses)
+
+        # Changed while the gateway wasn't looking (e.g. maintenance mode)
+        banks[2] = bytearray([255] * 256)
+        del reads[:]
+        eeprom_file = EepromFile()
+        result = eeprom_file.read(addresses)
+        self.assertEqual(bytearray([255] * 256), result[EepromAddress(2, 0, 256)].bytes)
+        self.assertEqual([0, 1, 2, 3], sorted(reads))
+
 
 class EepromModelTest(unittest.TestCase):
     """ Tests for EepromModel. """
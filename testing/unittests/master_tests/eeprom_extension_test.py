@@ -63,6 +63,25 @@ class EepromExtensionTest(unittest.TestCase):
         self.assertEqual('value_2', ext.read_data('model_name', 2, 'some_field'))
         self.assertIsNone(ext.read_data('model_name', 3, 'some_field'))
 
+    def test_read_many(self):
+        """ Test reading multiple fields of multiple ids at once """
+        ext = EepromExtensionTest._get_extension()
+        ext.write_data([('model_name', 0, 'field_a', 'a_0'),
+                        ('model_name', 1, 'field_a', 'a_1'),
+                        ('model_name', 1, 'field_b', 'b_1'),
+                        ('other_model', 1, 'field_a', 'other')])
+        self.assertEqual({(None, 'field_a'): 'a_0', (None, 'field_b'): None,
+                          (1, 'field_a'): 'a_1', (1, 'field_b'): 'b_1',
+                          (2, 'field_a'): None, (2, 'field_b'): None},
+                         ext.read_many('model_name', [None, 1, 2], ['field_a', 'field_b']))
+        # The cache is kept in sync with the database
+        ext.write_data([('model_name', 2, 'field_a', 'a_2')])
+        ext.delete_data('model_name', 1, 'field_b')
+        expected = {(1, 'field_a'): 'a_1', (1, 'field_b'): None,
+                    (2, 'field_a'): 'a_2', (2, 'field_b'): None}
+        self.assertEqual(expected, ext.read_many('model_name', [1, 2], ['field_a', 'field_b']))
+        self.assertEqual(expected, EepromExtension().read_many('model_name', [1, 2], ['field_a', 'field_b']))
+
 
 if __name__ == "__main__":
     unittest.main(testRunner=xmlrunner.XMLTestRunner(output='../gw-unit-reports'))
@@ -22,6 +22,7 @@ import threading
 import time
 import unittest
 
+import mock
 import xmlrunner
 from pytest import mark
 
@@ -317,6 +318,31 @@ class MasterCommunicatorTest(unittest.TestCase):
         self.assertEqual(True, got_output['passed'])
         self.assertEqual(bytearray(b'OL\x00\x01\x03\x0c\r\n'), comm.get_passthrough_data())
 
+    def test_dispatch_table(self):
+        pty = DummyPty([])
+        SetUpTestInjections(controller_serial=pty)
+
+        outputs = []
+        consumer = BackgroundConsumer(master_api.output_list(), 0, outputs.append)
+        comm = MasterCommunicator(init_master=False)
+        comm.enable_passthrough()
+        with mock.patch.object(comm, '_MasterCommunicator__update_dispatch_table',
+                               wraps=comm._MasterCommunicator__update_dispatch_table) as update:
+            comm.register_consumer(consumer)
+            comm.start()
+            # Bytes that share the start byte of a prefix, but don't match it, go to the passthrough as a whole
+            pty.fd.write(bytearray(b'Ok OL\x01 junk OL\x00\x01\x03\x0c\r\n tail'))
+            self.assertEqual(bytearray(b'Ok OL\x01 junk  tail'), comm.get_passthrough_data())
+            self.assertEqual(1, update.call_count)
+            comm.unregister_consumer(consumer)
+            self.assertEqual(2, update.call_count)
+        time.sleep(0.3)
+        self.assertEqual([(3, int(12 * 10.0 / 6.0))], outputs[0]['outputs'])
+
+        pty.fd.write(bytearray(b'OL\x00\x01\x03\x0c\r\n'))
+        self.assertEqual(bytearray(b'OL\x00\x01\x03\x0c\r\n'), comm.get_passthrough_data())
+        consumer.stop()
+
     def test_bytes_counter(self):
         action = master_api.basic_action()
         fields = {'action_type': 1, 'action_number': 2}
@@ -42,6 +42,7 @@ from gateway.shutter_controller import ShutterController
 from ioc import SetTestMode, SetUpTestInjections
 from plugin_runtime.base import PluginConfigChecker, PluginException
 from logs import Logs
+from plugins.runner import PluginRunner
 
 MODELS = [Plugin]
 
@@ -580,6 +581,88 @@ class P2(OMPluginBase):
             PluginControllerTest._destroy_plugin('P1')
             PluginControllerTest._destroy_plugin('P2')
 
+    def test_process_observer_event(self):
+        """ Validates that every payload is built once, and only when a plugin subscribes to it """
+        output_controller = Mock(OutputController)
+        output_controller.get_output_statuses = Mock(return_value=[OutputStateDTO(id=1, status=True, dimmer=5)])
+        shutter_controller = Mock(ShutterController)
+        shutter_controller.get_states = Mock(return_value={'status': ['stopped'], 'detail': {}})
+        controller = PluginControllerTest._get_controller(output_controller=output_controller,
+                                                          shutter_controller=shutter_controller)
+        runners = {}
+        for name, decorators in [('P1', {'output_status': [1, 2], 'shutter_status': [3]}),
+                                 ('P2', {'output_status': [2], 'shutter_status': [1, 2]}),
+                                 ('P3', {})]:
+            runner = Mock(PluginRunner)
+            runner.is_running.return_value = True
+            runner.has_receiver.side_effect = lambda action, action_version, decorators=decorators: action_version in decorators.get(action, [])
+            runners[name] = runner
+        controller._runners = runners
+
+        output_event = GatewayEvent(event_type=GatewayEvent.Types.OUTPUT_CHANGE, data={'id': 1})
+        controller.process_observer_event(output_event)
+        self.assertEqual(1, output_controller.get_output_statuses.call_count)
+        self.assertEqual([('output_status', 1), ('output_status', 2)],
+                         [(call[0][0], call[1]['action_version']) for call in runners['P1'].process_status.call_args_list])
+        self.assertEqual([('output_status', 2)],
+                         [(call[0][0], call[1]['action_version']) for call in runners['P2'].process_status.call_args_list])
+        self.assertIs(runners['P1'].process_status.call_args_list[1][0][1], runners['P2'].process_status.call_args_list[0][0][1])
+        runners['P3'].process_status.assert_not_called()
+
+        runners['P1'].is_running.return_value = False
+        controller.process_observer_event(output_event)
+        self.assertEqual(1, output_controller.get_output_statuses.call_count)
+
+        shutter_event = GatewayEvent(event_type=GatewayEvent.Types.SHUTTER_CHANGE, data={'id': 1})
+        controller.process_observer_event(shutter_event)
+        self.assertEqual(1, shutter_controller.get_states.call_count)
+        self.assertEqual([('shutter_status', 1), ('shutter_status', 2)],
+                         [(call[0][0], call[1]['action_version']) for call in runners['P2'].process_status.call_args_list[2:]])
+
+    def test_distribute_metrics_routing(self):
+        """ Validates that metrics are routed through the (source, type) index """
+        controller = PluginControllerTest._get_controller()
+        filters = {'source': {'OpenMotics': {'OpenMotics'}, None: {'OpenMotics', 'P3'}},
+                   'metric_type': {'energy': {'energy'}, None: {'energy', 'counter'}}}
+        get_filter = Mock(side_effect=lambda filter_type, metric_filter: filters[filter_type][metric_filter])
+        controller.set_metrics_controller(type('MetricController', (), {'get_filter': staticmethod(get_filter),
+                                                                        'set_plugin_definitions': lambda _self, *args, **kwargs: None})())
+        runners = {}
+        for name, receivers, queued in [('P1', [{'name': 'energy', 'source': 'OpenMotics', 'metric_type': 'energy'}], True),
+                                        ('P2', [{'name': 'all', 'source': None, 'metric_type': None}], False)]:
+            runner = Mock(PluginRunner)
+            runner.name = name
+            runner.is_running.return_value = True
+            runner.get_metric_receivers.return_value = receivers
+            runner.distribute_metrics.return_value = queued
+            runners[name] = runner
+        controller._runners = runners
+
+        metrics = [{'source': source, 'type': metric_type, 'timestamp': 0, 'tags': {}, 'values': {}}
+                   for source, metric_type in [('OpenMotics', 'energy'), ('OpenMotics', 'counter'), ('P3', 'energy'),
+                                               ('OpenMotics', 'energy'), ('other', 'other')]]
+        rates = controller.distribute_metrics(metrics)
+        self.assertEqual({'total': 6, 'openmotics.energy': 4, 'openmotics.counter': 1, 'p3.energy': 1, 'other.other': 0}, rates)
+        runners['P1'].distribute_metrics.assert_called_once_with('energy', [metrics[0], metrics[3]])
+        runners['P2'].distribute_metrics.assert_called_once_with('all', metrics[:4])
+        self.assertEqual({'P1': {'energy': {'delivered': 2, 'dropped': 0}},
+                          'P2': {'all': {'delivered': 0, 'dropped': 4}}}, controller.get_metric_receiver_statistics())
+
+        # The routes are reused, until the receivers change
+        calls = get_filter.call_count
+        controller.distribute_metrics(metrics)
+        self.assertEqual(calls, get_filter.call_count)
+        statistics = controller.get_metric_receiver_statistics()
+        self.assertEqual({'delivered': 4, 'dropped': 0}, statistics['P1']['energy'])
+        controller.distribute_metrics(metrics)
+        self.assertEqual({'delivered': 4, 'dropped': 0}, statistics['P1']['energy'])  # A copy
+        self.assertEqual({'delivered': 6, 'dropped': 0}, controller.get_metric_receiver_statistics()['P1']['energy'])
+        runners['P2'].is_running.return_value = False
+        controller._update_dependencies()
+        controller.distribute_metrics(metrics)
+        self.assertEqual(3, runners['P2'].distribute_metrics.call_count)  # Not called anymore once stopped
+        self.assertEqual({'delivered': 8, 'dropped': 0}, controller.get_metric_receiver_statistics()['P1']['energy'])
+
     def test_check_plugin(self):
         """ Test the exception that can occur when checking a plugin. """
         from plugin_runtime.utils import check_plugin
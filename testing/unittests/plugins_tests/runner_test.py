@@ -21,8 +21,11 @@ import os
 import plugin_runtime
 import shutil
 import tempfile
+import time
 import unittest
 import xmlrunner
+from six.moves.queue import PriorityQueue
+from threading import Thread
 from plugins.runner import PluginRunner
 
 
@@ -51,6 +54,105 @@ class PluginRunnerTest(unittest.TestCase):
         runner = PluginRunner('foo', self.RUNTIME_PATH, self.PLUGIN_PATH, self._log)
         self.assertEqual(runner.get_queue_length(), 0)
 
+    def _get_running_runner(self, write, logs):
+        runner = PluginRunner('foo', self.RUNTIME_PATH, self.PLUGIN_PATH, logs.append, command_timeout=0.5)
+        runner._proc = type('Process', (), {'poll': lambda _: None})()
+        runner._writer = type('Writer', (), {'write': lambda _, command, **kwargs: write(command)})()
+        runner._process_running = True
+        return runner
+
+    def test_concurrent_commands(self):
+        commands = []
+        logs = []
+
+        def _write(command):
+            commands.append(command)
+            if command['action'] == 'collect_metrics':
+                # Answered right away, while the request is still being processed
+                runner._process_command({'cid': command['cid'], 'action': 'collect_metrics', 'metrics': [{'foo': 1}]})
+
+        runner = self._get_running_runner(_write, logs)
+        runner._metric_collectors = [{'name': 'collect', 'interval': 5}]
+        results = {}
+
+        def _request():
+            try:
+                runner.request('slow')
+            except Exception as ex:
+                results['request'] = str(ex)
+
+        request_thread = Thread(target=_request)
+        request_thread.start()
+        time.sleep(0.1)
+        start = time.time()
+        self.assertEqual([{'foo': 1, 'source': 'foo'}], list(runner.collect_metrics()))
+        self.assertLess(time.time() - start, 0.2)
+        self.assertNotIn('request', results)
+        request_thread.join()
+        self.assertEqual('Plugin did not respond', results['request'])
+        self.assertEqual({}, runner._pending_commands)
+
+        # A late response is dropped
+        runner._process_command({'cid': commands[0]['cid'], 'action': 'request', 'success': True, 'response': 'late'})
+        self.assertIn('unknown cid', logs[-1])
+
+        # Responses are matched on cid, regardless of their order
+        def _write_delayed(command):
+            commands.append(command)
+            if len(commands) == 2:
+                for pending in reversed(commands):
+                    runner._process_command({'cid': pending['cid'], 'action': 'request',
+                                             'success': True, 'response': pending['method']})
+
+        commands = []
+        runner = self._get_running_runner(_write_delayed, logs)
+        threads = [Thread(target=lambda method=method: results.update({method: runner.request(method)}))
+                   for method in ['first', 'second']]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual('first', results['first'])
+        self.assertEqual('second', results['second'])
+
+    def test_stop_aborts_pending_commands(self):
+        runner = self._get_running_runner(lambda command: None, [])
+        results = {}
+
+        def _request():
+            try:
+                runner.request('slow')
+            except Exception as ex:
+                results['request'] = str(ex)
+
+        request_thread = Thread(target=_request)
+        request_thread.start()
+        time.sleep(0.1)
+        runner._proc.poll = lambda: 1
+        runner._process_command({'cid': 0, 'action': 'logs', 'logs': ''})
+        request_thread.join()
+        self.assertEqual('Plugin was stopped', results['request'])
+
+    def test_async_priorities(self):
+        runner = self._get_running_runner(lambda command: None, [])
+        runner._async_command_queue = PriorityQueue(1000)
+        runner._decorators_in_use = {'output_status': [1], 'receive_events': [1]}
+        runner.distribute_metrics('receive', [{'foo': 1}])
+        runner.distribute_metrics('receive', [{'foo': 2}])
+        runner.process_status('output_status', {'status': [(1, 100)]})
+        runner.process_status('output_status', {'event': {}}, action_version=2)  # Not subscribed
+        runner._do_async('ping', {})
+        runner.process_event(5)
+        actions = []
+        while runner.get_queue_length() > 0:
+            _, _, command = runner._async_command_queue.get()
+            actions.append((command['action'], command['payload']))
+        self.assertEqual([('output_status', {'status': [(1, 100)]}),
+                          ('receive_events', {'code': 5}),
+                          ('ping', {}),
+                          ('distribute_metrics', {'name': 'receive', 'metrics': [{'foo': 1}]}),
+                          ('distribute_metrics', {'name': 'receive', 'metrics': [{'foo': 2}]})], actions)
+
 
 if __name__ == "__main__":
     unittest.main(testRunner=xmlrunner.XMLTestRunner(output='../gw-unit-reports'))
@@ -0,0 +1,108 @@
+# Copyright (C) 2020 OpenMotics BV
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the plugin web interface dispatcher
+"""
+from __future__ import absolute_import
+
+import json
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+from threading import Thread
+
+import mock
+import xmlrunner
+
+from plugin_runtime.web import UnixSocketAdapter, WebInterfaceDispatcher
+
+
+class WebInterfaceDispatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.directory, 'api.sock')
+        self.logs = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _get_dispatcher(self, socket_path=None):
+        return WebInterfaceDispatcher(self.logs.append, port=8088, socket_path=socket_path)
+
+    def test_calls(self):
+        dispatcher = self._get_dispatcher()
+        with mock.patch('requests.Session.get', return_value=mock.Mock(text='{"success": true}')) as get:
+            self.assertEqual('{"success": true}', dispatcher.get_output_status())
+            dispatcher.set_output(2, is_on=True, dimmer=None)
+            dispatcher.set_output(id=3, is_on=False, token='token')
+            self.assertEqual([mock.call('http://localhost:8088/get_output_status', params={}, timeout=30.0),
+                              mock.call('http://localhost:8088/set_output', params={'id': 2, 'is_on': True, 'dimmer': 'None'}, timeout=30.0),
+                              mock.call('http://localhost:8088/set_output', params={'id': 3, 'is_on': False}, timeout=30.0)],
+                             get.call_args_list)
+        self.assertEqual(3, len(self.logs))  # A single deprecation warning
+        with mock.patch('requests.Session.get', side_effect=ValueError()):
+            self.assertFalse(json.loads(dispatcher.get_output_status())['success'])
+        with self.assertRaises(AttributeError):
+            dispatcher.unknown_call()
+
+    def test_batch(self):
+        dispatcher = self._get_dispatcher()
+        with mock.patch('requests.Session.post', return_value=mock.Mock(text='{"success": true, "responses": []}')) as post:
+            self.assertEqual('{"success": true, "responses": []}', dispatcher.batch([('get_output_status', {}),
+                                                                                    ('set_output', {'id': 1, 'is_on': True, 'dimmer': None})]))
+            url, = post.call_args[0]
+            self.assertEqual('http://localhost:8088/batch_calls', url)
+            self.assertEqual([{'name': 'get_output_status', 'params': {}},
+                              {'name': 'set_output', 'params': {'id': 1, 'is_on': True, 'dimmer': None}}],
+                             json.loads(post.call_args[1]['data']['calls']))
+            with self.assertRaises(AttributeError):
+                dispatcher.batch([('get_plugin_metric_statistics', {})])
+
+    def test_unix_socket(self):
+        dispatcher = self._get_dispatcher(socket_path=self.socket_path)
+        with mock.patch('requests.Session.get', return_value=mock.Mock(text='{}')) as get:
+            dispatcher.get_output_status()
+            self.assertEqual('http://localhost:8088/get_output_status', get.call_args[0][0])  # No socket yet
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        server.listen(1)
+        requests = []
+
+        def _serve():
+            connection, _ = server.accept()
+            for _ in range(3):
+                data = b''
+                while b'\r\n\r\n' not in data:
+                    data += connection.recv(4096)
+                requests.append(data.split(b'\r\n')[0])
+                connection.sendall(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: 16\r\n\r\n{"success":true}')
+            connection.close()
+
+        thread = Thread(target=_serve)
+        thread.start()
+        try:
+            for _ in range(3):  # All calls reuse the same connection
+                self.assertEqual('{"success":true}', dispatcher.get_output_status(id=1))
+        finally:
+            thread.join()
+            server.close()
+        self.assertEqual([b'GET /get_output_status?id=1 HTTP/1.1'] * 3, requests)
+        self.assertIsInstance(dispatcher._WebInterfaceDispatcher__session.get_adapter('http+unix://localhost/'), UnixSocketAdapter)
+
+
+if __name__ == "__main__":
+    unittest.main(testRunner=xmlrunner.XMLTestRunner(output='../gw-unit-reports'))
@@ -25,9 +25,10 @@ import threading
 import time
 import unittest
 
+import mock
 from serial import Serial
 
-from serial_utils import printable
+from serial_utils import DebugBuffer, printable
 
 if False:  # MYPY
     from typing import List, Optional, Tuple
@@ -224,3 +225,31 @@ class SerialMockTest(unittest.TestCase):
 
         serial_mock.read(1)
         self.assertEqual(1, phase['phase'])
+
+
+class DebugBufferTest(unittest.TestCase):
+    """ Tests for DebugBuffer class """
+
+    def test_time_window(self):
+        debug_buffer = DebugBuffer(duration=10)
+        with mock.patch('serial_utils.monotonic', return_value=100.0), \
+                mock.patch.object(time, 'time', return_value=1000.0):
+            debug_buffer.append(bytearray(b'foo'))
+        with mock.patch('serial_utils.monotonic', return_value=105.0), \
+                mock.patch.object(time, 'time', return_value=1005.0):
+            debug_buffer.append(bytearray(b'bar'))
+            self.assertEqual({1000.0: printable(bytearray(b'foo')),
+                              1005.0: printable(bytearray(b'bar'))}, debug_buffer.get())
+        with mock.patch('serial_utils.monotonic', return_value=112.0):
+            self.assertEqual({1005.0: printable(bytearray(b'bar'))}, debug_buffer.get())
+        with mock.patch('serial_utils.monotonic', return_value=120.0):
+            self.assertEqual({}, debug_buffer.get())
+        self.assertEqual(0, len(debug_buffer))
+
+    def test_byte_budget(self):
+        debug_buffer = DebugBuffer(max_bytes=8)
+        with mock.patch.object(time, 'time', side_effect=[1.0, 2.0, 3.0, 4.0]):
+            for data in [b'abc', b'def', b'ghi', b'jk']:
+                debug_buffer.append(bytearray(data))
+        self.assertEqual([printable(bytearray(b'def')), printable(bytearray(b'ghi')), printable(bytearray(b'jk'))],
+                         [v for _, v in sorted(debug_buffer.get().items())])
@@ -0,0 +1,202 @@
+# Copyright (C) 2020 OpenMotics BV
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the plugin IPC helpers
+"""
+from __future__ import absolute_import
+
+import logging
+import os
+import time
+import unittest
+from threading import Thread
+
+import mock
+import msgpack
+import xmlrunner
+
+import toolbox
+from toolbox import EncodedPayload, Empty, PluginIPCReader, PluginIPCWriter, Queue
+
+logger = logging.getLogger('test')
+
+
+class CountingStream(object):
+    """ Wraps a stream, counting the amount of reads/writes """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self.reads = 0
+        self.writes = 0
+
+    def fileno(self):
+        return self._stream.fileno()
+
+    def read(self, size=-1):
+        self.reads += 1
+        return self._stream.read(size)
+
+    def write(self, data):
+        self.writes += 1
+        return self._stream.write(data)
+
+    def flush(self):
+        self._stream.flush()
+
+    def close(self):
+        self._stream.close()
+
+
+class ToolboxTest(unittest.TestCase):
+    def setUp(self):
+        read_fd, write_fd = os.pipe()
+        self.read_stream = CountingStream(os.fdopen(read_fd, 'rb', 0))
+        self.write_stream = CountingStream(os.fdopen(write_fd, 'wb', 0))
+        self.errors = []
+        self.reader = PluginIPCReader(self.read_stream, lambda message, ex: self.errors.append((message, ex)))
+        self.writer = PluginIPCWriter(self.write_stream)
+
+    def tearDown(self):
+        self.write_stream.close()  # Makes the reader stop
+        self.reader.stop()
+        self.read_stream.close()
+
+    @staticmethod
+    def _build_batch(cid):
+        metrics = [{'source': 'OpenMotics',
+                    'type': 'energy',
+                    'timestamp': 1600000000.0 + i,
+                    'tags': {'type': 'openmotics', 'id': '11.{0}'.format(i % 8)},
+                    'values': {'voltage': 230.0, 'frequency': 50.0, 'current': 1.5, 'power': 345.0}}
+                   for i in range(250)]
+        return {'cid': cid, 'action': 'distribute_metrics', 'action_version': 1, 'name': 'receive', 'metrics': metrics}
+
+    def test_queue(self):
+        queue = Queue()
+        with self.assertRaises(Empty):
+            queue.get(block=False)
+        start = time.time()
+        with self.assertRaises(Empty):
+            queue.get(block=True, timeout=0.1)
+        self.assertGreaterEqual(time.time() - start, 0.1)
+        queue.put(1)
+        queue.put(2)
+        self.assertEqual(2, queue.qsize())
+        self.assertEqual(1, queue.get())
+        self.assertEqual(2, queue.get())
+
+        # A waiting get is woken up right away
+        latencies = []
+
+        def _put():
+            for _ in range(20):
+                time.sleep(0.005)
+                queue.put(time.time())
+
+        thread = Thread(target=_put)
+        thread.start()
+        for _ in range(20):
+            timestamp = queue.get(block=True, timeout=1)
+            latencies.append(time.time() - timestamp)
+        thread.join()
+        logger.info('Queue wake up latency: max {0:.2f}ms'.format(max(latencies) * 1000))
+        self.assertLess(sum(latencies) / len(latencies), 0.01)
+
+    def test_event_latency(self):
+        self.reader.start()
+        latencies = []
+        for i in range(50):
+            start = time.time()
+            self.writer.write({'cid': i, 'action': 'output_status', 'action_version': 1, 'status': [(1, 100)]})
+            command = self.reader.get(block=True, timeout=1)
+            latencies.append(time.time() - start)
+            self.assertEqual(i, command['cid'])
+        logger.info('Event latency: avg {0:.2f}ms, max {1:.2f}ms'.format(sum(latencies) / len(latencies) * 1000,
+                                                                         max(latencies) * 1000))
+        self.assertLess(sum(latencies) / len(latencies), 0.01)
+        self.assertEqual([], self.errors)
+
+    def test_metrics_throughput(self):
+        amount = 20
+        batch = ToolboxTest._build_batch(1)
+        size = len(msgpack.packb(batch))
+        os_read = os.read
+        reads = []
+
+        def _read(fd, length):
+            reads.append(fd)
+            return os_read(fd, length)
+
+        with mock.patch.object(toolbox.os, 'read', side_effect=_read):
+            self.reader.start()
+
+            def _write():
+                for i in range(amount):
+                    self.writer.write(ToolboxTest._build_batch(i))
+
+            start = time.time()
+            thread = Thread(target=_write)
+            thread.start()
+            for i in range(amount):
+                command = self.reader.get(block=True, timeout=5)
+                self.assertEqual(i, command['cid'])
+                self.assertEqual(250, len(command['metrics']))
+            duration = time.time() - start
+            thread.join()
+        logger.info('{0} batches of {1} bytes in {2:.3f}s, {3} reads'.format(amount, size, duration, len(reads)))
+        # Reading byte per byte would take `size` reads per batch
+        self.assertLess(len(reads), amount * (size // PluginIPCReader.READ_SIZE + 4))
+        self.assertEqual(0, self.read_stream.reads)
+        self.assertEqual([], self.errors)
+
+    def test_buffered_writes(self):
+        self.reader.start()
+        for i in range(10):
+            self.writer.write({'cid': i, 'action': 'ping', 'action_version': 1}, flush=False)
+        self.assertEqual(0, self.write_stream.writes)
+        with self.assertRaises(Empty):
+            self.reader.get(block=True, timeout=0.05)
+        self.writer.flush()
+        self.assertEqual(1, self.write_stream.writes)
+        self.assertEqual(list(range(10)), [self.reader.get(block=True, timeout=1)['cid'] for _ in range(10)])
+
+        # The buffer is flushed by a normal write, or once it becomes too large
+        self.writer.write({'cid': 10, 'action': 'ping', 'action_version': 1}, flush=False)
+        self.writer.write({'cid': 11, 'action': 'ping', 'action_version': 1})
+        self.assertEqual(2, self.write_stream.writes)
+        for i in range(2):
+            self.writer.write(ToolboxTest._build_batch(12 + i), flush=False)
+        self.assertEqual(3, self.write_stream.writes)
+        self.assertEqual(list(range(10, 14)), [self.reader.get(block=True, timeout=1)['cid'] for _ in range(4)])
+
+    def test_encoded_payload(self):
+        self.reader.start()
+        payload = EncodedPayload({'event': {'type': 'OUTPUT_CHANGE', 'data': {'id': 1}}, 'status': [[1, 5]]})
+        for i in range(2):
+            self.writer.write({'cid': i, 'action': 'output_status', 'action_version': 2}, payload=payload)
+        for i in range(2):
+            self.assertEqual({'cid': i, 'action': 'output_status', 'action_version': 2,
+                              'event': {'type': 'OUTPUT_CHANGE', 'data': {'id': 1}}, 'status': [[1, 5]]},
+                             self.reader.get(block=True, timeout=1))
+
+    def test_invalid_data(self):
+        self.reader.start()
+        self.write_stream.write(msgpack.packb([1, 2]) + msgpack.packb({'cid': 1}))
+        self.assertEqual({'cid': 1}, self.reader.get(block=True, timeout=1))
+        self.assertEqual(1, len(self.errors))
+
+
+if __name__ == "__main__":
+    unittest.main(testRunner=xmlrunner.XMLTestRunner(output='../gw-unit-reports'))